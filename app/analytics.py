@@ -0,0 +1,320 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+import json
+import threading
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select
+from .model import db, Patient, Doctor, Department, Appointment, DoctorSchedule, EntityCount
+from .scheduling import DEFAULT_HOURS, schedule_windows
+
+
+# Management reports (weekly/monthly trends, department x weekday heatmap, doctor
+# utilization, patient demographics) computed with NumPy over a columnar snapshot of the
+# appointments, patients and doctors held by each process. New appointments are appended
+# by id watermark, so a refresh reads only the rows added since the last one
+
+REFRESH_AFTER = timedelta(minutes=1)
+# Patients and doctors are re-read whole this often, to pick up edits. Patients booking for
+# the first time are fetched along with their appointments
+PEOPLE_REFRESH_AFTER = timedelta(minutes=30)
+FETCH_SIZE = 10000
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+AGE_BINS = [18, 30, 45, 60, 75]
+AGE_LABELS = ['0-17', '18-29', '30-44', '45-59', '60-74', '75+']
+BMI_BINS = [18.5, 25, 30]
+BMI_LABELS = ['underweight', 'normal', 'overweight', 'obese']
+GENDERS = ['Male', 'Female']
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+
+
+class Codes:
+    # Categorical values stored as small integer codes, -1 for missing
+    def __init__(self):
+        self.labels = []
+        self.codes = {}
+
+    def code(self, value):
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.labels)
+            self.labels.append(value)
+        return code
+
+
+class Column:
+    # A growable NumPy array (of rows of `width` values when given), appended to in chunks
+    def __init__(self, dtype, width=None):
+        import numpy as np
+        self.width = width
+        self.data = np.empty((1024, width) if width else 1024, dtype)
+        self.size = 0
+
+    def extend(self, values):
+        import numpy as np
+        values = np.asarray(values, self.data.dtype)
+        if self.width:
+            values = values.reshape(-1, self.width)
+        if self.size + len(values) > len(self.data):
+            grown = np.empty((max(len(self.data) * 2, self.size + len(values)),) + self.data.shape[1:], self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+    def set(self, index, value):
+        self.data[index] = value
+
+    @property
+    def values(self):
+        return self.data[:self.size]
+
+
+class People:
+    # Patients or doctors by position. Positions never change, new rows are appended and
+    # edited rows overwritten, so the appointment columns can point into them
+    def __init__(self, columns):
+        self.index = {}
+        self.columns = {name: Column(*spec) if isinstance(spec, tuple) else Column(spec) for name, spec in columns.items()}
+        self.names = []
+
+    def upsert(self, rows):
+        new = defaultdict(list)
+        for row in rows:
+            position = self.index.get(row['id'])
+            if position is None:
+                self.index[row['id']] = len(self.names) + len(new['id'])
+                for name, value in row.items():
+                    new[name].append(value)
+            else:
+                for name, column in self.columns.items():
+                    column.set(position, row[name])
+                self.names[position] = row.get('name')
+        for name, column in self.columns.items():
+            column.extend(new[name])
+        self.names.extend(new['name'] or [None] * len(new['id']))
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Snapshot:
+    def __init__(self):
+        import numpy as np
+        self.watermark = 0
+        self.appointment_ids = Column(np.int64)
+        self.days = Column('datetime64[D]')
+        self.minutes = Column(np.int16)
+        self.patient = Column(np.int32)
+        self.doctor = Column(np.int32)
+        self.genders, self.blood_groups, self.departments = Codes(), Codes(), Codes()
+        self.patients = People({'gender': np.int8, 'age': np.int16, 'blood_group': np.int8, 'height': np.float32, 'weight': np.float32})
+        # slots: bookable slots per weekday, Monday first
+        self.doctors = People({'department': np.int16, 'slots': (np.int16, 7)})
+        self.patients_loaded_at = None
+        self.loaded_at = None
+
+    # ---- Loading ----
+
+    def refresh_patients(self, ids=None):
+        # Every patient, or only the given ones (new patients seen in new appointments)
+        import numpy as np
+        query = db.session.query(Patient.id, Patient.gender, Patient.age, Patient.blood_group, Patient.height, Patient.weight)
+        if ids is not None:
+            query = query.filter(Patient.id.in_(ids))
+        self.patients.upsert({'id': id, 'gender': self.genders.code(gender), 'age': age or 0, 'blood_group': self.blood_groups.code(blood_group),
+                              'height': height or np.nan, 'weight': weight or np.nan}
+                             for id, gender, age, blood_group, height, weight in query.yield_per(FETCH_SIZE))
+        if ids is None:
+            self.patients_loaded_at = datetime.utcnow()
+
+    def refresh_doctors(self):
+        # A few hundred rows, always read whole
+        department_names = dict(db.session.query(Department.id, Department.name))
+        schedules = defaultdict(list)
+        for row in DoctorSchedule.query:
+            schedules[row.doctor_id].append(row)
+        self.doctors.upsert({'id': id, 'name': f'{first_name} {last_name}', 'department': self.departments.code(department_names.get(department_id)),
+                             'slots': weekday_slots(schedule_windows(schedules[id]) if id in schedules else DEFAULT_HOURS)}
+                            for id, first_name, last_name, department_id in db.session.query(Doctor.id, Doctor.first_name, Doctor.last_name, Doctor.department_id))
+
+    def refresh_appointments(self):
+        # Only rows past the watermark. Ids only grow, so that is every new appointment.
+        # Archived ones keep their ids and stay in the snapshot
+        import numpy as np
+        appointments = Appointment.with_archive()
+        statement = select(appointments.id, appointments.date, appointments.time, appointments.patient_id, appointments.doctor_id) \
+            .where(appointments.id > self.watermark).order_by(appointments.id).execution_options(yield_per=FETCH_SIZE)
+        for chunk in db.session.execute(statement).partitions():
+            ids, days, times, patient_ids, doctor_ids = zip(*chunk)
+            missing = {patient_id for patient_id in patient_ids if patient_id not in self.patients.index}
+            if missing:
+                self.refresh_patients(list(missing))
+            if any(doctor_id not in self.doctors.index for doctor_id in doctor_ids):
+                self.refresh_doctors()
+            self.appointment_ids.extend(ids)
+            self.days.extend(np.array(days, 'datetime64[D]'))
+            self.minutes.extend([slot.hour * 60 + slot.minute for slot in times])
+            self.patient.extend([self.patients.index.get(patient_id, -1) for patient_id in patient_ids])
+            self.doctor.extend([self.doctors.index.get(doctor_id, -1) for doctor_id in doctor_ids])
+            self.watermark = ids[-1]
+        self.loaded_at = datetime.utcnow()
+
+    def refresh(self):
+        if self.patients_loaded_at is None or datetime.utcnow() - self.patients_loaded_at > PEOPLE_REFRESH_AFTER:
+            self.refresh_patients()
+            self.refresh_doctors()
+        self.refresh_appointments()
+        # Deleted or archived appointments don't move the watermark, a count that no longer
+        # matches the maintained rollup means the snapshot has to be rebuilt
+        total = EntityCount.get_count('appointment')
+        return total is None or total == self.appointment_ids.size
+
+
+def weekday_slots(windows):
+    return [sum((end - start) // slot for start, end, slot in windows.get(weekday, ())) for weekday in range(7)]
+
+
+# Built on first use, NumPy is only imported by the report, not when a worker boots
+snapshot = None
+_lock = threading.Lock()
+
+
+def get_snapshot(force=False):
+    global snapshot
+    with _lock:
+        if snapshot is None:
+            snapshot = Snapshot()
+        if force or snapshot.loaded_at is None or datetime.utcnow() - snapshot.loaded_at > REFRESH_AFTER:
+            if not snapshot.refresh():
+                snapshot = Snapshot()
+                snapshot.refresh()
+        return snapshot
+
+
+# ---------------------------- Aggregates ---------------------------- #
+
+def _in_range(snap, date_from=None, date_to=None):
+    import numpy as np
+    mask = np.ones(snap.days.size, bool)
+    if date_from:
+        mask &= snap.days.values >= np.datetime64(date_from, 'D')
+    if date_to:
+        mask &= snap.days.values <= np.datetime64(date_to, 'D')
+    return mask
+
+
+def trends(snap, mask, period='week'):
+    # Appointments per week (starting Monday) or month, split by patient gender
+    import numpy as np
+    days = snap.days.values[mask]
+    if not days.size:
+        return []
+    if period == 'month':
+        buckets = days.astype('datetime64[M]')
+    else:
+        buckets = days - ((days.astype(np.int64) + EPOCH_WEEKDAY) % 7).astype('timedelta64[D]')
+    starts, bucket = np.unique(buckets, return_inverse=True)
+    patient = snap.patient.values[mask]
+    gender = np.where(patient >= 0, snap.patients.columns['gender'].values[patient], -1)
+    series = {'total': np.bincount(bucket, minlength=len(starts))}
+    for label in GENDERS:
+        code = snap.genders.codes.get(label, -2)
+        series[label.lower()] = np.bincount(bucket[gender == code], minlength=len(starts))
+    return [{'start': str(start.astype('datetime64[D]')), **{name: int(counts[i]) for name, counts in series.items()}} for i, start in enumerate(starts)]
+
+
+def department_weekday_heatmap(snap, mask):
+    import numpy as np
+    doctor = snap.doctor.values[mask]
+    known = doctor >= 0
+    department = snap.doctors.columns['department'].values[doctor[known]].astype(np.int64)
+    weekday = (snap.days.values[mask][known].astype(np.int64) + EPOCH_WEEKDAY) % 7
+    has_department = department >= 0
+    departments = len(snap.departments.labels)
+    counts = np.bincount(department[has_department] * 7 + weekday[has_department], minlength=departments * 7).reshape(departments, 7)
+    return {'departments': snap.departments.labels, 'weekdays': WEEKDAYS, 'counts': counts.tolist()}
+
+
+def doctor_utilization(snap, mask, date_from, date_to, limit=None):
+    # Booked slots over bookable slots in the window, from each doctor's weekly hours
+    import numpy as np
+    doctors = len(snap.doctors)
+    doctor = snap.doctor.values[mask]
+    booked = np.bincount(doctor[doctor >= 0], minlength=doctors)
+    window = np.arange(np.datetime64(date_from, 'D'), np.datetime64(date_to, 'D') + 1)
+    weekday_counts = np.bincount((window.astype(np.int64) + EPOCH_WEEKDAY) % 7, minlength=7)
+    capacity = snap.doctors.columns['slots'].values.astype(np.int64) @ weekday_counts
+    utilization = np.divide(booked, capacity, out=np.zeros(doctors), where=capacity > 0)
+    order = np.argsort(-utilization, kind='stable')[:limit]
+    departments = snap.doctors.columns['department'].values
+    ids = list(snap.doctors.index)
+    return {
+        'overall': float(booked.sum() / capacity.sum()) if capacity.sum() else 0.0,
+        'doctors': [{'id': str(ids[i]), 'name': snap.doctors.names[i],
+                     'department': snap.departments.labels[departments[i]] if departments[i] >= 0 else None,
+                     'booked': int(booked[i]), 'capacity': int(capacity[i]), 'utilization': round(float(utilization[i]), 4)} for i in order],
+    }
+
+
+def patient_demographics(snap):
+    import numpy as np
+    columns = snap.patients.columns
+    age = columns['age'].values
+    height, weight = columns['height'].values.astype(np.float64), columns['weight'].values.astype(np.float64)
+    # Heights are entered in metres, but centimetres show up too
+    height = np.where(height > 3, height / 100, height)
+    valid = (height > 0) & (weight > 0)
+    bmi = weight[valid] / height[valid] ** 2
+
+    def counts(codes, labels):
+        return {label: int(count) for label, count in zip(labels, np.bincount(codes[codes >= 0], minlength=len(labels)))}
+    return {
+        'patients': len(snap.patients),
+        'age': dict(zip(AGE_LABELS, map(int, np.bincount(np.digitize(age, AGE_BINS), minlength=len(AGE_LABELS))))),
+        'bmi': dict(zip(BMI_LABELS, map(int, np.bincount(np.digitize(bmi, BMI_BINS), minlength=len(BMI_LABELS))))),
+        'bmi_mean': round(float(bmi.mean()), 2) if bmi.size else None,
+        'blood_group': counts(columns['blood_group'].values.astype(np.int64), snap.blood_groups.labels),
+        'gender': counts(columns['gender'].values.astype(np.int64), snap.genders.labels),
+    }
+
+
+def report(date_from=None, date_to=None, period='week', top_doctors=20):
+    snap = get_snapshot()
+    with _lock:
+        mask = _in_range(snap, date_from, date_to)
+        days = snap.days.values[mask]
+        span_from = date_from or (days.min().item() if days.size else date.today())
+        span_to = date_to or (days.max().item() if days.size else date.today())
+        return {
+            'appointments': int(mask.sum()),
+            'date_from': str(span_from),
+            'date_to': str(span_to),
+            'trends': trends(snap, mask, period),
+            'department_weekday': department_weekday_heatmap(snap, mask),
+            'utilization': doctor_utilization(snap, mask, span_from, span_to, top_doctors),
+            'demographics': patient_demographics(snap),
+        }
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('analytics', cls=AppGroup, help='Appointment trends and patient demographics.')
+def analytics_cli():
+    pass
+
+
+@analytics_cli.command('report', help='Print the analytics report as JSON.')
+@click.option('--from', 'date_from', type=click.DateTime(['%Y-%m-%d']))
+@click.option('--to', 'date_to', type=click.DateTime(['%Y-%m-%d']))
+@click.option('--period', type=click.Choice(['week', 'month']), default='week', show_default=True)
+def report_command(date_from, date_to, period):
+    click.echo(json.dumps(report(date_from and date_from.date(), date_to and date_to.date(), period), indent=2))
+
+
+def init_app(app):
+    app.cli.add_command(analytics_cli)
@@ -1,247 +1,93 @@
-from flask import Flask, request, render_template, redirect, url_for, flash, session, current_app
-from flask_login import login_user, LoginManager, login_required, current_user, logout_user
+from flask import Flask
+from flask_login import LoginManager
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
-from dotenv import load_dotenv
-from .model import Patient, Admin, Doctor, Role, Appointment, db, app, upload_file_to_azure
-import secrets
-from PIL import Image
-from werkzeug.utils import secure_filename
-from functools import wraps
+from .config import load_config
+from .model import Patient, Admin, Doctor, db, ROLE_MODELS
+from .cache import identity_cache, identity_version
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import make_transient_to_detached
+from .blueprints.patients import patient
 from .blueprints.admin import admin
 from .blueprints.doctors import doctor
+from . import rollups, cache, hashing, storage, images, scheduling, migrations, instrumentation, imports, exports, search, analytics, templating, assets, mail, jobs, replicas, archive
+# Registers the email jobs
+from . import notifications
 from uuid import UUID
-from datetime import datetime
 
-load_dotenv()
-
-
-upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
-os.makedirs(upload_dir, exist_ok=True)
-
-app.config['UPLOAD_FOLDER'] = upload_dir
 
 login_manager = LoginManager()
-login_manager.init_app(app)
+
 
 @login_manager.user_loader
 def load_user(user_id):
+    # Recently seen users are rebuilt from their cached columns without a query, unless
+    # the user changed since. The version is read first, a change made while the user is
+    # loaded below bumps it past the one the snapshot is stored with
+    version = identity_version(user_id)
+    hit, entry = identity_cache.get(user_id)
+    if hit and entry[0] == version:
+        Model, columns = entry[1]
+        user = Model(**columns)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    # Session ids are "<role_id>:<uuid>", older sessions only carry the uuid
+    role_id, _, raw_id = user_id.rpartition(':')
     try:
-        user_id = UUID(user_id)
-    except ValueError:
+        uid = UUID(raw_id)
+        models = [ROLE_MODELS[int(role_id)]] if role_id else [Patient, Doctor, Admin]
+    except (ValueError, KeyError):
         return None
-    for Model in [Patient, Doctor, Admin]:
-        user = Model.query.get(user_id)
+    for Model in models:
+        user = db.session.get(Model, uid)
         if user:
+            identity_cache.set(user_id, (version, (Model, {attr.key: getattr(user, attr.key) for attr in sa_inspect(Model).column_attrs})))
             return user
     return None
 
 
-def save_picture(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(current_app.root_path, 'static/profile_pics', picture_fn)
-
-    output_size = (400, 400)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-
-    return picture_fn
-
-
-def patient_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if current_user.role_id != 1:  # Assuming 3 is the role_id for admins
-            print(current_user.role_id)
-            flash('You are not authorized to view this page', 'danger')
-            return redirect(url_for('unauthorized'))  # Redirect to a general page if user is not an admin
-        return f(*args, **kwargs)
-    return decorated_function
-
-
-
-# ---------------------------- Patient Section ---------------------------- #
-
-@app.route('/unauthorized')
-def unauthorized():
-    return render_template('landing/error.html')
-
-
-@app.route('/')
-def home():
-    return render_template('landing/index-three.html')
-
-
-@app.route('/dashboard')
-@login_required
-@patient_required
-def index():
-    patient_id = current_user.id
-    user = Patient.query.get(patient_id)
-    patient_appointments = Appointment.query.filter_by(patient_id=patient_id).all()
-    return render_template('landing/patient-dashboard.html', patient=user, appointments=patient_appointments)
-
-
-@app.route('/register', methods=['GET', 'POST'])
-def register():
-    if request.method == 'POST':
-        first_name = request.form['first_name']
-        last_name = request.form['last_name']
-        email = request.form['email']
-        phone_number = request.form['phone_number']
-        password = request.form['password']
-        age = request.form['age']
-        health_status = request.form['health_status']
-        blood_group = request.form['blood_group']
-        height = request.form['height']
-        weight = request.form['weight']
-        gender = request.form['gender']
-        role_id = 1
-
-        # Check if role with id 1 exists
-        role = Role.query.get(role_id)
-        if not role:
-            # If not, create it
-            role = Role(id=role_id, name='Patient')
-            db.session.add(role)
-            db.session.commit()
-
-        # Handle the file upload
-        image = request.files['image']
-        if image:
-            filename = secure_filename(image.filename)
-            # image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            # image_file = filename
-            blob_url = upload_file_to_azure(image, filename)
-            print(blob_url)
-            if blob_url:
-                image_file = blob_url
-            else:
-                flash('Failed to upload image', 'danger')
-                return redirect(url_for('register'))
-        else:
-            image_file = 'https://static-00.iconduck.com/assets.00/profile-default-icon-512x511-v4sw4m29.png'
-
-        user = Patient(first_name=first_name, last_name=last_name, gender=gender, email=email, phone_number=phone_number, role_id=role_id, age=age, health_status=health_status, blood_group=blood_group, height=height, weight=weight, image_file=image_file)
-        user.set_password(password)
-        db.session.add(user)
-        db.session.commit()
-        flash('You have successfully registered', 'success')
-        login_user(user)
-        return redirect(url_for('index'))
-    
-    return render_template('landing/signup.html')
-
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        email = request.form['email']
-        password = request.form['password']
-        user = Patient.query.filter_by(email=email).first()
-        if user and user.check_password(password):
-            login_user(user)
-            return redirect(url_for('index'))
-        else:
-            flash('Invalid username or password', 'danger')
-    return render_template('landing/login.html')
-
-
-@app.route('/logout')
-@login_required
-@patient_required
-def logout():
-    logout_user()
-    return redirect(url_for('login'))
-
-
-@app.route('/profile')
-@login_required
-@patient_required
-def profile():
-    return render_template('profile.html')
-
-
-@app.route('/update-profile', methods=['GET', 'POST'])
-@login_required
-@patient_required
-def update_profile():
-    if request.method == 'POST':
-        user = Patient.query.get(current_user.id)
-        user.first_name = request.form['first_name']
-        user.last_name = request.form['last_name']
-        user.email = request.form['email']
-        user.phone_number = request.form['phone_number']
-        user.bio = request.form['bio']
-        db.session.commit()
-        flash('Profile updated successfully', 'success')
-        return redirect(url_for('profile'))
-    return render_template('update-profile.html')
-
-# def update_profile():
-#     form = UpdateProfileForm()
-#     if form.validate_on_submit():
-#         if form.picture.data:
-#             picture_file = save_picture(form.picture.data)
-#             current_user.image_file = picture_file
-#         current_user.bio = form.bio.data
-#         db.session.commit()
-#         flash('Your profile has been updated!')
-#         return redirect(url_for('profile'))
-#     elif request.method == 'GET':
-#         form.bio.data = current_user.bio
-#     image_file = url_for('static', filename='profile_pics/' + current_user.image_file)
-#     return render_template('update_profile.html', title='Update Profile', image_file=image_file, form=form)
-
-
-@app.route('/book-appointment', methods=['GET', 'POST'])
-@login_required
-@patient_required
-def book_appointment():
-    if request.method == 'POST':
-
-        doctor_id = request.form['doctor']
-        if not doctor_id:
-            doctor_id = None
-        else:
-            doctor_id = UUID(doctor_id)
-
-        patient_id = current_user.id
-        appointment_type = request.form['appointment_type']
-        comments = request.form['comments']
-        # status = 'pending'
-        
-        if appointment_type == 'online':
-            appointment_date = request.form['date']
-            appointment_time = request.form['time']
-
-            appointment_date = datetime.strptime(appointment_date, '%Y-%m-%d').date()
-            appointment_time = datetime.strptime(appointment_time, '%H:%M').time()
-
-            appointment = Appointment(doctor_id=doctor_id, patient_id=patient_id, date=appointment_date, time=appointment_time, comment=comments)
-        else:
-            appointment = Appointment(doctor_id=doctor_id, patient_id=patient_id, comment=comments)
-
-        db.session.add(appointment)
-        db.session.commit()
-        flash('Appointment booked successfully', 'success')
-        return redirect(url_for('index'))
-
-    doctors = Doctor.query.all()
-    patient_id = current_user.id
-    user = Patient.query.get(patient_id)
-
-    return render_template('landing/booking-appointment.html', doctors=doctors, patient=user) 
-
-
-
-
-
-app.register_blueprint(admin, url_prefix='/admin')
-app.register_blueprint(doctor, url_prefix='/doctor')
+def create_app(config=None):
+    # Nothing here connects to the database, the engine opens its first connection on the
+    # first query. Run with `flask --app app.app run` or `gunicorn 'app.app:create_app()'`
+    app = Flask(__name__)
+    load_config(app, config)
+
+    upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+    app.config['UPLOAD_FOLDER'] = upload_dir
+
+    templating.init_app(app)
+    assets.init_app(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    rollups.init_app(app)
+    cache.init_app(app, db)
+    hashing.init_app(app)
+    storage.init_app(app)
+    images.init_app(app)
+    scheduling.init_app(app)
+    migrations.init_app(app)
+    instrumentation.init_app(app, db)
+    imports.init_app(app)
+    exports.init_app(app)
+    search.init_app(app)
+    analytics.init_app(app)
+    mail.init_app(app)
+    jobs.init_app(app)
+    replicas.init_app(app)
+    archive.init_app(app)
+
+    app.register_blueprint(patient)
+    app.register_blueprint(admin, url_prefix='/admin')
+    app.register_blueprint(doctor, url_prefix='/doctor')
+
+    if app.config['AUTO_CREATE_SCHEMA']:
+        with app.app_context():
+            # Replicas get the schema by replication
+            db.create_all(bind_key=None)
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
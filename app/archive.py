@@ -0,0 +1,106 @@
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, insert, delete, literal, func
+from .model import db, Appointment, AppointmentArchive, AppointmentReminder, BookingKey
+from .cache import cache
+from .jobs import task
+
+
+# Hot/cold split of the appointments. Interactive use is about the last few months, so
+# appointments that took place more than ARCHIVE_AFTER_DAYS ago are moved in batches to
+# appointment_archive, keeping the appointment table and its indexes small. Queries only
+# read the archive for date ranges that reach into it, see Appointment.between(). The
+# dashboard rollups count archived appointments too, moving a row leaves them as they are
+
+COLUMNS = ('id', 'date', 'time', 'patient_id', 'doctor_id', 'comment')
+
+
+def cutoff(today=None):
+    return (today or date.today()) - timedelta(days=current_app.config['ARCHIVE_AFTER_DAYS'])
+
+
+def ensure_partitions(connection, first, last):
+    # Postgres only, one partition per year. Created up front in their own transaction,
+    # adding a partition locks the whole archive table
+    if connection.dialect.name != 'postgresql':
+        return
+    for year in range(first.year, last.year + 1):
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS appointment_archive_{year} PARTITION OF appointment_archive "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')")
+
+
+def archive_batch(before, batch_size, now):
+    # Moves the oldest appointments dated before `before` and returns how many. Postgres
+    # skips rows another archiver has locked
+    ids = [id for id, in db.session.execute(
+        select(Appointment.id).where(Appointment.date < before).order_by(Appointment.date, Appointment.time, Appointment.id)
+        .limit(batch_size).with_for_update(skip_locked=True))]
+    if not ids:
+        return 0
+    db.session.execute(insert(AppointmentArchive).from_select(
+        [*COLUMNS, 'archived_at'],
+        select(*(getattr(Appointment, name) for name in COLUMNS), literal(now, db.DateTime)).where(Appointment.id.in_(ids))))
+    # The foreign keys cascade as well, but SQLite only enforces them with foreign_keys on
+    db.session.execute(delete(AppointmentReminder).where(AppointmentReminder.appointment_id.in_(ids)).execution_options(synchronize_session=False))
+    db.session.execute(delete(BookingKey).where(BookingKey.appointment_id.in_(ids)).execution_options(synchronize_session=False))
+    db.session.execute(delete(Appointment).where(Appointment.id.in_(ids)).execution_options(synchronize_session=False))
+    return len(ids)
+
+
+def archive_appointments(before=None, batch_size=None, echo=None):
+    before = before or cutoff()
+    batch_size = batch_size or current_app.config['ARCHIVE_BATCH_SIZE']
+    oldest = db.session.query(func.min(Appointment.date)).filter(Appointment.date < before).scalar()
+    if oldest is None:
+        return 0
+    with db.engine.begin() as connection:
+        ensure_partitions(connection, oldest, before)
+    now = datetime.utcnow()
+    moved = 0
+    while True:
+        count = archive_batch(before, batch_size, now)
+        db.session.commit()
+        if not count:
+            return moved
+        # Bulk statements skip the session events: listings, dashboard stats and every
+        # doctor's dashboard are recomputed on their next read
+        cache.invalidate('appointment', 'appointment_archive', 'doctor_dashboard')
+        moved += count
+        if echo:
+            echo(f'{moved} appointments archived')
+
+
+@task('archive_appointments', every='ARCHIVE_INTERVAL')
+def run_archival():
+    archive_appointments()
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('archive', cls=AppGroup, help='Move old appointments to the archive table.')
+def archive_cli():
+    pass
+
+
+@archive_cli.command('run', help='Archive appointments older than ARCHIVE_AFTER_DAYS.')
+@click.option('--before', type=click.DateTime(['%Y-%m-%d']), help='Archive appointments dated before this day instead.')
+@click.option('--batch-size', type=int, help='Rows moved per transaction.')
+def run_command(before, batch_size):
+    moved = archive_appointments(before.date() if before else None, batch_size, echo=click.echo)
+    click.echo(f'Archived {moved} appointments')
+
+
+@archive_cli.command('status', help='Count hot and archived appointments.')
+def status_command():
+    hot, oldest = db.session.query(func.count(Appointment.id), func.min(Appointment.date)).one()
+    archived, first, last = db.session.query(func.count(AppointmentArchive.id), func.min(AppointmentArchive.date), func.max(AppointmentArchive.date)).one()
+    click.echo(f'hot       {hot:>10}  from {oldest}')
+    click.echo(f'archived  {archived:>10}  {f"{first} to {last}" if archived else ""}')
+    click.echo(f'cutoff    {cutoff()}')
+
+
+def init_app(app):
+    app.cli.add_command(archive_cli)
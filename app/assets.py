@@ -0,0 +1,242 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import AppGroup
+
+
+# `flask assets build` copies every static file the templates reference (and the fonts and
+# images their stylesheets pull in) to static/dist under a content-hashed name, with gzip
+# siblings, brotli ones too when the optional Brotli package is installed (it is left out
+# of requirements.txt, `pip install Brotli` on the build machine), and writes
+# dist/manifest.json. Once the manifest exists,
+# url_for('static', filename=...) points at the hashed copy and those are served with
+# immutable cache headers. Without a build nothing changes
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.map', '.txt', '.html', '.ttf', '.eot', '.otf'}
+# Encodings tried in order of preference, with the suffix of their precompressed sibling
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Vendor scripts every admin page loads back to back, served as one file. Only libraries
+# go in: a page script that throws would stop everything after it in the same bundle
+BUNDLES = {
+    'assets/js/admin-vendor.js': [
+        'assets/libs/simplebar/simplebar.min.js',
+        'assets/libs/apexcharts/apexcharts.min.js',
+        'assets/libs/feather-icons/feather.min.js',
+        'assets/libs/bootstrap/js/bootstrap.bundle.min.js',
+    ],
+}
+
+TEMPLATE_REFERENCE = re.compile(r"""url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*['"]([^'"]+)['"]\s*\)""")
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+CSS_COMMENT = re.compile(r'/\*(?!!).*?\*/', re.S)
+SOURCE_MAP = re.compile(r'^\s*//# sourceMappingURL=.*$|/\*# sourceMappingURL=.*?\*/', re.M)
+
+# {'files': {source path: hashed path}, 'bundles': {bundle: hashed path}, 'version': ...}
+manifest = {}
+
+
+def _brotli():
+    # Only needed by the build, and optional there: without it only gzip siblings are written
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def hashed_name(path, content):
+    root, ext = posixpath.splitext(path)
+    return f'{DIST_DIR}/{root}.{hashlib.md5(content).hexdigest()[:10]}{ext}'
+
+
+def minify_css(text):
+    # Comments and whitespace only. Spaces around ':' are kept, 'a :hover' is not 'a:hover'
+    text = CSS_COMMENT.sub('', text)
+    text = re.sub(r'\s+', ' ', text)
+    return re.sub(r'\s*([{};,>])\s*', r'\1', text).strip()
+
+
+class Builder:
+    def __init__(self, static_folder, echo=print):
+        self.static_folder = static_folder
+        self.echo = echo
+        self.files = {}
+        self.brotli = _brotli()
+        self.written = 0
+
+    def read(self, path):
+        with open(os.path.join(self.static_folder, path), 'rb') as f:
+            return f.read()
+
+    def exists(self, path):
+        return os.path.isfile(os.path.join(self.static_folder, path))
+
+    def add(self, path):
+        # Builds a referenced file once and returns its hashed path
+        if path in self.files:
+            return self.files[path]
+        content = self.read(path)
+        if path.endswith('.css'):
+            content = self.rewrite_css(path, content.decode('utf-8')).encode('utf-8')
+        elif path.endswith('.js'):
+            content = SOURCE_MAP.sub('', content.decode('utf-8')).encode('utf-8')
+        self.files[path] = self.write(path, content)
+        return self.files[path]
+
+    def rewrite_css(self, path, text):
+        # Point url() at the hashed copies, building the fonts and images as they come up
+        out_dir = posixpath.dirname(hashed_name(path, b''))
+
+        def replace(match):
+            quote, target = match.groups()
+            if re.match(r'^(data:|[a-z]+:|//|/|#)', target, re.I):
+                return match.group(0)
+            bare, suffix = re.match(r'([^?#]*)(.*)', target).groups()
+            referenced = posixpath.normpath(posixpath.join(posixpath.dirname(path), bare))
+            if not self.exists(referenced):
+                return match.group(0)
+            return f'url({quote}{posixpath.relpath(self.add(referenced), out_dir)}{suffix}{quote})'
+
+        text = CSS_URL.sub(replace, SOURCE_MAP.sub('', text))
+        return text if path.endswith('.min.css') else minify_css(text)
+
+    def bundle(self, name, members):
+        content = b'\n;\n'.join(SOURCE_MAP.sub('', self.read(member).decode('utf-8')).encode('utf-8') for member in members)
+        return self.write(name, content)
+
+    def write(self, path, content):
+        target = hashed_name(path, content)
+        full = os.path.join(self.static_folder, target)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'wb') as f:
+            f.write(content)
+        self.written += len(content)
+        if posixpath.splitext(path)[1].lower() in COMPRESSIBLE:
+            self.compress(full, content)
+        return target
+
+    def compress(self, full, content):
+        # Siblings that don't come out smaller are not worth serving
+        variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if self.brotli:
+            variants.append(('.br', self.brotli.compress(content, quality=11)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(content):
+                with open(full + suffix, 'wb') as f:
+                    f.write(compressed)
+
+
+def template_references(template_folder):
+    references = set()
+    for folder, _, files in os.walk(template_folder):
+        for file in files:
+            with open(os.path.join(folder, file), encoding='utf-8') as f:
+                references.update(TEMPLATE_REFERENCE.findall(f.read()))
+    return references
+
+
+def build(app, echo=print):
+    static_folder = app.static_folder
+    shutil.rmtree(os.path.join(static_folder, DIST_DIR), ignore_errors=True)
+    builder = Builder(static_folder, echo)
+    missing = []
+    for path in sorted(template_references(os.path.join(app.root_path, app.template_folder))):
+        if builder.exists(path):
+            builder.add(path)
+        else:
+            missing.append(path)
+    bundles = {name: builder.bundle(name, members) for name, members in BUNDLES.items()}
+    for path in missing:
+        echo(f'Referenced but missing: {path}')
+    if not builder.brotli:
+        echo('brotli is not installed, only gzip variants were written')
+
+    version = hashlib.md5(json.dumps([builder.files, bundles], sort_keys=True).encode()).hexdigest()[:10]
+    result = {'files': builder.files, 'bundles': bundles, 'version': version}
+    with open(os.path.join(static_folder, DIST_DIR, MANIFEST), 'w') as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+    echo(f'{len(builder.files)} files and {len(bundles)} bundles, {builder.written / 1024 / 1024:.1f} MB, manifest version {version}')
+    return result
+
+
+def load_manifest(app):
+    try:
+        with open(os.path.join(app.static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# ---------------------------- Serving ---------------------------- #
+
+def fingerprint(endpoint, values):
+    # url_defaults hook, turns every url_for('static', filename=...) into the hashed copy
+    if endpoint == 'static' and manifest:
+        hashed = manifest['files'].get(values.get('filename'))
+        if hashed:
+            values['filename'] = hashed
+
+
+def asset_bundle(name):
+    # Script URLs for a bundle: the built file, or its members one by one before a build
+    if name in manifest.get('bundles', {}):
+        return [url_for('static', filename=manifest['bundles'][name])]
+    return [url_for('static', filename=member) for member in BUNDLES[name]]
+
+
+def serve_static(filename):
+    if not filename.startswith(DIST_DIR + '/'):
+        return current_app.send_static_file(filename)
+    # Hashed names never change content, let browsers and proxies keep them for a year
+    accepted = request.accept_encodings
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        if accepted[encoding] and os.path.isfile(os.path.join(current_app.static_folder, filename + suffix)):
+            response = send_from_directory(current_app.static_folder, filename + suffix, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(current_app.static_folder, filename, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('assets', cls=AppGroup, help='Build fingerprinted, precompressed static assets.')
+def assets_cli():
+    pass
+
+
+@assets_cli.command('build', help='Hash, minify and compress the referenced static files into static/dist.')
+def build_command():
+    build(current_app, echo=click.echo)
+
+
+@assets_cli.command('clean', help='Remove static/dist, static files are served as they are again.')
+def clean_command():
+    shutil.rmtree(os.path.join(current_app.static_folder, DIST_DIR), ignore_errors=True)
+
+
+def init_app(app):
+    global manifest
+    manifest = load_manifest(app) if app.config.get('ASSETS_FINGERPRINT', True) else {}
+    app.url_defaults(fingerprint)
+    app.add_template_global(asset_bundle)
+    app.view_functions['static'] = serve_static
+    app.cli.add_command(assets_cli)
+    if manifest:
+        # Cached fragments hold static URLs, a new build must not serve the old ones
+        app.config['FRAGMENT_CACHE_VERSION'] = f'{app.config["FRAGMENT_CACHE_VERSION"]}.{manifest["version"]}'
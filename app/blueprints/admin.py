@@ -1,10 +1,21 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, get_flashed_messages
+from flask import Blueprint, render_template, redirect, url_for, flash, request, get_flashed_messages, jsonify, abort, Response, stream_with_context
 from flask_login import current_user, login_required, login_user, logout_user
-from ..model import db, Admin, Doctor, Department, Patient, Appointment, app, Role, upload_file_to_azure
+from ..model import db, Admin, Doctor, Department, Patient, Appointment, Role
+from ..storage import read_profile_image, upload_profile_image, DEFAULT_PROFILE_IMAGE
+from ..images import ImageRejected
+from ..pagination import InvalidCursor, KeysetPage
+from ..search import search, SEARCH_KINDS, MAX_LIMIT
+from ..cache import cache, forget_user
+from ..directory import get_directory
+from ..routing import read_only
+from ..analytics import report as analytics_report
+from ..imports import IMPORT_KINDS, iter_rows, import_rows, guess_format
+from ..exports import build_statement, stream_partitions, export_filename, ENCODERS, FORMATS, STREAMABLE_FORMATS
 from functools import wraps
 import os
 from werkzeug.utils import secure_filename
 from uuid import UUID
+from datetime import date
 
 
 admin = Blueprint('admin', __name__)
@@ -16,11 +27,70 @@ def admin_required(f):
         if current_user.role_id != 3:  # Assuming 3 is the role_id for admins
             print(current_user.role_id)
             flash('You are not authorized to view this page', 'danger')
-            return redirect(url_for('unauthorized'))  # Redirect to a general page if user is not an admin
+            return redirect(url_for('patient.unauthorized'))  # Redirect to a general page if user is not an admin
         return f(*args, **kwargs)
     return decorated_function
 
 
+LISTING_FILTERS = {
+    'date_from': date.fromisoformat,
+    'date_to': date.fromisoformat,
+    'department': int,
+    'doctor': UUID,
+    'gender': str,
+    'blood_group': str,
+}
+
+
+def get_listing_page(get_page, *filter_names):
+    # Parse the cursor and the allowed filters from the query string and fetch one keyset page.
+    # Returns the page plus the raw filter values so templates can build next-page links
+    raw_filters = {name: request.args[name] for name in filter_names if request.args.get(name)}
+    try:
+        filters = {name: LISTING_FILTERS[name](value) for name, value in raw_filters.items()}
+    except ValueError:
+        abort(400)
+
+    # Model methods take the column-style names
+    for name, column in (('department', 'department_id'), ('doctor', 'doctor_id')):
+        if name in filters:
+            filters[column] = filters.pop(name)
+
+    try:
+        page = get_page(cursor=request.args.get('cursor'), per_page=request.args.get('per_page', type=int), **filters)
+    except InvalidCursor:
+        abort(400)
+    return page, raw_filters
+
+
+def search_page(kind, Model):
+    filters = {name: request.args[name] for name in SEARCH_KINDS[kind].filters if request.args.get(name)}
+    items = search(kind, request.args['q'], filters, limit=MAX_LIMIT)
+    by_id = {record.id: record for record in Model.query.filter(Model.id.in_([UUID(item['id']) for item in items]))}
+    return KeysetPage([by_id[UUID(item['id'])] for item in items if UUID(item['id']) in by_id], None)
+
+
+def patient_json(patient):
+    return {'id': str(patient.id), 'first_name': patient.first_name, 'last_name': patient.last_name,
+            'email': patient.email, 'phone_number': patient.phone_number, 'gender': patient.gender,
+            'age': patient.age, 'blood_group': patient.blood_group, 'health_status': patient.health_status,
+            'image_file': patient.image_file}
+
+
+def doctor_json(doctor):
+    return {'id': str(doctor.id), 'first_name': doctor.first_name, 'last_name': doctor.last_name,
+            'email': doctor.email, 'phone_number': doctor.phone_number, 'gender': doctor.gender,
+            'department': doctor.department.name if doctor.department else None, 'image_file': doctor.image_file}
+
+
+def appointment_json(appointment):
+    patient, doctor = appointment.patient, appointment.doctor
+    return {'id': appointment.id, 'date': appointment.date.isoformat(), 'time': appointment.time.isoformat(timespec='minutes'),
+            'patient': {'id': str(appointment.patient_id), 'name': f'{patient.first_name} {patient.last_name}' if patient else None},
+            'doctor': {'id': str(appointment.doctor_id), 'name': f'{doctor.first_name} {doctor.last_name}' if doctor else None},
+            'department': doctor.department.name if doctor and doctor.department else None}
+
+
 
 # ---------------------------------- Admin Section ------------------------------------------- #
 
@@ -32,8 +102,10 @@ def unauthorized():
 @admin.route('/')
 @login_required
 @admin_required
+@read_only
 def admin_dashboard():
-    admin = Admin.query.filter_by(id=current_user.id).first()
+    # The admin login_manager already loaded for this request, no second query
+    admin = current_user
     male_counts, female_counts = Appointment.get_gender_counts()
     top_departments = Department.get_top_departments()
     total_patients = Patient.get_unique_patient_count()
@@ -85,6 +157,7 @@ def admin_login():
         user = Admin.query.filter_by(email=email).first()
         if user and user.check_password(password):
             login_user(user)
+            db.session.commit()
             return redirect(url_for('admin.admin_dashboard'))
         else:
             flash('Invalid email or password', 'danger')
@@ -94,6 +167,7 @@ def admin_login():
 @admin.route('/logout')
 @login_required
 def admin_logout():
+    forget_user(current_user)
     logout_user()
     return redirect(url_for('admin.admin_login'))
 
@@ -122,31 +196,28 @@ def add_doctor():
             db.session.add(role)
             db.session.commit()
 
-        # Handle the file upload
+        # The picture is processed and uploaded in the background, the default image shows until it lands
         image = request.files['image']
         if image:
-            filename = secure_filename(image.filename)
-            # image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            # image_file = filename
-            blob_url = upload_file_to_azure(image, filename)
-            print(blob_url)
-            if blob_url:
-                image_file = blob_url
-            else:
-                flash('Failed to upload image', 'danger')
-                return redirect(url_for('add_doctor'))
-        else:
-            image_file = 'https://static-00.iconduck.com/assets.00/profile-default-icon-512x511-v4sw4m29.png'
+            try:
+                image_data = read_profile_image(image)
+            except ImageRejected as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('admin.add_doctor'))
 
-        user = Doctor(first_name=first_name, last_name=last_name, bio=bio, image_file=image_file, email=email, gender=gender, phone_number=phone_number, role_id=role_id, department_id=department_id)
+        user = Doctor(first_name=first_name, last_name=last_name, bio=bio, image_file=DEFAULT_PROFILE_IMAGE, email=email, gender=gender, phone_number=phone_number, role_id=role_id, department_id=department_id)
         user.set_password(password)
         db.session.add(user)
         db.session.commit()
+        # The commit invalidated the booking page's doctor directory, rebuild it now
+        get_directory()
+        if image:
+            upload_profile_image(Doctor, user.id, image_data)
         flash('Doctor added successfully', 'success')
         return redirect(url_for('admin.view_doctors'))
     
     departments = Department.query.all()
-    admin = Admin.query.filter_by(id=current_user.id).first()
+    admin = current_user
     return render_template('admin/add-doctor.html', departments=departments, admin=admin)
 
 
@@ -159,10 +230,11 @@ def add_department():
         department = Department(name=department)
         db.session.add(department)
         db.session.commit()
+        get_directory()
         flash('Department added successfully', 'success')
         return redirect(url_for('admin.add_department'))
     
-    admin = Admin.query.filter_by(id=current_user.id).first()
+    admin = current_user
 
     return render_template('admin/add-department.html', admin=admin)
 
@@ -170,10 +242,13 @@ def add_department():
 @admin.route('/view-doctors')
 @login_required
 @admin_required
+@read_only
 def view_doctors():
-    doctors = Doctor.query.all()
-    admin = Admin.query.filter_by(id=current_user.id).first()
-    return render_template('admin/doctors.html', doctors=doctors, admin=admin)
+    doctors, filters = get_listing_page(Doctor.get_doctor_page, 'department', 'gender')
+    departments = Department.query.all()
+    admin = current_user
+    return render_template('admin/doctors.html', doctors=doctors, admin=admin, page=doctors, filters=filters,
+                           departments=departments, filter_fields=['department', 'gender'])
 
 
 @admin.route('/view-departments')
@@ -181,7 +256,7 @@ def view_doctors():
 @admin_required
 def view_departments():
     departments = Department.query.all()
-    admin = Admin.query.filter_by(id=current_user.id).first()
+    admin = current_user
     return render_template('admin/departments.html', departments=departments, admin=admin)
 
 
@@ -225,29 +300,24 @@ def add_patient():
             db.session.add(role)
             db.session.commit()
 
-        # Handle the file upload
+        # The picture is processed and uploaded in the background, the default image shows until it lands
         image = request.files['image']
         if image:
-            filename = secure_filename(image.filename)
-            # image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            # image_file = filename
-            blob_url = upload_file_to_azure(image, filename)
-            print(blob_url)
-            if blob_url:
-                image_file = blob_url
-            else:
-                flash('Failed to upload image', 'danger')
-                return redirect(url_for('add_doctor'))
-        else:
-            image_file = 'https://static-00.iconduck.com/assets.00/profile-default-icon-512x511-v4sw4m29.png'
+            try:
+                image_data = read_profile_image(image)
+            except ImageRejected as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('admin.add_patient'))
 
-        user = Patient(first_name=first_name, last_name=last_name, gender=gender, email=email, phone_number=phone_number, role_id=role_id, age=age, health_status=health_status, blood_group=blood_group, height=height, weight=weight, image_file=image_file)
+        user = Patient(first_name=first_name, last_name=last_name, gender=gender, email=email, phone_number=phone_number, role_id=role_id, age=age, health_status=health_status, blood_group=blood_group, height=height, weight=weight, image_file=DEFAULT_PROFILE_IMAGE)
         user.set_password(password)
         db.session.add(user)
         db.session.commit()
+        if image:
+            upload_profile_image(Patient, user.id, image_data)
         return redirect(url_for('admin.view_patients'))
 
-    admin = Admin.query.filter_by(id=current_user.id).first()
+    admin = current_user
 
     return render_template('admin/add-patient.html', admin=admin)
 
@@ -255,18 +325,117 @@ def add_patient():
 @admin.route('/view-patients')
 @login_required
 @admin_required
+@read_only
 def view_patients():
-    patients = Patient.query.all()
-    admin = Admin.query.filter_by(id=current_user.id).first()
-    # count = 1
-    return render_template('admin/patients.html', patients=patients, admin=admin)
+    if request.args.get('q'):
+        # Search replaces the listing, the best matches on a single page
+        patients = search_page('patients', Patient)
+        filters = {name: request.args[name] for name in ('q', *SEARCH_KINDS['patients'].filters) if request.args.get(name)}
+    else:
+        patients, filters = get_listing_page(Patient.get_patient_page, 'gender', 'blood_group')
+    admin = current_user
+    return render_template('admin/patients.html', patients=patients, admin=admin, page=patients, filters=filters,
+                           filter_fields=['q', 'gender', 'blood_group'])
 
 
 @admin.route('/view-appointments')
 @login_required
 @admin_required
+@read_only
 def view_appointments():
-    appointments = Appointment.query.all()
-    admin = Admin.query.filter_by(id=current_user.id).first()
-    return render_template('admin/appointment.html', appointments=appointments, admin=admin)
+    appointments, filters = get_listing_page(Appointment.get_appointment_page, *LISTING_FILTERS)
+    departments = Department.query.all()
+    admin = current_user
+    return render_template('admin/appointment.html', appointments=appointments, admin=admin, page=appointments, filters=filters,
+                           departments=departments, filter_fields=['date_from', 'date_to', 'department', 'gender', 'blood_group'])
+
 
+# ---------------------------------- Listing API ------------------------------------------- #
+
+@admin.route('/api/patients')
+@login_required
+@admin_required
+@read_only
+def api_patients():
+    patients, _ = get_listing_page(Patient.get_patient_page, 'gender', 'blood_group')
+    return jsonify(items=[patient_json(p) for p in patients], next_cursor=patients.next_cursor)
+
+
+@admin.route('/api/doctors')
+@login_required
+@admin_required
+@read_only
+def api_doctors():
+    doctors, _ = get_listing_page(Doctor.get_doctor_page, 'department', 'gender')
+    return jsonify(items=[doctor_json(d) for d in doctors], next_cursor=doctors.next_cursor)
+
+
+@admin.route('/api/appointments')
+@login_required
+@admin_required
+@read_only
+def api_appointments():
+    appointments, _ = get_listing_page(Appointment.get_appointment_page, *LISTING_FILTERS)
+    return jsonify(items=[appointment_json(a) for a in appointments], next_cursor=appointments.next_cursor)
+
+
+
+@admin.route('/api/import/<kind>', methods=['POST'])
+@login_required
+@admin_required
+def api_import(kind):
+    # Bulk import a CSV or JSONL upload, e.g. curl -F file=@patients.csv .../admin/api/import/patients.
+    # The upload is read row by row, rejected rows are listed in the response
+    upload = request.files.get('file')
+    if kind not in IMPORT_KINDS or upload is None:
+        abort(400)
+    file_format = request.form.get('format') or guess_format(upload.filename or '')
+    if file_format not in ('csv', 'jsonl'):
+        abort(400)
+    result = import_rows(kind, iter_rows(upload.stream, file_format))
+    return jsonify(result.to_dict())
+
+
+@admin.route('/api/export/<kind>')
+@login_required
+@admin_required
+def api_export(kind):
+    # Stream a full export, e.g. /admin/api/export/appointments?format=jsonl&date_from=2024-01-01&date_to=2024-01-31.
+    # Resume an interrupted download with after=<last id received>
+    file_format = request.args.get('format', 'csv')
+    if file_format not in STREAMABLE_FORMATS:
+        abort(400)
+    try:
+        date_from = LISTING_FILTERS['date_from'](request.args['date_from']) if request.args.get('date_from') else None
+        date_to = LISTING_FILTERS['date_to'](request.args['date_to']) if request.args.get('date_to') else None
+        statement = build_statement(kind, date_from, date_to, request.args.get('after'))
+    except ValueError:
+        abort(400)
+    filename = export_filename(kind, file_format, date_from, date_to)
+    return Response(stream_with_context(ENCODERS[file_format](stream_partitions(statement))), mimetype=FORMATS[file_format],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@admin.route('/api/analytics')
+@login_required
+@admin_required
+@read_only
+def api_analytics():
+    # Trends, department x weekday heatmap, utilization and demographics,
+    # e.g. /admin/api/analytics?date_from=2024-01-01&date_to=2024-06-30&period=month
+    period = request.args.get('period', 'week')
+    if period not in ('week', 'month'):
+        abort(400)
+    try:
+        date_from = LISTING_FILTERS['date_from'](request.args['date_from']) if request.args.get('date_from') else None
+        date_to = LISTING_FILTERS['date_to'](request.args['date_to']) if request.args.get('date_to') else None
+    except ValueError:
+        abort(400)
+    return jsonify(analytics_report(date_from, date_to, period, request.args.get('top', 20, type=int)))
+
+
+@admin.route('/api/cache-stats')
+@login_required
+@admin_required
+def api_cache_stats():
+    return jsonify(cache.stats())
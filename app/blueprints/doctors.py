@@ -1,11 +1,14 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, get_flashed_messages
 from flask_login import current_user, login_required, login_user, logout_user
-from ..model import db, Role, Doctor, Patient, Appointment, app
+from ..model import db, Role, Doctor, Patient, Appointment, Department
+from ..cache import forget_user
+from ..routing import read_only
 from functools import wraps
 import os
 from werkzeug.utils import secure_filename
 from uuid import UUID
-from sqlalchemy import func
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 
 
 doctor = Blueprint('doctor', __name__)
@@ -17,7 +20,7 @@ def doctor_required(f):
         if current_user.role_id != 2:  # Assuming 3 is the role_id for admins
             print(current_user.role_id)
             flash('You are not authorized to view this page', 'danger')
-            return redirect(url_for('unauthorized'))  # Redirect to a general page if user is not an admin
+            return redirect(url_for('patient.unauthorized'))  # Redirect to a general page if user is not an admin
         return f(*args, **kwargs)
     return decorated_function
 
@@ -38,6 +41,7 @@ def login():
         user = Doctor.query.filter_by(email=email).first()
         if user and user.check_password(password):
             login_user(user)
+            db.session.commit()
             flash('You have been logged in successfully', 'success')
             return redirect(url_for('doctor.doctor_dashboard'))
         else:
@@ -49,6 +53,7 @@ def login():
 @doctor.route('/logout')
 @login_required
 def logout():
+    forget_user(current_user)
     logout_user()
     flash('You have been logged out', 'info')
 
@@ -58,24 +63,24 @@ def logout():
 @doctor.route('/dashboard')
 @login_required
 @doctor_required
+@read_only
 def doctor_dashboard():
-    doctor_id = current_user.id
-    user = Doctor.query.get(doctor_id)
-    doctor_appointments = Appointment.query.filter_by(doctor_id=doctor_id).all()
-    patient_for_doctor = db.session.query(Appointment, Patient).join(Patient, Patient.id == Appointment.patient_id).filter(Appointment.doctor_id == doctor_id).all()
-    
-    # Query the database for the count of appointments per day
-    appointments_per_day = db.session.query(func.date(Appointment.date), func.count(Appointment.id)).filter_by(doctor_id=doctor_id).group_by(func.date(Appointment.date)).all()
+    dashboard = Doctor.get_dashboard(current_user.id)
+    user = current_user._get_current_object()
+    if dashboard['department']:
+        # The department came with the dashboard, attach it so the templates don't lazy load it
+        department = Department(**dashboard['department'])
+        make_transient_to_detached(department)
+        set_committed_value(user, 'department', db.session.merge(department, load=False))
 
-    # Convert the result to a dictionary
-    appointments_per_day_dict = {str(date): count for date, count in appointments_per_day}
-    
-    return render_template('landing/doctor-dashboard.html', doctor=user, appointments=doctor_appointments, total_patients=patient_for_doctor, appointments_per_day=appointments_per_day_dict)
+    return render_template('landing/doctor-dashboard.html', doctor=user, appointments=dashboard['upcoming'], total_patients=dashboard['patients'],
+                           appointments_per_day=dashboard['appointments_per_day'])
 
 
 @doctor.route('/view-appoinments')
 @login_required
 @doctor_required
+@read_only
 def view_appointments():
     doctor_id = current_user.id
     user = Doctor.query.get(doctor_id)
@@ -0,0 +1,263 @@
+from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify, abort, Response
+from flask_login import login_user, login_required, current_user, logout_user
+from ..model import Patient, Role, Appointment, db
+from ..storage import read_profile_image, upload_profile_image, DEFAULT_PROFILE_IMAGE
+from ..images import ImageRejected
+from ..cache import forget_user
+from ..scheduling import find_free_slots, is_bookable
+from ..search import search, SEARCH_KINDS
+from ..directory import get_directory
+from ..booking import book, SlotTaken, SLOT_ATTEMPTS
+from functools import wraps
+from uuid import UUID, uuid4
+from datetime import datetime
+
+
+patient = Blueprint('patient', __name__)
+
+
+def patient_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_user.role_id != 1:  # Assuming 3 is the role_id for admins
+            print(current_user.role_id)
+            flash('You are not authorized to view this page', 'danger')
+            return redirect(url_for('patient.unauthorized'))  # Redirect to a general page if user is not an admin
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+
+# ---------------------------- Patient Section ---------------------------- #
+
+@patient.route('/unauthorized')
+def unauthorized():
+    return render_template('landing/error.html')
+
+
+@patient.route('/')
+def home():
+    return render_template('landing/index-three.html')
+
+
+@patient.route('/dashboard')
+@login_required
+@patient_required
+def index():
+    patient_id = current_user.id
+    user = Patient.query.get(patient_id)
+    patient_appointments = Appointment.query.filter_by(patient_id=patient_id).all()
+    return render_template('landing/patient-dashboard.html', patient=user, appointments=patient_appointments)
+
+
+@patient.route('/register', methods=['GET', 'POST'])
+def register():
+    if request.method == 'POST':
+        first_name = request.form['first_name']
+        last_name = request.form['last_name']
+        email = request.form['email']
+        phone_number = request.form['phone_number']
+        password = request.form['password']
+        age = request.form['age']
+        health_status = request.form['health_status']
+        blood_group = request.form['blood_group']
+        height = request.form['height']
+        weight = request.form['weight']
+        gender = request.form['gender']
+        role_id = 1
+
+        # Check if role with id 1 exists
+        role = Role.query.get(role_id)
+        if not role:
+            # If not, create it
+            role = Role(id=role_id, name='Patient')
+            db.session.add(role)
+            db.session.commit()
+
+        # The picture is processed and uploaded in the background, the default image shows until it lands
+        image = request.files['image']
+        if image:
+            try:
+                image_data = read_profile_image(image)
+            except ImageRejected as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('patient.register'))
+
+        user = Patient(first_name=first_name, last_name=last_name, gender=gender, email=email, phone_number=phone_number, role_id=role_id, age=age, health_status=health_status, blood_group=blood_group, height=height, weight=weight, image_file=DEFAULT_PROFILE_IMAGE)
+        user.set_password(password)
+        db.session.add(user)
+        db.session.commit()
+        if image:
+            upload_profile_image(Patient, user.id, image_data)
+        flash('You have successfully registered', 'success')
+        login_user(user)
+        return redirect(url_for('patient.index'))
+    
+    return render_template('landing/signup.html')
+
+@patient.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        email = request.form['email']
+        password = request.form['password']
+        user = Patient.query.filter_by(email=email).first()
+        if user and user.check_password(password):
+            login_user(user)
+            db.session.commit()
+            return redirect(url_for('patient.index'))
+        else:
+            flash('Invalid username or password', 'danger')
+    return render_template('landing/login.html')
+
+
+@patient.route('/logout')
+@login_required
+@patient_required
+def logout():
+    forget_user(current_user)
+    logout_user()
+    return redirect(url_for('patient.login'))
+
+
+@patient.route('/profile')
+@login_required
+@patient_required
+def profile():
+    return render_template('profile.html')
+
+
+@patient.route('/update-profile', methods=['GET', 'POST'])
+@login_required
+@patient_required
+def update_profile():
+    if request.method == 'POST':
+        user = Patient.query.get(current_user.id)
+        user.first_name = request.form['first_name']
+        user.last_name = request.form['last_name']
+        user.email = request.form['email']
+        user.phone_number = request.form['phone_number']
+        user.bio = request.form['bio']
+        db.session.commit()
+        flash('Profile updated successfully', 'success')
+        return redirect(url_for('patient.profile'))
+    return render_template('update-profile.html')
+
+# def update_profile():
+#     form = UpdateProfileForm()
+#     if form.validate_on_submit():
+#         if form.picture.data:
+#             picture_file = save_picture(form.picture.data)
+#             current_user.image_file = picture_file
+#         current_user.bio = form.bio.data
+#         db.session.commit()
+#         flash('Your profile has been updated!')
+#         return redirect(url_for('profile'))
+#     elif request.method == 'GET':
+#         form.bio.data = current_user.bio
+#     image_file = url_for('static', filename='profile_pics/' + current_user.image_file)
+#     return render_template('update_profile.html', title='Update Profile', image_file=image_file, form=form)
+
+
+@patient.route('/book-appointment', methods=['GET', 'POST'])
+@login_required
+@patient_required
+def book_appointment():
+    if request.method == 'POST':
+
+        doctor_id = request.form['doctor']
+        if not doctor_id:
+            doctor_id = None
+        else:
+            doctor_id = UUID(doctor_id)
+
+        patient_id = current_user.id
+        appointment_type = request.form['appointment_type']
+        comments = request.form['comments']
+        # status = 'pending'
+        if not doctor_id:
+            flash('Please pick a doctor from the list', 'danger')
+            return redirect(url_for('patient.book_appointment'))
+        
+        if appointment_type == 'online':
+            try:
+                appointment_date = datetime.strptime(request.form['date'], '%Y-%m-%d').date()
+                appointment_time = datetime.strptime(request.form['time'], '%H:%M').time()
+            except ValueError:
+                appointment_date = appointment_time = None
+            # Same working hours and slot grid the free-slot search offers
+            if appointment_date is None or not is_bookable(doctor_id, appointment_date, appointment_time):
+                flash('The doctor does not see patients at that time, please pick one of the free slots', 'danger')
+                return redirect(url_for('patient.book_appointment'))
+            slots = [(appointment_date, appointment_time)]
+        else:
+            # Offline visits take the doctor's next free slot, or the one after if another
+            # patient gets there first
+            slots = [(slot_start.date(), slot_start.time()) for slot_start, _ in find_free_slots(doctor_id=doctor_id, limit=SLOT_ATTEMPTS)]
+            if not slots:
+                flash('The doctor has no free slot in the next two weeks', 'danger')
+                return redirect(url_for('patient.book_appointment'))
+
+        try:
+            # A resubmitted form (same idempotency key) gets the appointment it already made
+            book(patient_id, doctor_id, slots, comments, request.form.get('idempotency_key') or None)
+        except SlotTaken:
+            flash('That time is already booked for this doctor, please pick another slot', 'danger')
+            return redirect(url_for('patient.book_appointment'))
+        flash('Appointment booked successfully', 'success')
+        return redirect(url_for('patient.index'))
+
+    # Doctors are picked with the typeahead (/api/search/doctors), narrowed down by the
+    # department list of the cached directory. current_user is already the patient
+    return render_template('landing/booking-appointment.html', patient=current_user, directory=get_directory(), idempotency_key=uuid4().hex)
+
+
+@patient.route('/api/doctor-directory')
+@login_required
+def doctor_directory():
+    # Doctors grouped by department, or a single department with ?department=<id>
+    directory = get_directory()
+    payload = directory.payload(request.args.get('department', type=int))
+    if payload is None:
+        abort(404)
+    response = Response(payload, mimetype='application/json')
+    response.set_etag(directory.etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@patient.route('/api/free-slots')
+@login_required
+def free_slots():
+    # Next free slots for one doctor or a whole department, e.g. ?doctor=<id>&start=2024-05-01&limit=5
+    try:
+        doctor_id = UUID(request.args['doctor']) if request.args.get('doctor') else None
+        department_id = request.args.get('department', type=int)
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else datetime.utcnow()
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        abort(400)
+    if not doctor_id and not department_id:
+        abort(400)
+
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    slots = find_free_slots(doctor_id=doctor_id, department_id=department_id, start=max(start, datetime.utcnow()), end=end, limit=limit)
+    return jsonify(slots=[{'doctor_id': str(slot_doctor_id), 'date': slot_start.date().isoformat(), 'time': slot_start.strftime('%H:%M')} for slot_start, slot_doctor_id in slots])
+
+
+@patient.route('/api/search/<kind>')
+@login_required
+def api_search(kind):
+    # Typeahead, e.g. /api/search/doctors?q=smi&department=3. Everyone signed in can look up
+    # doctors, patient records are for admins only
+    if kind not in SEARCH_KINDS:
+        abort(404)
+    if kind == 'patients' and current_user.role_id != 3:
+        abort(403)
+    filters = {name: request.args[name] for name in SEARCH_KINDS[kind].filters if request.args.get(name)}
+    if 'department' in filters:
+        try:
+            filters['department'] = int(filters['department'])
+        except ValueError:
+            abort(400)
+    return jsonify(items=search(kind, request.args.get('q', ''), filters, request.args.get('limit', type=int)))
@@ -0,0 +1,103 @@
+from datetime import datetime
+import hashlib
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from .model import db, Appointment, BookingKey
+from .jobs import enqueue
+from . import scheduling
+
+
+# Booking under contention. The unique index on (doctor_id, date, time) is what finally
+# refuses a double booking. On Postgres a transaction-level advisory lock per slot comes
+# first, so of two requests racing for a slot the second gives up at once instead of
+# queueing behind the first only to hit the index. Booking forms carry an idempotency key:
+# a double-clicked or resubmitted form gets the appointment the first submission made
+
+# Next free slots tried, in order, for a booking that takes the doctor's next free slot
+SLOT_ATTEMPTS = 3
+
+
+class SlotTaken(Exception):
+    pass
+
+
+def lock_id(*parts):
+    # Signed 64-bit key for pg_advisory locks
+    digest = hashlib.blake2b(':'.join(map(str, parts)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def try_lock_slot(doctor_id, day, slot):
+    # Held until the transaction ends. Other databases have no advisory locks, SQLite only
+    # lets one writer in at a time anyway
+    if db.engine.dialect.name != 'postgresql':
+        return True
+    return db.session.execute(select(func.pg_try_advisory_xact_lock(lock_id('booking', doctor_id, day, slot)))).scalar()
+
+
+def previous_booking(patient_id, key):
+    return db.session.query(BookingKey.appointment_id).filter_by(patient_id=patient_id, key=key).scalar()
+
+
+def claim_key(patient_id, key):
+    # The key row goes in first: a concurrent submission of the same form waits on it until
+    # this transaction ends and then fails on the primary key. Returns the key row, holding
+    # the appointment a previous submission made, or none yet when this is the first one.
+    # Tried twice, the first claim can lose to a submission that then rolled back. A key
+    # still without an appointment after that counts as a taken slot
+    for _ in range(2):
+        claimed = BookingKey(patient_id=patient_id, key=key)
+        db.session.add(claimed)
+        try:
+            db.session.flush()
+            return claimed
+        except IntegrityError:
+            db.session.rollback()
+        previous = db.session.get(BookingKey, (patient_id, key))
+        if previous is not None and previous.appointment_id is not None:
+            return previous
+    raise SlotTaken()
+
+
+def book(patient_id, doctor_id, slots, comment=None, idempotency_key=None):
+    # Books the first free one of `slots`, (date, time) pairs. Returns (appointment_id,
+    # created), created is False when the idempotency key was already used. Raises
+    # SlotTaken when every slot was taken
+    if idempotency_key:
+        appointment_id = previous_booking(patient_id, idempotency_key)
+        if appointment_id is not None:
+            return appointment_id, False
+    # Slots already booked fail on a plain read, without waiting for any lock
+    slots = [(day, slot) for day, slot in slots if not scheduling.is_slot_taken(doctor_id, day, slot)]
+    # Ends the read transaction. On SQLite a connection that read and then writes while
+    # another one is writing gets "database is locked" instead of waiting its turn
+    db.session.commit()
+    if not slots:
+        raise SlotTaken()
+
+    key = None
+    if idempotency_key:
+        key = claim_key(patient_id, idempotency_key)
+        if key.appointment_id is not None:
+            return key.appointment_id, False
+    for day, slot in slots:
+        if not try_lock_slot(doctor_id, day, slot) or scheduling.is_slot_taken(doctor_id, day, slot):
+            continue
+        appointment = Appointment(doctor_id=doctor_id, patient_id=patient_id, date=day, time=slot, comment=comment)
+        try:
+            with db.session.begin_nested():
+                db.session.add(appointment)
+        except IntegrityError:
+            # Booked by a writer that takes no lock, or on SQLite by a transaction that
+            # committed after our check. The availability index learns about it
+            if scheduling.availability.loaded_at is not None:
+                scheduling.availability.add_booking(doctor_id, datetime.combine(day, slot))
+            continue
+        if key is not None:
+            key.appointment_id = appointment.id
+        # Sent by a worker, committed with the booking so it never goes out for a rolled back one
+        enqueue('booking_confirmation', {'appointment_id': appointment.id})
+        db.session.commit()
+        return appointment.id, True
+    db.session.rollback()
+    raise SlotTaken()
@@ -0,0 +1,288 @@
+from collections import OrderedDict
+from functools import wraps
+import pickle
+import threading
+import time
+from flask_login import UserMixin
+from sqlalchemy import event
+from . import routing
+
+
+# ---------------------------- Backends ---------------------------- #
+
+class LRUCache:
+    # In-process cache bounded by entry count, every entry expires after its TTL
+
+    def __init__(self, max_entries=1024, default_ttl=300):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.default_ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Counters live outside the LRU so they never expire or get evicted
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LocalStore:
+    # Stand-in for a shared key/value server (the subset of the redis-py client we use)
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._data.get(key, (0, None))[0]) + 1
+            self._data[key] = (value, None)
+            return value
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedCache:
+    # Cache shared between workers through a redis-like client, values are pickled
+    # and expiry is left to the server
+
+    def __init__(self, client, default_ttl=300, prefix='hms:'):
+        self.client = client
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return False, None
+        return True, pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.default_ttl)
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+# ---------------------------- Cache ---------------------------- #
+
+class Cache:
+    # Entries are tagged with the tables they were computed from. Each table has a version
+    # counter that is bumped after a commit touches it, which orphans every entry built
+    # on the old version without having to find and delete them
+
+    def __init__(self, backend=None):
+        self.backend = backend or LRUCache()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def make_key(self, name, tables, args):
+        versions = ','.join(f'{table}={self.backend.counter(f"version:{table}")}' for table in tables)
+        return f'{name}:{args!r}:{versions}'
+
+    def get_or_compute(self, name, tables, args, compute, ttl=None):
+        key = self.make_key(name, tables, args)
+        hit, value = self.backend.get(key)
+        if hit:
+            self.hits += 1
+            return value
+        self.misses += 1
+        if routing.replica_reads_active() and self.recently_invalidated(tables):
+            # A replica may not have the commit that bumped the version yet, and what it
+            # returns would be cached under the new version for the whole TTL
+            with routing.primary_reads():
+                value = compute()
+        else:
+            value = compute()
+        self.backend.set(key, value, ttl)
+        return value
+
+    def recently_invalidated(self, tables):
+        since = time.time() - routing.state.max_lag
+        for table in tables:
+            hit, invalidated_at = self.backend.get(f'invalidated_at:{table}')
+            if hit and invalidated_at > since:
+                return True
+        return False
+
+    def invalidate(self, *tables):
+        now = time.time()
+        for table in tables:
+            self.backend.incr(f'version:{table}')
+            self.backend.set(f'invalidated_at:{table}', now, routing.state.max_lag + 1)
+            self.invalidations += 1
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.backend.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self.backend) if isinstance(self.backend, LRUCache) else None,
+        }
+
+
+cache = Cache()
+
+# Column snapshots of recently authenticated users keyed by their session id, lets
+# load_user skip the database on most requests. Each snapshot carries the user's version
+# counter from the cache backend, so with the shared backend a logout or password change
+# in one worker stops every other worker serving its snapshot too
+identity_cache = LRUCache(max_entries=10000, default_ttl=60)
+
+
+def identity_version(user_id):
+    return cache.backend.counter(f'version:user:{user_id}')
+
+
+def forget_identity(user_id):
+    cache.backend.incr(f'version:user:{user_id}')
+    identity_cache.delete(user_id)
+
+
+def forget_user(user):
+    forget_identity(user.get_id())
+
+
+def cached(tables, ttl=None):
+    # Cache a model classmethod's result until its TTL expires or a commit touches one of `tables`.
+    # Apply it under @classmethod; the class itself is not part of the key
+    def decorator(f):
+        name = f.__qualname__
+
+        @wraps(f)
+        def decorated_function(cls, *args, **kwargs):
+            return cache.get_or_compute(name, tables, (args, sorted(kwargs.items())), lambda: f(cls, *args, **kwargs), ttl)
+        return decorated_function
+    return decorator
+
+
+# ---------------------------- Invalidation ---------------------------- #
+
+def after_flush(session, flush_context):
+    tables = session.info.setdefault('cache_dirty_tables', set())
+    users = session.info.setdefault('cache_dirty_users', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table:
+            tables.add(table)
+        # Finer grained tags, e.g. one doctor's dashboard, for models that define them
+        if hasattr(obj, 'cache_scopes'):
+            tables.update(obj.cache_scopes())
+        # Profile and password changes must not be served from the identity cache
+        if isinstance(obj, UserMixin) and obj not in session.new:
+            users.add(obj.get_id())
+
+
+def after_commit(session):
+    tables = session.info.pop('cache_dirty_tables', None)
+    if tables:
+        cache.invalidate(*tables)
+    for user_id in session.info.pop('cache_dirty_users', ()):
+        forget_identity(user_id)
+
+
+def after_rollback(session):
+    session.info.pop('cache_dirty_tables', None)
+    session.info.pop('cache_dirty_users', None)
+
+
+def init_app(app, db):
+    default_ttl = app.config.get('CACHE_DEFAULT_TTL', 300)
+    if app.config.get('CACHE_BACKEND', 'lru') == 'shared':
+        url = app.config.get('CACHE_REDIS_URL')
+        if url:
+            import redis
+            client = redis.Redis.from_url(url)
+        else:
+            client = LocalStore()
+        cache.backend = SharedCache(client, default_ttl=default_ttl)
+    else:
+        cache.backend = LRUCache(max_entries=app.config.get('CACHE_MAX_ENTRIES', 1024), default_ttl=default_ttl)
+
+    identity_cache.max_entries = app.config.get('IDENTITY_CACHE_MAX_ENTRIES', 10000)
+    identity_cache.default_ttl = app.config.get('IDENTITY_CACHE_TTL', 60)
+
+    # db.session is shared by every app, see rollups.init_app
+    if not event.contains(db.session, 'after_flush', after_flush):
+        event.listen(db.session, 'after_flush', after_flush)
+        event.listen(db.session, 'after_commit', after_commit)
+        event.listen(db.session, 'after_rollback', after_rollback)
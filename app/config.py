@@ -0,0 +1,123 @@
+import os
+from dotenv import load_dotenv
+
+
+AZURE_DATABASE_URI = 'postgresql://hospitalmanagement.postgres.database.azure.com:5432/hosmanage?user=hms&password={password}&sslmode=require'
+
+
+def _flag(name, default):
+    value = os.environ.get(name)
+    return default if value is None else value.lower() not in ('0', 'false', 'no', '')
+
+
+def database_uri():
+    # DATABASE_URL wins, then the Azure database when its password is set, otherwise a local
+    # SQLite file in the instance folder
+    if os.environ.get('DATABASE_URL'):
+        return os.environ['DATABASE_URL']
+    if os.environ.get('PGPASSWORD'):
+        return AZURE_DATABASE_URI.format(password=os.environ['PGPASSWORD'])
+    return 'sqlite:///hms.db'
+
+
+def engine_options(uri):
+    # SQLAlchemy's compiled statement cache, per engine
+    options = {'query_cache_size': int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 500))}
+    if uri.startswith('sqlite'):
+        # SQLite gets Flask-SQLAlchemy's default pool, the sizing options don't apply to it
+        return options
+    options.update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        # Azure drops idle connections, recycle before it does and check on checkout
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        pool_pre_ping=_flag('DB_POOL_PRE_PING', True),
+    )
+    return options
+
+
+def load_config(app, overrides=None):
+    load_dotenv()
+
+    app.config['SECRET_KEY'] = f'{os.environ.get("SECRET_KEY")}'
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'lru')
+    app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+    app.config['CACHE_DEFAULT_TTL'] = int(os.environ.get('CACHE_DEFAULT_TTL', 300))
+    app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+    # Logouts and password changes reach other workers' identity caches through the shared
+    # backend only; with 'lru' another worker may serve the old user for up to this long
+    app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 60))
+    app.config['IDENTITY_CACHE_MAX_ENTRIES'] = int(os.environ.get('IDENTITY_CACHE_MAX_ENTRIES', 10000))
+    app.config['AZURE_STORAGE_CONNECTION_STRING'] = os.environ.get('AZURE_STORAGE_CONNECTION_STRING_PREFIX', '') + os.environ.get('AZURE_STORAGE_CONNECTION_STRING_SUFFIX', '')
+    app.config['AZURE_CONTAINER_NAME'] = os.environ.get('AZURE_CONTAINER_NAME')
+    app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'azure' if app.config['AZURE_STORAGE_CONNECTION_STRING'] else 'local')
+    app.config['UPLOAD_WORKERS'] = int(os.environ.get('UPLOAD_WORKERS', 4))
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ['PASSWORD_HASH_WORKERS']) if os.environ.get('PASSWORD_HASH_WORKERS') else None
+    app.config['PASSWORD_HASH_QUEUE_DEPTH'] = int(os.environ['PASSWORD_HASH_QUEUE_DEPTH']) if os.environ.get('PASSWORD_HASH_QUEUE_DEPTH') else None
+    app.config['INSTRUMENTATION_ENABLED'] = os.environ.get('INSTRUMENTATION_ENABLED', '1') != '0'
+    app.config['SLOW_QUERY_THRESHOLD_MS'] = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 250))
+    app.config['SLOW_QUERY_PARAMS_SAMPLE_RATE'] = float(os.environ.get('SLOW_QUERY_PARAMS_SAMPLE_RATE', 0.1))
+    # /metrics only exists with a token, scrapers send it as a bearer token
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    # auto: trigram indexes on Postgres, an in-memory index elsewhere. Or force postgres / memory
+    app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')
+    # Compiled templates go to this folder, the system temp folder when unset, '' turns it off
+    app.config['JINJA_BYTECODE_CACHE_DIR'] = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+    app.config['FRAGMENT_CACHE_ENABLED'] = _flag('FRAGMENT_CACHE_ENABLED', True)
+    app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+    # Serve the hashed copies from `flask assets build` when static/dist/manifest.json exists
+    app.config['ASSETS_FINGERPRINT'] = _flag('ASSETS_FINGERPRINT', True)
+    # Flask-Mail, MAIL_SERVER/MAIL_PORT can point at `flask mail sink` locally
+    app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'localhost')
+    app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 25))
+    app.config['MAIL_USE_TLS'] = _flag('MAIL_USE_TLS', False)
+    app.config['MAIL_USE_SSL'] = _flag('MAIL_USE_SSL', False)
+    app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
+    app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
+    app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', 'YCT Medicals <no-reply@localhost>')
+    app.config['MAIL_SUPPRESS_SEND'] = _flag('MAIL_SUPPRESS_SEND', False)
+    # Sessions are reopened after this many messages, idle pooled ones are checked after this many seconds
+    app.config['MAIL_MAX_EMAILS'] = int(os.environ['MAIL_MAX_EMAILS']) if os.environ.get('MAIL_MAX_EMAILS') else None
+    app.config['SMTP_POOL_SIZE'] = int(os.environ.get('SMTP_POOL_SIZE', 4))
+    app.config['SMTP_POOL_IDLE_TIMEOUT'] = int(os.environ.get('SMTP_POOL_IDLE_TIMEOUT', 30))
+    # Background jobs: jobs claimed per round trip, seconds between polls when idle, seconds
+    # before a running job whose worker went quiet is run again, retry backoff in seconds
+    app.config['JOBS_BATCH_SIZE'] = int(os.environ.get('JOBS_BATCH_SIZE', 20))
+    app.config['JOBS_POLL_INTERVAL'] = float(os.environ.get('JOBS_POLL_INTERVAL', 1))
+    app.config['JOBS_LOCK_TIMEOUT'] = int(os.environ.get('JOBS_LOCK_TIMEOUT', 600))
+    app.config['JOBS_MAX_ATTEMPTS'] = int(os.environ.get('JOBS_MAX_ATTEMPTS', 5))
+    app.config['JOBS_BACKOFF_BASE'] = int(os.environ.get('JOBS_BACKOFF_BASE', 30))
+    app.config['JOBS_BACKOFF_MAX'] = int(os.environ.get('JOBS_BACKOFF_MAX', 3600))
+    # Reminders go out REMINDER_LEAD_TIME seconds ahead, checked every REMINDER_INTERVAL seconds
+    app.config['REMINDER_LEAD_TIME'] = int(os.environ.get('REMINDER_LEAD_TIME', 24 * 3600))
+    app.config['REMINDER_INTERVAL'] = int(os.environ.get('REMINDER_INTERVAL', 300))
+    app.config['REMINDER_BATCH_SIZE'] = int(os.environ.get('REMINDER_BATCH_SIZE', 500))
+    # Appointments older than ARCHIVE_AFTER_DAYS (longer than the doctor dashboard's year of
+    # history) move to appointment_archive, ARCHIVE_BATCH_SIZE rows per transaction, checked
+    # every ARCHIVE_INTERVAL seconds. 0 turns the job off
+    app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 400))
+    app.config['ARCHIVE_BATCH_SIZE'] = int(os.environ.get('ARCHIVE_BATCH_SIZE', 1000))
+    app.config['ARCHIVE_INTERVAL'] = int(os.environ.get('ARCHIVE_INTERVAL', 24 * 3600))
+    # Read replicas, comma separated URLs. Each becomes a 'replica_<n>' bind that @read_only
+    # views read from, see app/routing.py. Seconds of lag tolerated, seconds a user who just
+    # wrote stays on the primary, seconds between lag checks and between heartbeats (none
+    # without replicas)
+    replicas = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    app.config['SQLALCHEMY_BINDS'] = {f'replica_{i + 1}': {'url': url, **engine_options(url)} for i, url in enumerate(replicas)}
+    app.config['REPLICA_MAX_LAG'] = float(os.environ.get('REPLICA_MAX_LAG', 5))
+    app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+    app.config['REPLICA_LAG_CHECK_INTERVAL'] = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+    app.config['REPLICA_HEARTBEAT_INTERVAL'] = int(os.environ.get('REPLICA_HEARTBEAT_INTERVAL', 5 if replicas else 0))
+
+    # Values passed to create_app() win over the environment
+    app.config.update(overrides or {})
+
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(uri))
+    # Creating tables on boot is only done for local SQLite databases. Everywhere else the
+    # schema is managed with `flask migrations upgrade`, so booting a worker runs no DDL
+    app.config.setdefault('AUTO_CREATE_SCHEMA', _flag('AUTO_CREATE_SCHEMA', uri.startswith('sqlite')))
@@ -0,0 +1,55 @@
+from collections import namedtuple
+import hashlib
+import json
+from .model import db, Doctor, Department
+from .cache import cache
+from .images import avatar_url
+
+
+# Doctor directory for the booking page: every doctor grouped by department, with only the
+# id, name and thumbnail it shows. One query builds it and it stays cached until a commit
+# touches a doctor or a department, so the page costs the same however many doctors there
+# are. Tuples, not model instances, a few thousand doctors fit in a few hundred KB
+
+DIRECTORY_TTL = 3600
+NO_DEPARTMENT = 'Other'
+
+DirectoryDoctor = namedtuple('DirectoryDoctor', 'id name thumbnail')
+DirectoryDepartment = namedtuple('DirectoryDepartment', 'id name doctors')
+
+
+class Directory:
+    # The groups for templates, and the JSON for /api/doctor-directory serialized once,
+    # whole and per department
+    __slots__ = ('departments', 'payloads', 'etag')
+
+    def __init__(self, departments):
+        self.departments = departments
+        groups = {department.id: {'id': department.id, 'name': department.name,
+                                  'doctors': [doctor._asdict() for doctor in department.doctors]} for department in departments}
+        self.payloads = {id: json.dumps(group, separators=(',', ':')).encode() for id, group in groups.items()}
+        self.payloads['all'] = json.dumps({'departments': list(groups.values())}, separators=(',', ':')).encode()
+        self.etag = hashlib.blake2b(self.payloads['all'], digest_size=8).hexdigest()
+
+    def __len__(self):
+        return sum(len(department.doctors) for department in self.departments)
+
+    def payload(self, department_id=None):
+        return self.payloads.get('all' if department_id is None else department_id)
+
+
+def build_directory():
+    doctors = {}
+    for department_id, id, first_name, last_name, image_file in db.session.query(Doctor.department_id, Doctor.id, Doctor.first_name, Doctor.last_name, Doctor.image_file) \
+            .order_by(Doctor.last_name, Doctor.first_name, Doctor.id):
+        doctors.setdefault(department_id, []).append(DirectoryDoctor(str(id), f'{first_name} {last_name}', avatar_url(image_file, 'sm')))
+    departments = [DirectoryDepartment(id, name, tuple(doctors.pop(id, ()))) for id, name in db.session.query(Department.id, Department.name).order_by(Department.name)]
+    # Doctors without a department, or with one that no longer exists, last
+    others = [doctor for group in doctors.values() for doctor in group]
+    if others:
+        departments.append(DirectoryDepartment(None, NO_DEPARTMENT, tuple(sorted(others, key=lambda doctor: doctor.name))))
+    return Directory(departments)
+
+
+def get_directory():
+    return cache.get_or_compute('directory', ['doctor', 'department'], (), build_directory, DIRECTORY_TTL)
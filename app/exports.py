@@ -0,0 +1,200 @@
+import csv
+import io
+import json
+import sys
+from collections import namedtuple
+from datetime import date, time
+from uuid import UUID
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, tuple_
+from .model import db, Appointment, Patient, Doctor, Department
+
+
+# Rows are fetched in partitions of this size through a server-side cursor on Postgres
+# (plain fetchmany elsewhere), so memory use doesn't depend on the table size
+YIELD_PER = 2000
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+# Parquet files can't be streamed over HTTP, their footer is written last
+STREAMABLE_FORMATS = ('csv', 'jsonl')
+
+
+class ExportError(ValueError):
+    pass
+
+
+def appointment_export(date_from=None, date_to=None, after=None):
+    # Ordered by (date, time, id) to walk the listing index. `after` is the last
+    # appointment_id already received, an interrupted export resumes right after it.
+    # Archived appointments are included when the date range reaches back to them
+    appointments = Appointment.between(date_from, date_to)
+    statement = (
+        select(
+            appointments.id.label('appointment_id'), appointments.date, appointments.time,
+            Patient.id.label('patient_id'), Patient.first_name.label('patient_first_name'), Patient.last_name.label('patient_last_name'),
+            Patient.email.label('patient_email'), Patient.gender.label('patient_gender'), Patient.age.label('patient_age'),
+            Patient.blood_group.label('patient_blood_group'),
+            Doctor.id.label('doctor_id'), Doctor.first_name.label('doctor_first_name'), Doctor.last_name.label('doctor_last_name'),
+            Department.id.label('department_id'), Department.name.label('department_name'),
+            appointments.comment,
+        )
+        .select_from(appointments)
+        .outerjoin(Patient, Patient.id == appointments.patient_id)
+        .outerjoin(Doctor, Doctor.id == appointments.doctor_id)
+        .outerjoin(Department, Department.id == Doctor.department_id)
+        .order_by(appointments.date, appointments.time, appointments.id)
+    )
+    if date_from:
+        statement = statement.where(appointments.date >= date_from)
+    if date_to:
+        statement = statement.where(appointments.date <= date_to)
+    if after is not None:
+        last = db.session.query(appointments.date, appointments.time).filter(appointments.id == after).first()
+        if last is None:
+            raise ExportError(f'Appointment {after} does not exist, cannot resume after it')
+        statement = statement.where(tuple_(appointments.date, appointments.time, appointments.id) > tuple_(last.date, last.time, after))
+    return statement
+
+
+def patient_export(date_from=None, date_to=None, after=None):
+    # Patients have no date, the whole table is exported in id order. `after` is the last
+    # patient id already received
+    if date_from or date_to:
+        raise ExportError('Patient exports do not take a date range')
+    statement = select(
+        Patient.id, Patient.first_name, Patient.last_name, Patient.email, Patient.phone_number, Patient.gender,
+        Patient.age, Patient.blood_group, Patient.health_status, Patient.height, Patient.weight,
+    ).order_by(Patient.id)
+    if after is not None:
+        statement = statement.where(Patient.id > after)
+    return statement
+
+
+Export = namedtuple('Export', 'build after_type')
+EXPORTS = {
+    'appointments': Export(appointment_export, int),
+    'patients': Export(patient_export, UUID),
+}
+
+
+def build_statement(kind, date_from=None, date_to=None, after=None):
+    if kind not in EXPORTS:
+        raise ExportError(f'Unknown export {kind!r}')
+    export = EXPORTS[kind]
+    try:
+        after = export.after_type(after) if after else None
+    except ValueError:
+        raise ExportError(f'Invalid resume position {after!r}')
+    return export.build(date_from, date_to, after)
+
+
+def stream_partitions(statement):
+    # Yields (column names, list of rows) per partition
+    result = db.session.execute(statement.execution_options(yield_per=YIELD_PER))
+    columns = list(result.keys())
+    for partition in result.partitions():
+        yield columns, partition
+
+
+# ---------------------------- Encoders ---------------------------- #
+
+def _plain(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    return value
+
+
+def encode_csv(partitions):
+    # Yields text chunks, one per partition, the header before the first one
+    header_written = False
+    for columns, rows in partitions:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not header_written:
+            writer.writerow(columns)
+            header_written = True
+        writer.writerows([[_plain(value) for value in row] for row in rows])
+        yield buffer.getvalue()
+
+
+def encode_jsonl(partitions):
+    for columns, rows in partitions:
+        yield ''.join(json.dumps(dict(zip(columns, map(_plain, row)))) + '\n' for row in rows)
+
+
+ENCODERS = {'csv': encode_csv, 'jsonl': encode_jsonl}
+
+
+def write_parquet(statement, path):
+    # One row group per partition. pyarrow is only needed for this format
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError('Parquet exports need pyarrow, pip install pyarrow')
+
+    # The schema comes from the column types, not from the data, where an all-null column has no type
+    arrow_types = {int: pa.int64(), float: pa.float64(), str: pa.string(), date: pa.date32(), time: pa.time64('us'), UUID: pa.string()}
+    schema = pa.schema([(column.name, arrow_types[column.type.python_type]) for column in statement.selected_columns])
+    rows_written = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for columns, rows in stream_partitions(statement):
+            data = {column: [str(value) if isinstance(value, UUID) else value for value in values] for column, values in zip(columns, zip(*rows))}
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+            rows_written += len(rows)
+    return rows_written
+
+
+def export_filename(kind, file_format, date_from=None, date_to=None):
+    span = f'-{date_from or "start"}-to-{date_to or "end"}' if date_from or date_to else ''
+    return f'{kind}{span}.{file_format}'
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('export', cls=AppGroup, help='Stream appointments or patient records to a file.')
+def export_cli():
+    pass
+
+
+def _export_command(kind):
+    @export_cli.command(kind, help=f'Export {kind}, to standard output unless --output is given.')
+    @click.option('--format', 'file_format', type=click.Choice(list(FORMATS)), default='csv', show_default=True)
+    @click.option('--output', type=click.Path(dir_okay=False), help='File to write, required for parquet.')
+    @click.option('--from', 'date_from', type=click.DateTime(['%Y-%m-%d']), help='First day to include (appointments).')
+    @click.option('--to', 'date_to', type=click.DateTime(['%Y-%m-%d']), help='Last day to include (appointments).')
+    @click.option('--after', help='Resume after this id, the last one of an interrupted export.')
+    def command(file_format, output, date_from, date_to, after):
+        try:
+            statement = build_statement(kind, date_from and date_from.date(), date_to and date_to.date(), after)
+            if file_format == 'parquet':
+                if not output:
+                    raise ExportError('Parquet exports need --output')
+                count = write_parquet(statement, output)
+                click.echo(f'Wrote {count} rows to {output}', err=True)
+                return
+        except ExportError as e:
+            raise click.ClickException(str(e))
+
+        out = open(output, 'w', newline='') if output else sys.stdout
+        try:
+            for chunk in ENCODERS[file_format](stream_partitions(statement)):
+                out.write(chunk)
+        finally:
+            if output:
+                out.close()
+    return command
+
+
+for _kind in EXPORTS:
+    _export_command(_kind)
+
+
+def init_app(app):
+    app.cli.add_command(export_cli)
@@ -0,0 +1,124 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import partial
+import os
+import threading
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from .instrumentation import external_call
+
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+
+class HashingBusy(Exception):
+    # Raised instead of queueing when too many hashes are already in flight
+    pass
+
+
+class PasswordHasher:
+    # Runs the CPU-bound password hashing in a bounded process pool so a burst of logins
+    # can't starve the request threads. With workers=0 hashing runs inline
+
+    def __init__(self, workers=None, queue_depth=None, timeout=10):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.queue_depth = queue_depth or max(self.workers, 1) * 4
+        self.timeout = timeout
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(self.queue_depth)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Create the pool lazily, and again after a fork so every worker process owns its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, fn, *args):
+        with external_call('password_hash'):
+            if not self.workers:
+                return fn(*args)
+            if not self._slots.acquire(blocking=False):
+                self.rejected += 1
+                raise HashingBusy()
+            try:
+                future = self._get_executor().submit(fn, *args)
+            except Exception:
+                self._slots.release()
+                raise
+            # The slot is held until the hash is done, not until we stop waiting for it, so a
+            # timed out hash still counts against the queue depth while it runs on
+            future.add_done_callback(lambda future: self._slots.release())
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise HashingBusy()
+
+    def hash(self, password, method=DEFAULT_METHOD, salt_length=16):
+        return self._run(generate_password_hash, password, method, salt_length)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def hash_many(self, passwords, method=DEFAULT_METHOD, salt_length=16):
+        # Bulk imports: spread a whole batch over the pool. Not counted against the queue
+        # depth, which protects interactive logins
+        hash_one = partial(generate_password_hash, method=method, salt_length=salt_length)
+        with external_call('password_hash'):
+            if not self.workers:
+                return [hash_one(password) for password in passwords]
+            chunksize = max(1, len(passwords) // (self.workers * 4))
+            return list(self._get_executor().map(hash_one, passwords, chunksize=chunksize))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hasher = PasswordHasher(workers=0)
+_normalized_methods = {}
+
+
+def current_method():
+    return current_app.config.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD)
+
+
+def normalized_method(method):
+    # werkzeug stores the full parameters (e.g. "pbkdf2:sha256:600000") even when the
+    # configured method leaves some out, hash once to learn the stored form
+    if method not in _normalized_methods:
+        _normalized_methods[method] = generate_password_hash('', method, 1).split('$', 1)[0]
+    return _normalized_methods[method]
+
+
+def hash_password(password):
+    return hasher.hash(password, current_method(), current_app.config.get('PASSWORD_SALT_LENGTH', 16))
+
+
+def hash_passwords(passwords):
+    return hasher.hash_many(passwords, current_method(), current_app.config.get('PASSWORD_SALT_LENGTH', 16))
+
+
+def verify_password(password_hash, password):
+    return hasher.verify(password_hash, password)
+
+
+def needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != normalized_method(current_method())
+
+
+def init_app(app):
+    global hasher
+    hasher.shutdown()
+    hasher = PasswordHasher(workers=app.config.get('PASSWORD_HASH_WORKERS'),
+                            queue_depth=app.config.get('PASSWORD_HASH_QUEUE_DEPTH'),
+                            timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 10))
+
+    @app.errorhandler(HashingBusy)
+    def hashing_busy(e):
+        return 'The server is busy, please try again in a moment.', 503, {'Retry-After': '1'}
@@ -0,0 +1,97 @@
+from io import BytesIO
+import hashlib
+
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MAX_PIXELS = 24_000_000
+ALLOWED_FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+
+# Square variants, sized for 2x displays: sm for the 36-45px list avatars,
+# md for the 65-80px profile avatars and lg for cards and profile pages
+VARIANT_SIZES = {'sm': 96, 'md': 160, 'lg': 400}
+VARIANT_FORMAT = 'WEBP'
+VARIANT_EXTENSION = 'webp'
+VARIANT_CONTENT_TYPE = 'image/webp'
+VARIANT_QUALITY = 80
+
+
+class ImageRejected(ValueError):
+    pass
+
+
+def _pillow():
+    # Pillow is only needed when an image is uploaded, keep it out of the boot path
+    from PIL import Image
+    # Let Pillow refuse anything bigger than we would accept ourselves
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    return Image
+
+
+def read_upload(stream, max_bytes=MAX_UPLOAD_BYTES):
+    # Never read more than one byte past the limit, however large the upload is
+    data = stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise ImageRejected(f'Images must be smaller than {max_bytes // (1024 * 1024)} MB')
+    return data
+
+
+def inspect_image(data):
+    # Only the header is parsed here, so a decompression bomb is rejected before a single
+    # pixel is decoded
+    Image = _pillow()
+    from PIL import UnidentifiedImageError
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image_format, (width, height) = image.format, image.size
+    except Image.DecompressionBombError:
+        raise ImageRejected('The image dimensions are too large')
+    except (UnidentifiedImageError, OSError):
+        raise ImageRejected('The uploaded file is not a supported image')
+    if image_format not in ALLOWED_FORMATS:
+        raise ImageRejected('Images must be JPEG, PNG, WebP or GIF')
+    if width * height > MAX_PIXELS:
+        raise ImageRejected('The image dimensions are too large')
+    return image_format, (width, height)
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def variant_name(digest, label):
+    return f'avatars/{digest}-{label}.{VARIANT_EXTENSION}'
+
+
+def render_variants(data, sizes=VARIANT_SIZES):
+    # Decode once and produce every square variant. Metadata (EXIF, ICC, comments) is
+    # dropped because the variants are saved without it
+    Image = _pillow()
+    from PIL import ImageOps
+    largest = max(sizes.values())
+    with Image.open(BytesIO(data)) as image:
+        # JPEGs are decoded straight at a reduced scale, bounding memory for huge photos
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+        variants = {}
+        for label, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            output = BytesIO()
+            variant.save(output, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+            variants[label] = output.getvalue()
+    return variants
+
+
+def avatar_url(url, label='sm'):
+    # Template filter: swap a stored variant URL for another size, other URLs pass through
+    if not url:
+        return url
+    suffix = f'-lg.{VARIANT_EXTENSION}'
+    if url.endswith(suffix) and '/avatars/' in url:
+        return url[:-len(suffix)] + f'-{label}.{VARIANT_EXTENSION}'
+    return url
+
+
+def init_app(app):
+    app.add_template_filter(avatar_url, 'avatar')
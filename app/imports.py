@@ -0,0 +1,272 @@
+import csv
+import io
+import json
+import re
+import uuid
+from collections import namedtuple
+import click
+from flask.cli import AppGroup
+from sqlalchemy import insert, select
+from .model import db, Role, Department, Doctor, Patient
+from .hashing import hash_passwords
+from .storage import DEFAULT_PROFILE_IMAGE
+from .cache import cache
+from . import rollups, scheduling, search
+
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+GENDERS = {'male': 'Male', 'female': 'Female'}
+BLOOD_GROUPS = {'A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-'}
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+# Rows imported without a password can't log in until one is set, and skip the slow hashing
+UNUSABLE_PASSWORD = '!'
+
+
+class RowError(ValueError):
+    pass
+
+
+# ---------------------------- Reading ---------------------------- #
+
+def iter_rows(stream, file_format):
+    # Yield (line number, dict) one row at a time, the file is never held in memory
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='') if isinstance(stream.read(0), bytes) else stream
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    elif file_format == 'jsonl':
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            # Malformed lines are reported by the validation step like any other bad row
+            yield line_number, row if isinstance(row, dict) else {'__invalid__': 'Line is not a JSON object'}
+    else:
+        raise ValueError(f'Unsupported format {file_format!r}, use csv or jsonl')
+
+
+def guess_format(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+# ---------------------------- Validation ---------------------------- #
+
+def _text(row, name, max_length, required=True):
+    value = row.get(name)
+    value = str(value).strip() if value is not None else ''
+    if not value:
+        if required:
+            raise RowError(f'{name} is required')
+        return None
+    if len(value) > max_length:
+        raise RowError(f'{name} is longer than {max_length} characters')
+    return value
+
+
+def _number(row, name, cast, low, high):
+    try:
+        value = cast(str(row.get(name)).strip())
+    except (TypeError, ValueError):
+        raise RowError(f'{name} must be a number')
+    if not low <= value <= high:
+        raise RowError(f'{name} must be between {low} and {high}')
+    return value
+
+
+def _person(row):
+    if '__invalid__' in row:
+        raise RowError(row['__invalid__'])
+    email = _text(row, 'email', 100)
+    if not EMAIL_PATTERN.match(email):
+        raise RowError('email is not a valid address')
+    gender = GENDERS.get((_text(row, 'gender', 10)).lower())
+    if gender is None:
+        raise RowError('gender must be Male or Female')
+    return {
+        'first_name': _text(row, 'first_name', 50),
+        'last_name': _text(row, 'last_name', 50),
+        'email': email,
+        'phone_number': _text(row, 'phone_number', 20),
+        'gender': gender,
+        'bio': _text(row, 'bio', 10000, required=False),
+        'password': _text(row, 'password', 1000, required=False),
+    }
+
+
+def validate_patient(row, departments):
+    person = _person(row)
+    blood_group = _text(row, 'blood_group', 3).upper()
+    if blood_group not in BLOOD_GROUPS:
+        raise RowError('blood_group is not a valid blood group')
+    person.update(
+        age=_number(row, 'age', int, 0, 150),
+        health_status=_text(row, 'health_status', 50),
+        blood_group=blood_group,
+        height=_number(row, 'height', float, 0, 300),
+        weight=_number(row, 'weight', float, 0, 1000),
+    )
+    return person
+
+
+def validate_doctor(row, departments):
+    person = _person(row)
+    department = _text(row, 'department', 100)
+    department_id = departments.get(department.lower())
+    if department_id is None:
+        raise RowError(f'department {department!r} does not exist')
+    person['department_id'] = department_id
+    return person
+
+
+ImportKind = namedtuple('ImportKind', 'model role_id role_name validate')
+IMPORT_KINDS = {
+    'patients': ImportKind(Patient, 1, 'Patient', validate_patient),
+    'doctors': ImportKind(Doctor, 2, 'Doctor', validate_doctor),
+}
+
+
+# ---------------------------- Import ---------------------------- #
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, email, message, report=None):
+        self.failed += 1
+        if report is not None:
+            report.writerow([line, email or '', message])
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'email': email, 'error': message})
+
+    def to_dict(self):
+        return {'imported': self.imported, 'failed': self.failed, 'errors': self.errors}
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def department_lookup():
+    # Doctors may name their department by id or by name
+    lookup = {}
+    for id, name in db.session.query(Department.id, Department.name):
+        lookup[str(id)] = id
+        lookup[name.strip().lower()] = id
+    return lookup
+
+
+def import_rows(kind, rows, batch_size=DEFAULT_BATCH_SIZE, report=None, echo=None):
+    # rows: iterable of (line number, dict). Every batch is validated, checked against the
+    # existing emails with one IN query on the unique email index, hashed across the
+    # hashing pool and inserted with one multi-row INSERT, then committed. Rejected rows go
+    # to `report`, a csv.writer, when given
+    spec = IMPORT_KINDS[kind]
+    table = spec.model.__table__
+    result = ImportResult()
+    if report is not None:
+        report.writerow(['line', 'email', 'error'])
+
+    if db.session.get(Role, spec.role_id) is None:
+        db.session.add(Role(id=spec.role_id, name=spec.role_name))
+        db.session.commit()
+    departments = department_lookup() if kind == 'doctors' else None
+    seen_emails = set()
+
+    for batch in _batches(rows, batch_size):
+        valid = []
+        for line, row in batch:
+            try:
+                values = spec.validate(row, departments)
+            except RowError as e:
+                result.error(line, row.get('email'), str(e), report)
+                continue
+            if values['email'] in seen_emails:
+                result.error(line, values['email'], 'email appears earlier in the file', report)
+                continue
+            seen_emails.add(values['email'])
+            valid.append((line, values))
+
+        existing = set(db.session.scalars(select(spec.model.email).where(spec.model.email.in_([values['email'] for _, values in valid])))) if valid else set()
+        for line, values in valid:
+            if values['email'] in existing:
+                result.error(line, values['email'], 'email is already registered', report)
+        valid = [(line, values) for line, values in valid if values['email'] not in existing]
+        if not valid:
+            continue
+
+        with_password = [values for _, values in valid if values['password']]
+        for values, password_hash in zip(with_password, hash_passwords([values['password'] for values in with_password])):
+            values['password_hash'] = password_hash
+        inserted = []
+        for _, values in valid:
+            password = values.pop('password')
+            if not password:
+                values['password_hash'] = UNUSABLE_PASSWORD
+            inserted.append(dict(values, id=uuid.uuid4(), role_id=spec.role_id, image_file=DEFAULT_PROFILE_IMAGE))
+
+        db.session.execute(insert(table), inserted)
+        # Core inserts skip the session events, keep the rollups and caches in step by hand
+        rollups.adjust_count(db.session.connection(), table.name, len(inserted))
+        db.session.commit()
+        cache.invalidate(table.name)
+        result.imported += len(inserted)
+        if echo:
+            echo(f'{result.imported} imported, {result.failed} rejected')
+
+    if result.imported:
+        search.invalidate(kind)
+    if kind == 'doctors' and result.imported:
+        # New doctors join the availability index on its next load
+        scheduling.availability.loaded_at = None
+    return result
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('import', cls=AppGroup, help='Bulk import records from CSV or JSONL files.')
+def import_cli():
+    pass
+
+
+def _import_command(kind):
+    @import_cli.command(kind, help=f'Import {kind} from a CSV (with a header row) or JSONL file.')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+    @click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+    @click.option('--errors', 'errors_path', type=click.Path(dir_okay=False), help='Write rejected rows to this CSV file.')
+    def command(path, file_format, batch_size, errors_path):
+        report_file = open(errors_path, 'w', newline='') if errors_path else None
+        try:
+            with open(path, 'rb') as f:
+                rows = iter_rows(f, file_format or guess_format(path))
+                result = import_rows(kind, rows, batch_size, csv.writer(report_file) if report_file else None, echo=click.echo)
+        finally:
+            if report_file:
+                report_file.close()
+        click.echo(f'Imported {result.imported} {kind}, rejected {result.failed}')
+        if result.failed and not errors_path:
+            for error in result.errors[:20]:
+                click.echo(f'  line {error["line"]}: {error["error"]}')
+    return command
+
+
+for _kind in IMPORT_KINDS:
+    _import_command(_kind)
+
+
+def init_app(app):
+    app.cli.add_command(import_cli)
@@ -0,0 +1,280 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import hmac
+import logging
+import random
+import threading
+import time
+from flask import g, request, current_app, has_request_context, abort, Response, request_started, request_finished, before_render_template, template_rendered
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 500)
+
+
+# ---------------------------- Metric types ---------------------------- #
+# Just enough of the Prometheus data model for our needs. Values are per process, every
+# worker serves its own /metrics and Prometheus sums them per instance
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][i] += 1
+            series[1] += value
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            values = sorted((label_values, (list(counts), total)) for label_values, (counts, total) in self._values.items())
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(self.labels, label_values, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # Callables returning (name, type, help, value) for values kept elsewhere (cache stats...)
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        for collector in self.collectors:
+            for name, kind, help, value in collector():
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}', f'{name} {_format_value(value)}']
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+request_duration = registry.histogram('http_request_duration_seconds', 'Time spent handling a request.', ['endpoint', 'method'])
+requests_total = registry.counter('http_requests_total', 'Requests handled, by response status.', ['endpoint', 'method', 'status'])
+request_queries = registry.histogram('http_request_queries', 'SQL statements issued per request.', ['endpoint'], QUERY_COUNT_BUCKETS)
+request_db_time = registry.histogram('http_request_db_seconds', 'Time spent in SQL statements per request.', ['endpoint'])
+request_render_time = registry.histogram('http_request_render_seconds', 'Time spent rendering templates per request, lazy loads included.', ['endpoint'])
+request_external_time = registry.histogram('http_request_external_seconds', 'Time spent waiting on external services per request.', ['endpoint'])
+query_duration = registry.histogram('db_query_duration_seconds', 'Duration of every SQL statement, in or out of a request.')
+slow_queries = registry.counter('db_slow_queries_total', 'SQL statements slower than SLOW_QUERY_THRESHOLD_MS.')
+external_duration = registry.histogram('external_call_duration_seconds', 'Duration of calls to external services.', ['service'])
+
+
+# ---------------------------- Per-request timings ---------------------------- #
+
+class RequestStats:
+    __slots__ = ('started', 'queries', 'db_time', 'render_time', 'render_started', 'external_time')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = self.render_time = self.external_time = 0.0
+        self.render_started = None
+
+
+def current_stats():
+    return g.get('_request_stats') if has_request_context() else None
+
+
+@contextmanager
+def external_call(service):
+    # Time a call to an outside service (blob storage, password hashing pool, SMTP...)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        external_duration.observe(elapsed, service)
+        stats = current_stats()
+        if stats is not None:
+            stats.external_time += elapsed
+
+
+def on_request_started(sender, **extra):
+    g._request_stats = RequestStats()
+
+
+def on_request_finished(sender, response, **extra):
+    stats = current_stats()
+    if stats is None:
+        return
+    elapsed = time.perf_counter() - stats.started
+    # Unmatched URLs share one label so 404 scans can't blow up the series count
+    endpoint = request.endpoint or 'unmatched'
+    request_duration.observe(elapsed, endpoint, request.method)
+    requests_total.inc(endpoint, request.method, str(response.status_code))
+    request_queries.observe(stats.queries, endpoint)
+    request_db_time.observe(stats.db_time, endpoint)
+    request_render_time.observe(stats.render_time, endpoint)
+    request_external_time.observe(stats.external_time, endpoint)
+    response.headers['Server-Timing'] = (f'db;desc="{stats.queries} queries";dur={stats.db_time * 1000:.1f}, '
+                                         f'render;dur={stats.render_time * 1000:.1f}, ext;dur={stats.external_time * 1000:.1f}, '
+                                         f'total;dur={elapsed * 1000:.1f}')
+
+
+def on_before_render_template(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.render_started = time.perf_counter()
+
+
+def on_template_rendered(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.render_started is not None:
+        stats.render_time += time.perf_counter() - stats.render_started
+        stats.render_started = None
+
+
+# ---------------------------- SQL timings ---------------------------- #
+
+class QueryTimer:
+    # Engine listeners timing every statement; the slow ones are logged, a sample of them
+    # with their bind parameters (which may hold personal data, hence the sampling)
+
+    def __init__(self, slow_threshold, params_sample_rate):
+        self.slow_threshold = slow_threshold
+        self.params_sample_rate = params_sample_rate
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        query_duration.observe(elapsed)
+        stats = current_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+        if elapsed >= self.slow_threshold:
+            self.log_slow_query(elapsed, statement, parameters)
+
+    def handle_error(self, context):
+        # The statement failed, drop its start time so the stack stays balanced
+        started = context.connection.info.get('query_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    def log_slow_query(self, elapsed, statement, parameters):
+        slow_queries.inc()
+        endpoint = request.endpoint if has_request_context() else None
+        statement = ' '.join(statement.split())[:2000]
+        if random.random() < self.params_sample_rate:
+            logger.warning('Slow query (%.1f ms, endpoint %s): %s; parameters: %.500r', elapsed * 1000, endpoint, statement, parameters)
+        else:
+            logger.warning('Slow query (%.1f ms, endpoint %s): %s', elapsed * 1000, endpoint, statement)
+
+    def listen(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(engine, 'handle_error', self.handle_error)
+
+
+def metrics():
+    # Route names, latencies and query counts are nobody else's business: without a
+    # METRICS_TOKEN there is no /metrics at all
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def register_collectors():
+    from .cache import cache, identity_cache
+    from . import hashing, storage, routing
+
+    def collect():
+        stats = cache.stats()
+        yield 'cache_hits_total', 'counter', 'Query cache hits.', stats['hits']
+        yield 'cache_misses_total', 'counter', 'Query cache misses.', stats['misses']
+        yield 'cache_evictions_total', 'counter', 'Query cache evictions.', stats['evictions']
+        yield 'cache_invalidations_total', 'counter', 'Query cache table invalidations.', stats['invalidations']
+        yield 'identity_cache_entries', 'gauge', 'Users in the identity cache.', len(identity_cache)
+        yield 'password_hash_rejected_total', 'counter', 'Logins shed because the hashing pool was full.', hashing.hasher.rejected
+        yield 'upload_completed_total', 'counter', 'Background uploads completed.', storage.upload_queue.completed
+        yield 'upload_failed_total', 'counter', 'Background uploads failed.', storage.upload_queue.failed
+        yield 'replica_reads_total', 'counter', 'Statements sent to read replicas.', sum(routing.state.reads.values())
+        lags = [lag for lag in routing.state.lag.values() if lag is not None]
+        if lags:
+            yield 'replica_lag_seconds', 'gauge', 'Lag of the furthest behind replica at the last check.', max(lags)
+
+    registry.collectors.append(collect)
+
+
+def init_app(app, db):
+    if not app.config.get('INSTRUMENTATION_ENABLED', True):
+        return
+    with app.app_context():
+        timer = QueryTimer(app.config.get('SLOW_QUERY_THRESHOLD_MS', 250) / 1000, app.config.get('SLOW_QUERY_PARAMS_SAMPLE_RATE', 0.1))
+        # The primary and every replica bind
+        for engine in db.engines.values():
+            timer.listen(engine)
+
+    request_started.connect(on_request_started, app)
+    request_finished.connect(on_request_finished, app)
+    before_render_template.connect(on_before_render_template, app)
+    template_rendered.connect(on_template_rendered, app)
+
+    if not registry.collectors:
+        register_collectors()
+    app.add_url_rule('/metrics', 'metrics', metrics)
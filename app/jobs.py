@@ -0,0 +1,215 @@
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+import uuid
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, or_, update, func
+from sqlalchemy.exc import IntegrityError
+from .model import db, Job
+from .mail import smtp_pool
+
+
+# Durable background jobs in the job table. Requests enqueue rows in their own transaction,
+# `flask jobs worker` processes claim them in batches (FOR UPDATE SKIP LOCKED on Postgres),
+# run them and record the outcome. A failed job goes back to pending with an exponential
+# backoff until it runs out of attempts; a job whose worker died is picked up again once
+# its lock times out. Periodic jobs queue their next run when they finish
+
+EPOCH = datetime(1970, 1, 1)
+# kind -> function, filled by @task
+TASKS = {}
+# kind -> config key holding its interval in seconds, 0 turns it off
+PERIODIC = {}
+
+
+def task(kind, every=None):
+    def decorator(f):
+        TASKS[kind] = f
+        if every:
+            PERIODIC[kind] = every
+        return f
+    return decorator
+
+
+def enqueue(kind, payload=None, run_at=None, max_attempts=None, unique_key=None):
+    # Added to the caller's session, the job only exists once the caller commits
+    job = Job(kind=kind, payload=payload or {}, run_at=run_at or datetime.utcnow(),
+              max_attempts=max_attempts or current_app.config['JOBS_MAX_ATTEMPTS'], unique_key=unique_key)
+    db.session.add(job)
+    return job
+
+
+def enqueue_once(kind, unique_key, payload=None, run_at=None):
+    # For jobs that several workers may queue at the same moment, the unique key lets one
+    # through. Returns None when the job was already queued
+    try:
+        with db.session.begin_nested():
+            return enqueue(kind, payload, run_at, unique_key=unique_key)
+    except IntegrityError:
+        return None
+
+
+def schedule_next(kind, now=None):
+    # Runs fall on multiples of the interval, so every worker computes the same next run
+    # and the unique key keeps it to one job
+    interval = current_app.config[PERIODIC[kind]]
+    if not interval:
+        # Turned off
+        return None
+    elapsed = int(((now or datetime.utcnow()) - EPOCH).total_seconds())
+    run_at = EPOCH + timedelta(seconds=(elapsed // interval + 1) * interval)
+    return enqueue_once(kind, f'{kind}@{run_at.isoformat()}', run_at=run_at)
+
+
+def backoff(attempts):
+    # Exponential, capped, with jitter so failed jobs don't all come back together
+    config = current_app.config
+    delay = min(config['JOBS_BACKOFF_MAX'], config['JOBS_BACKOFF_BASE'] * 2 ** (attempts - 1))
+    return timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def claim(worker_id, limit):
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=current_app.config['JOBS_LOCK_TIMEOUT'])
+    ready = or_(and_(Job.status == 'pending', Job.run_at <= now), and_(Job.status == 'running', Job.locked_at < stale))
+    # Other workers skip the rows locked here instead of queueing up behind them
+    ids = [id for id, in db.session.query(Job.id).filter(ready).order_by(Job.run_at).limit(limit).with_for_update(skip_locked=True)]
+    if ids:
+        # The ready condition again, for databases without row locks (SQLite serializes writers)
+        db.session.execute(update(Job).where(Job.id.in_(ids), ready)
+                           .values(status='running', locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1)
+                           .execution_options(synchronize_session=False))
+    db.session.commit()
+    if not ids:
+        return []
+    return db.session.query(Job).filter(Job.id.in_(ids), Job.locked_by == worker_id, Job.locked_at == now).order_by(Job.run_at).all()
+
+
+def run_job(job):
+    job_id = job.id
+    try:
+        TASKS[job.kind](**job.payload)
+    except Exception:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.last_error = traceback.format_exc()[-4000:]
+        if job.attempts >= job.max_attempts:
+            job.status, job.finished_at = 'failed', datetime.utcnow()
+        else:
+            job.status, job.run_at = 'pending', datetime.utcnow() + backoff(job.attempts)
+    else:
+        job = db.session.get(Job, job_id)
+        job.status, job.finished_at = 'done', datetime.utcnow()
+    job.locked_by = job.locked_at = None
+    status = job.status
+    if job.kind in PERIODIC and status != 'pending':
+        schedule_next(job.kind)
+        # The next run takes its place, only failures are worth keeping
+        if status == 'done':
+            db.session.delete(job)
+    db.session.commit()
+    return status
+
+
+class Worker:
+    def __init__(self, app, batch_size=None, poll_interval=None, burst=False):
+        self.app = app
+        self.batch_size = batch_size or app.config['JOBS_BATCH_SIZE']
+        self.poll_interval = poll_interval or app.config['JOBS_POLL_INTERVAL']
+        self.burst = burst
+        self.id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self.stopping = False
+        self.processed = 0
+
+    def stop(self, *args):
+        # The batch in hand is finished first
+        self.stopping = True
+
+    def run(self):
+        with self.app.app_context():
+            for kind in PERIODIC:
+                schedule_next(kind)
+            db.session.commit()
+            try:
+                while not self.stopping:
+                    jobs = claim(self.id, self.batch_size)
+                    for job in jobs:
+                        run_job(job)
+                        self.processed += 1
+                    if not jobs:
+                        if self.burst:
+                            break
+                        time.sleep(self.poll_interval)
+            finally:
+                smtp_pool.close()
+                db.session.remove()
+        return self.processed
+
+
+def _worker_process(burst):
+    # Each process builds its own app, engine and SMTP pool
+    from .app import create_app
+    worker = Worker(create_app(), burst=burst)
+    signal.signal(signal.SIGTERM, worker.stop)
+    worker.run()
+
+
+def run_workers(processes, burst=False):
+    context = multiprocessing.get_context('spawn')
+    children = [context.Process(target=_worker_process, args=(burst,)) for _ in range(processes)]
+    for child in children:
+        child.start()
+    try:
+        for child in children:
+            child.join()
+    except KeyboardInterrupt:
+        for child in children:
+            child.terminate()
+            child.join()
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('jobs', cls=AppGroup, help='Background jobs.')
+def jobs_cli():
+    pass
+
+
+@jobs_cli.command('worker', help='Run jobs until stopped.')
+@click.option('--processes', type=int, default=1, show_default=True)
+@click.option('--burst', is_flag=True, help='Exit once no job is due.')
+def worker_command(processes, burst):
+    if processes > 1:
+        run_workers(processes, burst)
+        return
+    worker = Worker(current_app._get_current_object(), burst=burst)
+    signal.signal(signal.SIGTERM, worker.stop)
+    click.echo(f'Worker {worker.id} ran {worker.run()} jobs')
+
+
+@jobs_cli.command('status', help='Count jobs by kind and status.')
+def status_command():
+    rows = db.session.query(Job.kind, Job.status, func.count(), func.min(Job.run_at)).group_by(Job.kind, Job.status).order_by(Job.kind, Job.status)
+    for kind, status, count, next_run in rows:
+        click.echo(f'{kind:<24} {status:<8} {count:>8}  {next_run if status == "pending" else ""}')
+
+
+@jobs_cli.command('prune', help='Delete finished jobs older than --days.')
+@click.option('--days', type=int, default=7, show_default=True)
+@click.option('--failed', is_flag=True, help='Failed jobs too.')
+def prune_command(days, failed):
+    statuses = ['done', 'failed'] if failed else ['done']
+    deleted = Job.query.filter(Job.status.in_(statuses), Job.finished_at < datetime.utcnow() - timedelta(days=days)).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f'Deleted {deleted} jobs')
+
+
+def init_app(app):
+    app.cli.add_command(jobs_cli)
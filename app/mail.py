@@ -0,0 +1,180 @@
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+import smtplib
+import socketserver
+import threading
+import time
+import click
+from flask.cli import AppGroup
+from flask_mail import Mail
+
+
+mail = Mail()
+
+
+# ---------------------------- Connection pool ---------------------------- #
+
+class SMTPPool:
+    # Open SMTP sessions kept between messages, so a batch of reminders pays for one
+    # connect/EHLO/STARTTLS/AUTH instead of one per message. Sessions idle for longer than
+    # idle_timeout are checked with a NOOP before reuse, servers drop them eventually
+
+    def __init__(self, size=4, idle_timeout=30):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = LifoQueue()
+        self.opened = 0
+
+    def _open(self):
+        # Flask-Mail's Connection opens its session in __enter__ and quits in __exit__,
+        # here that happens when the pool takes it in and drops it
+        connection = mail.connect()
+        connection.__enter__()
+        self.opened += 1
+        return connection
+
+    def _alive(self, connection, idle_since):
+        if connection.host is None or time.monotonic() - idle_since < self.idle_timeout:
+            return True
+        try:
+            return connection.host.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+
+    def _close(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _acquire(self):
+        while True:
+            try:
+                connection, idle_since = self._idle.get_nowait()
+            except Empty:
+                return self._open()
+            if self._alive(connection, idle_since):
+                return connection
+            self._close(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        except Exception:
+            # Don't hand a session in an unknown state to the next message
+            self._close(connection)
+            raise
+        if self._idle.qsize() < self.size:
+            self._idle.put((connection, time.monotonic()))
+        else:
+            self._close(connection)
+
+    def send(self, message):
+        # One retry on a fresh session when the server hung up on an idle one
+        try:
+            with self.connection() as connection:
+                connection.send(message)
+        except smtplib.SMTPServerDisconnected:
+            with self.connection() as connection:
+                connection.send(message)
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except Empty:
+                return
+            self._close(connection)
+
+
+smtp_pool = SMTPPool()
+
+
+# ---------------------------- Local SMTP sink ---------------------------- #
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP for smtplib: accepts every message and keeps only counts (and the
+    # last few messages, for inspection)
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 hms smtp sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip().split(' ', 1)[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250-hms smtp sink\r\n250 8BITMIME' if command == 'EHLO' else '250 hms smtp sink')
+            elif command in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line)
+                sink.received(b''.join(data))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=1025, keep=100):
+        super().__init__((host, port), SMTPSinkHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.keep = keep
+        self.last = []
+
+    def received(self, data):
+        with self.lock:
+            self.messages += 1
+            self.last = (self.last + [data])[-self.keep:]
+
+    def start(self):
+        # Serves from a daemon thread, for benchmarks and tests
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('mail', cls=AppGroup, help='Outgoing email.')
+def mail_cli():
+    pass
+
+
+@mail_cli.command('sink', help='Run an SMTP server that accepts and discards every message.')
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', type=int, default=1025, show_default=True)
+def sink_command(host, port):
+    sink = SMTPSink(host, port)
+    click.echo(f'SMTP sink listening on {host}:{port}, point MAIL_SERVER/MAIL_PORT at it')
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        click.echo(f'{sink.messages} messages over {sink.connections} connections')
+
+
+def init_app(app):
+    mail.init_app(app)
+    smtp_pool.size = app.config.get('SMTP_POOL_SIZE', 4)
+    smtp_pool.idle_timeout = app.config.get('SMTP_POOL_IDLE_TIMEOUT', 30)
+    app.cli.add_command(mail_cli)
@@ -0,0 +1,131 @@
+from collections import namedtuple
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+from .model import db, SchemaMigration
+
+
+# db.create_all() only creates missing tables, it never touches existing ones. Changes to
+# tables that already hold data (new indexes, mostly) are listed here instead, in order,
+# and applied once per database with `flask migrations upgrade`. Never edit or reorder a
+# migration that has shipped, append a new one.
+
+Migration = namedtuple('Migration', 'version name apply')
+
+
+def drop_invalid_index(connection, name):
+    # A CREATE INDEX CONCURRENTLY that failed half-way leaves an INVALID index behind,
+    # which IF NOT EXISTS would then happily skip
+    invalid = connection.execute(text(
+        'SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid '
+        'WHERE c.relname = :name AND NOT i.indisvalid'), {'name': name}).first()
+    if invalid:
+        connection.exec_driver_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def create_index(connection, name, table, *columns, using=None, unique=False):
+    # On Postgres the index is built CONCURRENTLY, so writes to the table carry on while
+    # it builds. That cannot run inside a transaction, migrations get an autocommit connection
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    if connection.dialect.name == 'postgresql':
+        drop_invalid_index(connection, name)
+        method = f' USING {using}' if using else ''
+        connection.exec_driver_sql(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table}{method} ({", ".join(columns)})')
+    else:
+        connection.exec_driver_sql(f'CREATE {kind} IF NOT EXISTS {name} ON {table} ({", ".join(columns)})')
+
+
+def listing_indexes(connection):
+    # Keyset pagination of the admin listings
+    for table in ('patient', 'doctor', 'admin'):
+        create_index(connection, f'ix_{table}_last_name_id', table, 'last_name', 'id')
+    create_index(connection, 'ix_appointment_date_time_id', 'appointment', 'date', 'time', 'id')
+    create_index(connection, 'ix_doctor_schedule_doctor_id', 'doctor_schedule', 'doctor_id')
+
+
+def appointment_lookup_indexes(connection):
+    # Doctor and patient dashboards, the doctor's appointment list and double-booking
+    # checks filter appointments by doctor or patient and then by date. Lookups by date
+    # alone are served by ix_appointment_date_time_id
+    create_index(connection, 'ix_appointment_doctor_id_date', 'appointment', 'doctor_id', 'date')
+    create_index(connection, 'ix_appointment_patient_id_date', 'appointment', 'patient_id', 'date')
+    create_index(connection, 'ix_doctor_department_id', 'doctor', 'department_id')
+
+
+def search_indexes(connection):
+    # Trigram indexes for app/search.py, they serve both its LIKE '%word%' and its
+    # word_similarity() lookups. Other databases search an in-memory index instead
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table in ('patient', 'doctor'):
+        # Keep the expression identical to search.search_expression()
+        create_index(connection, f'ix_{table}_search_trgm', table,
+                     "lower(first_name || ' ' || last_name || ' ' || email || ' ' || phone_number) gin_trgm_ops", using='gin')
+
+
+def unique_appointment_slots(connection):
+    # Double bookings already in the table would fail the index half-way, they need a
+    # person to decide which appointment stays
+    duplicates = connection.exec_driver_sql(
+        'SELECT COUNT(*) FROM (SELECT 1 FROM appointment GROUP BY doctor_id, date, time HAVING COUNT(*) > 1) AS duplicates').scalar()
+    if duplicates:
+        raise click.ClickException(f'{duplicates} doctor slots are booked more than once, cancel the extra appointments and upgrade again')
+    create_index(connection, 'uq_appointment_doctor_id_date_time', 'appointment', 'doctor_id', 'date', 'time', unique=True)
+
+
+MIGRATIONS = [
+    Migration(1, 'listing indexes', listing_indexes),
+    Migration(2, 'appointment lookup indexes', appointment_lookup_indexes),
+    Migration(3, 'search indexes', search_indexes),
+    Migration(4, 'unique appointment slots', unique_appointment_slots),
+]
+
+
+def applied_versions():
+    return {version for version, in db.session.query(SchemaMigration.version)}
+
+
+def pending_migrations():
+    applied = applied_versions()
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def upgrade(echo=print):
+    # Workers no longer create tables on boot (except on SQLite), a fresh database gets its
+    # tables here. Existing tables are left alone, the migrations below change those
+    db.create_all()
+    applied = []
+    for migration in pending_migrations():
+        echo(f'Applying {migration.version}: {migration.name}')
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            migration.apply(connection)
+        # Recorded only once the migration went through, a failed one is retried next time
+        db.session.add(SchemaMigration(version=migration.version, name=migration.name))
+        db.session.commit()
+        applied.append(migration)
+    return applied
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('migrations', cls=AppGroup, help='Apply schema changes to an existing database.')
+def migrations_cli():
+    pass
+
+
+@migrations_cli.command('upgrade', help='Apply every pending migration.')
+def upgrade_command():
+    if not upgrade(echo=click.echo):
+        click.echo('Database is up to date')
+
+
+@migrations_cli.command('status', help='List migrations and whether they have been applied.')
+def status_command():
+    applied = applied_versions()
+    for migration in MIGRATIONS:
+        click.echo(f'{"applied" if migration.version in applied else "pending":<8} {migration.version:>3}  {migration.name}')
+
+
+def init_app(app):
+    app.cli.add_command(migrations_cli)
@@ -1,26 +1,25 @@
-from flask import Flask
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import func, desc
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
-import os
-from dotenv import load_dotenv
+from sqlalchemy import func, desc, select, inspect, union_all
+from sqlalchemy.orm import joinedload, contains_eager, load_only, declared_attr, aliased
+from datetime import datetime, date, timedelta
+from collections import Counter
 import uuid
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+from .pagination import keyset_paginate, DEFAULT_PER_PAGE
+from .cache import cache, cached
+from .hashing import hash_password, verify_password, needs_rehash
+from .routing import RoutingSession
 
 
-load_dotenv()
+# Sessions send @read_only work to the replica binds, see app/routing.py
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
-app = Flask(__name__)
-
-app.config['SECRET_KEY'] = f'{os.environ.get("SECRET_KEY")}'
-app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://hospitalmanagement.postgres.database.azure.com:5432/hosmanage?user=hms&password={os.environ.get("PGPASSWORD")}&sslmode=require'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-
-db = SQLAlchemy(app)
+# Doctor dashboard: upcoming appointments it lists, days of history it covers, and rows
+# fetched per round trip
+DASHBOARD_UPCOMING_LIMIT = 20
+DASHBOARD_HISTORY_DAYS = 365
+DASHBOARD_YIELD_PER = 2000
 
 
 class Role(db.Model):
@@ -40,11 +39,26 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'), nullable=False)
 
+    # Listings are ordered by (last_name, id), keep an index that matches it
+    @declared_attr.directive
+    def __table_args__(cls):
+        return (db.Index(f'ix_{cls.__tablename__}_last_name_id', 'last_name', 'id'),)
+
+    # Flask-Login session id, carries the role so load_user knows which table to read
+    def get_id(self):
+        return f'{self.role_id}:{self.id}'
+
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not verify_password(self.password_hash, password):
+            return False
+        # Upgrade hashes made with outdated cost parameters while we have the plaintext,
+        # the login routes commit it
+        if needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
 class Patient(User):
     age = db.Column(db.Integer, nullable=False)
@@ -56,8 +70,19 @@ class Patient(User):
     appointments = db.relationship('Appointment', backref='patient', lazy=True)
 
     @classmethod
+    @cached(['patient'])
     def get_unique_patient_count(cls):
-        return db.session.query(cls).count()
+        count = EntityCount.get_count(cls.__tablename__)
+        return count if count is not None else db.session.query(cls).count()
+
+    @classmethod
+    def get_patient_page(cls, cursor=None, per_page=DEFAULT_PER_PAGE, gender=None, blood_group=None):
+        query = cls.query.options(load_only(cls.first_name, cls.last_name, cls.email, cls.phone_number, cls.gender, cls.age, cls.blood_group, cls.health_status, cls.image_file))
+        if gender:
+            query = query.filter(cls.gender == gender)
+        if blood_group:
+            query = query.filter(cls.blood_group == blood_group)
+        return keyset_paginate(query, [cls.last_name, cls.id], cursor, per_page)
 
 class Department(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -65,56 +90,312 @@ class Department(db.Model):
     doctors = db.relationship('Doctor', backref='department', lazy=True)
 
     @classmethod
+    @cached(['appointment', 'appointment_archive', 'doctor', 'department'])
     def get_top_departments(cls, limit=4):
+        if EntityCount.get_count(Appointment.__tablename__) is not None:
+            # Read the maintained per-department rollup instead of joining every appointment
+            departments = db.session.query(cls, DepartmentAppointmentCount.total).join(DepartmentAppointmentCount, DepartmentAppointmentCount.department_id == cls.id).filter(DepartmentAppointmentCount.total > 0).order_by(desc(DepartmentAppointmentCount.total)).limit(limit).all()
+            return [(department.name, count) for department, count in departments]
 
         # Fetch the top departments with the highest patient count
-        departments = db.session.query(cls, func.count(Appointment.id)).join(Doctor, Doctor.department_id == cls.id).join(Appointment, Appointment.doctor_id == Doctor.id).group_by(cls.id).order_by(desc(func.count(Appointment.id))).limit(limit).all()
+        appointments = Appointment.with_archive()
+        departments = db.session.query(cls, func.count(appointments.id)).join(Doctor, Doctor.department_id == cls.id).join(appointments, appointments.doctor_id == Doctor.id).group_by(cls.id).order_by(desc(func.count(appointments.id))).limit(limit).all()
 
         # Return a list of department names and patient counts
         return [(department.name, count) for department, count in departments]
 
 class Doctor(User):
-    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
+    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False, index=True)
     appointments = db.relationship('Appointment', backref='doctor', lazy=True)
 
     @classmethod
+    @cached(['doctor'])
     def get_unique_doctor_count(cls):
-        return db.session.query(cls).count()
+        count = EntityCount.get_count(cls.__tablename__)
+        return count if count is not None else db.session.query(cls).count()
+
+    @classmethod
+    def get_doctor_page(cls, cursor=None, per_page=DEFAULT_PER_PAGE, department_id=None, gender=None):
+        query = cls.query.options(
+            load_only(cls.first_name, cls.last_name, cls.email, cls.phone_number, cls.gender, cls.image_file, cls.department_id),
+            joinedload(cls.department).load_only(Department.name),
+        )
+        if department_id:
+            query = query.filter(cls.department_id == department_id)
+        if gender:
+            query = query.filter(cls.gender == gender)
+        return keyset_paginate(query, [cls.last_name, cls.id], cursor, per_page)
+
+    def cache_scopes(self):
+        return {f'doctor_dashboard:{self.id}'}
+
+    @classmethod
+    def get_dashboard(cls, doctor_id, upcoming_limit=DASHBOARD_UPCOMING_LIMIT, history_days=DASHBOARD_HISTORY_DAYS):
+        # Cached per doctor: only commits touching this doctor or their appointments (see
+        # cache_scopes) invalidate it. Bulk writes bump the shared 'doctor_dashboard' tag
+        today = date.today()
+        return cache.get_or_compute('Doctor.get_dashboard', ['department', 'doctor_dashboard', f'doctor_dashboard:{doctor_id}'], (str(doctor_id), upcoming_limit, history_days, today),
+                                    lambda: cls._build_dashboard(doctor_id, upcoming_limit, today - timedelta(days=history_days), today))
+
+    @classmethod
+    def _build_dashboard(cls, doctor_id, upcoming_limit, since, today):
+        # One pass over the doctor's appointments from `since` on, joined to their patients,
+        # through the (doctor_id, date) index. Older history is never read, so the cost
+        # doesn't grow with the years a doctor has been here. Plain values so it can be pickled
+        statement = (
+            select(
+                Department.id, Department.name,
+                Appointment.id, Appointment.date, Appointment.time, Appointment.comment,
+                Patient.id, Patient.first_name, Patient.last_name, Patient.email, Patient.gender, Patient.age, Patient.blood_group, Patient.image_file,
+            )
+            .select_from(cls)
+            .outerjoin(Department, Department.id == cls.department_id)
+            .outerjoin(Appointment, (Appointment.doctor_id == cls.id) & (Appointment.date >= since))
+            .outerjoin(Patient, Patient.id == Appointment.patient_id)
+            .where(cls.id == doctor_id)
+            .order_by(Appointment.date, Appointment.time, Appointment.id)
+            .execution_options(yield_per=DASHBOARD_YIELD_PER)
+        )
+        department, upcoming, patients, per_day = None, [], {}, Counter()
+        for department_id, department_name, id, day, time, comment, patient_id, first_name, last_name, email, gender, age, blood_group, image_file in db.session.execute(statement):
+            if department_id is not None:
+                department = {'id': department_id, 'name': department_name}
+            if id is None:
+                continue
+            per_day[day] += 1
+            if patient_id is not None:
+                patient = patients.get(patient_id)
+                if patient is None:
+                    patient = patients[patient_id] = {'id': patient_id, 'first_name': first_name, 'last_name': last_name, 'email': email, 'gender': gender,
+                                                      'age': age, 'blood_group': blood_group, 'image_file': image_file, 'visits': 0}
+                patient['visits'] += 1
+                patient['last_visit'] = day
+            if day >= today and len(upcoming) < upcoming_limit:
+                upcoming.append({'id': id, 'date': day, 'time': time, 'comment': comment, 'patient_id': patient_id,
+                                 'patient_name': f'{first_name} {last_name}' if patient_id else None})
+        return {
+            'department': department,
+            'upcoming': upcoming,
+            # Most recently seen patients first
+            'patients': sorted(patients.values(), key=lambda patient: patient['last_visit'], reverse=True),
+            'appointments_per_day': {str(day): count for day, count in per_day.items()},
+        }
 
 class Appointment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, nullable=False, default=datetime.utcnow().date())
-    time = db.Column(db.Time, nullable=False, default=datetime.utcnow().time())
+    date = db.Column(db.Date, nullable=False, default=lambda: datetime.utcnow().date())
+    time = db.Column(db.Time, nullable=False, default=lambda: datetime.utcnow().time().replace(second=0, microsecond=0))
     patient_id = db.Column(UUID(as_uuid=True), db.ForeignKey('patient.id'), nullable=False, default=uuid.uuid4)
     doctor_id = db.Column(UUID(as_uuid=True), db.ForeignKey('doctor.id'), nullable=False, default=uuid.uuid4)
     comment = db.Column(db.Text, nullable=True)
 
+    # Keep in step with app/migrations.py, which adds these to existing databases
+    __table_args__ = (
+        db.Index('ix_appointment_date_time_id', 'date', 'time', 'id'),
+        db.Index('ix_appointment_doctor_id_date', 'doctor_id', 'date'),
+        db.Index('ix_appointment_patient_id_date', 'patient_id', 'date'),
+        # A doctor is booked at most once per slot, see app/booking.py
+        db.Index('uq_appointment_doctor_id_date_time', 'doctor_id', 'date', 'time', unique=True),
+    )
+
     @classmethod
+    @cached(['appointment', 'appointment_archive', 'patient'])
     def get_gender_counts(cls):
-        male_counts = db.session.query(cls.date, func.count(cls.id)).join(Patient, cls.patient_id == Patient.id).filter(Patient.gender == 'Male').group_by(cls.date).all()
-        female_counts = db.session.query(cls.date, func.count(cls.id)).join(Patient, cls.patient_id == Patient.id).filter(Patient.gender == 'Female').group_by(cls.date).all()
+        if EntityCount.get_count(cls.__tablename__) is not None:
+            # One row per day and gender from the maintained rollup
+            rows = db.session.query(AppointmentDailyGenderCount.date, AppointmentDailyGenderCount.gender, AppointmentDailyGenderCount.total).filter(AppointmentDailyGenderCount.gender.in_(['Male', 'Female']), AppointmentDailyGenderCount.total > 0).order_by(AppointmentDailyGenderCount.date).all()
+            return [(str(date), count) for date, gender, count in rows if gender == 'Male'], [(str(date), count) for date, gender, count in rows if gender == 'Female']
+
+        # Like the rollups, these count archived appointments too
+        appointments = cls.with_archive()
+        male_counts = db.session.query(appointments.date, func.count(appointments.id)).join(Patient, appointments.patient_id == Patient.id).filter(Patient.gender == 'Male').group_by(appointments.date).all()
+        female_counts = db.session.query(appointments.date, func.count(appointments.id)).join(Patient, appointments.patient_id == Patient.id).filter(Patient.gender == 'Female').group_by(appointments.date).all()
         return [(str(date), count) for date, count in male_counts], [(str(date), count) for date, count in female_counts]
     
     @classmethod
+    @cached(['appointment', 'appointment_archive'])
     def get_total_appointment_count(cls):
-        return db.session.query(cls).count()
+        count = EntityCount.get_count(cls.__tablename__)
+        return count if count is not None else db.session.query(cls).count() + db.session.query(AppointmentArchive).count()
+
+    @classmethod
+    def with_archive(cls):
+        # Hot and archived appointments as one entity, for queries over the whole history.
+        # Filters on it reach both tables and their indexes
+        columns = ('id', 'date', 'time', 'patient_id', 'doctor_id', 'comment')
+        rows = union_all(select(*(getattr(cls, name) for name in columns)),
+                         select(*(getattr(AppointmentArchive, name) for name in columns))).subquery('appointment_with_archive')
+        return aliased(cls, rows, adapt_on_names=True)
+
+    @classmethod
+    def between(cls, date_from=None, date_to=None):
+        # The entity to query for a date range. Archived appointments are only read when
+        # the range asks for days the archive holds, everything else stays on the hot table
+        if date_from is None and date_to is None:
+            return cls
+        horizon = AppointmentArchive.get_horizon()
+        if horizon is None or (date_from is not None and date_from > horizon):
+            return cls
+        return cls.with_archive()
+
+    @classmethod
+    def get_appointment_page(cls, cursor=None, per_page=DEFAULT_PER_PAGE, date_from=None, date_to=None,
+                             department_id=None, doctor_id=None, gender=None, blood_group=None):
+        # Load appointments together with the patient, doctor and department columns the
+        # admin table shows in a single joined query instead of one lazy load per row
+        appointments = cls.between(date_from, date_to)
+        query = db.session.query(appointments).outerjoin(appointments.patient).outerjoin(appointments.doctor).outerjoin(Doctor.department).options(
+            load_only(appointments.date, appointments.time, appointments.patient_id, appointments.doctor_id),
+            contains_eager(appointments.patient).load_only(Patient.first_name, Patient.last_name, Patient.email, Patient.age, Patient.gender, Patient.blood_group, Patient.image_file),
+            contains_eager(appointments.doctor).load_only(Doctor.first_name, Doctor.last_name, Doctor.image_file, Doctor.department_id)
+            .contains_eager(Doctor.department).load_only(Department.name),
+        )
+        if date_from:
+            query = query.filter(appointments.date >= date_from)
+        if date_to:
+            query = query.filter(appointments.date <= date_to)
+        if doctor_id:
+            query = query.filter(appointments.doctor_id == doctor_id)
+        if department_id:
+            query = query.filter(Doctor.department_id == department_id)
+        if gender:
+            query = query.filter(Patient.gender == gender)
+        if blood_group:
+            query = query.filter(Patient.blood_group == blood_group)
+        return keyset_paginate(query, [appointments.date, appointments.time, appointments.id], cursor, per_page)
+
+    def cache_scopes(self):
+        # A reassigned appointment changes the dashboards of both doctors
+        doctor_ids = {self.doctor_id, *inspect(self).attrs.doctor_id.history.deleted}
+        return {f'doctor_dashboard:{doctor_id}' for doctor_id in doctor_ids if doctor_id}
+
+class AppointmentArchive(db.Model):
+    # Cold storage for appointments older than ARCHIVE_AFTER_DAYS, moved here in batches by
+    # app/archive.py with their ids unchanged. Range partitioned by date on Postgres, one
+    # partition per year, which is why the date is part of the key
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date = db.Column(db.Date, primary_key=True)
+    time = db.Column(db.Time, nullable=False)
+    patient_id = db.Column(UUID(as_uuid=True), db.ForeignKey('patient.id'), nullable=False)
+    doctor_id = db.Column(UUID(as_uuid=True), db.ForeignKey('doctor.id'), nullable=False)
+    comment = db.Column(db.Text, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_appointment_archive_date_time_id', 'date', 'time', 'id'),
+        db.Index('ix_appointment_archive_doctor_id_date', 'doctor_id', 'date'),
+        db.Index('ix_appointment_archive_patient_id_date', 'patient_id', 'date'),
+        {'postgresql_partition_by': 'RANGE (date)'},
+    )
+
+    @classmethod
+    @cached(['appointment_archive'])
+    def get_horizon(cls):
+        # The newest archived day, None while nothing has been archived
+        return db.session.query(func.max(cls.date)).scalar()
+
+class DoctorSchedule(db.Model):
+    # Working hours for one weekday (0 = Monday), split into fixed-length slots
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(UUID(as_uuid=True), db.ForeignKey('doctor.id'), nullable=False, index=True)
+    weekday = db.Column(db.Integer, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    slot_minutes = db.Column(db.Integer, nullable=False, default=30)
 
 class Admin(User):
     # Add any additional fields for Admin here
     pass
 
-with app.app_context():
-    db.create_all()
-
-
-def upload_file_to_azure(file, filename):
-    try:
-        blob_service_client = BlobServiceClient.from_connection_string(os.environ.get('AZURE_STORAGE_CONNECTION_STRING_PREFIX') + os.environ.get('AZURE_STORAGE_CONNECTION_STRING_SUFFIX'))
-        blob_client = blob_service_client.get_blob_client(os.environ.get('AZURE_CONTAINER_NAME'), filename)
-        blob_client.upload_blob(file)
-        # Generate blob url and return
-        blob_url = blob_client.url
-        return blob_url
-    except Exception as e:
-        print(e)
-        return None
\ No newline at end of file
+ROLE_MODELS = {1: Patient, 2: Doctor, 3: Admin}
+
+
+# ---------------------------- Dashboard rollups ---------------------------- #
+# Summary tables kept up to date by app/rollups.py in the same transaction as the
+# inserts/deletes they summarize, so the dashboard never scans the appointment table
+
+class AppointmentDailyGenderCount(db.Model):
+    date = db.Column(db.Date, primary_key=True)
+    gender = db.Column(db.String(10), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+class DepartmentAppointmentCount(db.Model):
+    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+class EntityCount(db.Model):
+    # Totals as of the last rebuild, what changed since is spread over EntityCountShard
+    name = db.Column(db.String(50), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def get_count(cls, name):
+        # None means the rollups have not been built yet for this database
+        changes = select(func.coalesce(func.sum(EntityCountShard.total), 0)).where(EntityCountShard.name == name).scalar_subquery()
+        return db.session.query(cls.total + changes).filter(cls.name == name).scalar()
+
+class EntityCountShard(db.Model):
+    # Every insert or delete adds to one of a few rows per name, picked at random, so
+    # concurrent bookings do not all queue for the lock on a single row
+    name = db.Column(db.String(50), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+
+# ---------------------------- Background jobs ---------------------------- #
+# Queue rows for app/jobs.py. A job is enqueued in the same transaction as the change that
+# calls for it, so a rolled back booking never sends its confirmation
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    # pending -> running -> done, or back to pending with a later run_at until it has
+    # used up max_attempts and ends up failed
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    # Set for jobs that must only be queued once, e.g. one run of a periodic job
+    unique_key = db.Column(db.String(200), nullable=True, unique=True)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+class AppointmentReminder(db.Model):
+    # One row per appointment whose reminder went out
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id', ondelete='CASCADE'), primary_key=True)
+    sent_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class BookingKey(db.Model):
+    # Idempotency key of a submitted booking form and the appointment it made, a resubmitted
+    # form finds it here instead of booking again. Goes with the appointment
+    patient_id = db.Column(UUID(as_uuid=True), db.ForeignKey('patient.id'), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id', ondelete='CASCADE'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ReplicaHeartbeat(db.Model):
+    # A single row the primary rewrites every REPLICA_HEARTBEAT_INTERVAL seconds, how old
+    # a replica's copy is tells how far behind it is
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    beat_at = db.Column(db.DateTime, nullable=False)
+
+
+# ---------------------------- Schema migrations ---------------------------- #
+
+class SchemaMigration(db.Model):
+    # One row per migration from app/migrations.py applied to this database
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
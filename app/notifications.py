@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+import smtplib
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import insert, tuple_
+from .model import db, Appointment, AppointmentReminder, Patient, Doctor
+from .mail import smtp_pool
+from .jobs import task, enqueue_once
+
+
+# Booking confirmations and appointment reminders, sent from background jobs
+
+
+def confirmation_message(email, patient_name, doctor_name, day, slot):
+    return Message('Your appointment is booked', recipients=[email],
+                   body=f'Hello {patient_name},\n\nYour appointment with Dr. {doctor_name} is booked for '
+                        f'{day:%A %d %B %Y} at {slot:%H:%M}.\n\nYCT Medicals')
+
+
+def reminder_message(email, patient_name, doctor_name, day, slot):
+    return Message('Appointment reminder', recipients=[email],
+                   body=f'Hello {patient_name},\n\nThis is a reminder of your appointment with Dr. {doctor_name} on '
+                        f'{day:%A %d %B %Y} at {slot:%H:%M}.\n\nYCT Medicals')
+
+
+def appointment_details(appointment_id):
+    return db.session.query(Patient.email, Patient.first_name, Doctor.first_name + ' ' + Doctor.last_name, Appointment.date, Appointment.time) \
+        .select_from(Appointment).join(Patient, Appointment.patient_id == Patient.id).outerjoin(Doctor, Appointment.doctor_id == Doctor.id) \
+        .filter(Appointment.id == appointment_id).first()
+
+
+@task('booking_confirmation')
+def send_booking_confirmation(appointment_id):
+    details = appointment_details(appointment_id)
+    # Cancelled before the job got to it
+    if details is not None:
+        smtp_pool.send(confirmation_message(*details))
+
+
+@task('appointment_reminder')
+def send_reminder(appointment_id):
+    # A reminder the batch dispatch could not deliver, retried on its own
+    details = appointment_details(appointment_id)
+    if details is not None:
+        smtp_pool.send(reminder_message(*details))
+
+
+@task('dispatch_reminders', every='REMINDER_INTERVAL')
+def dispatch_reminders():
+    # Appointments starting within the lead time that have had no reminder yet, in
+    # (date, time, id) order so each batch is a range of ix_appointment_date_time_id.
+    # A batch goes out over one SMTP session and is committed before the next, a crash
+    # resends at most one batch
+    config = current_app.config
+    now = datetime.utcnow()
+    until = now + timedelta(seconds=config['REMINDER_LEAD_TIME'])
+    after = (now.date(), now.time(), 0)
+    sent = 0
+    while True:
+        batch = db.session.query(Appointment.id, Appointment.date, Appointment.time, Patient.email, Patient.first_name,
+                                 Doctor.first_name + ' ' + Doctor.last_name) \
+            .join(Patient, Appointment.patient_id == Patient.id).outerjoin(Doctor, Appointment.doctor_id == Doctor.id) \
+            .outerjoin(AppointmentReminder, AppointmentReminder.appointment_id == Appointment.id) \
+            .filter(tuple_(Appointment.date, Appointment.time, Appointment.id) > tuple_(*after),
+                    tuple_(Appointment.date, Appointment.time) <= tuple_(until.date(), until.time()),
+                    AppointmentReminder.appointment_id.is_(None)) \
+            .order_by(Appointment.date, Appointment.time, Appointment.id).limit(config['REMINDER_BATCH_SIZE']).all()
+        if not batch:
+            return sent
+        with smtp_pool.connection() as connection:
+            for id, day, slot, email, patient_name, doctor_name in batch:
+                try:
+                    connection.send(reminder_message(email, patient_name, doctor_name, day, slot))
+                    sent += 1
+                except smtplib.SMTPRecipientsRefused:
+                    # This address is the problem, not the session: retry it alone with backoff
+                    enqueue_once('appointment_reminder', f'appointment_reminder:{id}', {'appointment_id': id})
+        db.session.execute(insert(AppointmentReminder), [{'appointment_id': row[0], 'sent_at': now} for row in batch])
+        db.session.commit()
+        id, day, slot = batch[-1][:3]
+        after = (day, slot, id)
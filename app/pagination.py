@@ -0,0 +1,73 @@
+import base64
+import json
+from datetime import date, time
+from uuid import UUID
+from sqlalchemy import tuple_
+
+
+DEFAULT_PER_PAGE = 25
+MAX_PER_PAGE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    payload = json.dumps([value.isoformat() if isinstance(value, (date, time)) else str(value) for value in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, keys):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw_values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if len(raw_values) != len(keys):
+            raise InvalidCursor(cursor)
+        return [_parse_value(key.type.python_type, value) for key, value in zip(keys, raw_values)]
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+def _parse_value(python_type, value):
+    if python_type is date:
+        return date.fromisoformat(value)
+    if python_type is time:
+        return time.fromisoformat(value)
+    if python_type is UUID:
+        return UUID(value)
+    return python_type(value)
+
+
+def clamp_per_page(per_page):
+    if not per_page or per_page < 1:
+        return DEFAULT_PER_PAGE
+    return min(per_page, MAX_PER_PAGE)
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=DEFAULT_PER_PAGE):
+    # Seek past the last row of the previous page with a row-value comparison on the
+    # ordering keys, so every page is an index range scan no matter how deep it is
+    per_page = clamp_per_page(per_page)
+    if cursor:
+        query = query.filter(tuple_(*keys) > tuple_(*decode_cursor(cursor, keys)))
+
+    rows = query.order_by(*keys).limit(per_page + 1).all()
+    items = rows[:per_page]
+    next_cursor = None
+    if len(rows) > per_page:
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, key.key) for key in keys])
+    return KeysetPage(items, next_cursor)
@@ -0,0 +1,60 @@
+from datetime import datetime
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+from .model import db, ReplicaHeartbeat
+from .jobs import task
+from . import routing
+
+
+# Lag measurement for the read replicas in app/routing.py. A periodic job rewrites the
+# heartbeat row on the primary; a replica's copy of it is as old as the replica is behind
+
+
+@task('replica_heartbeat', every='REPLICA_HEARTBEAT_INTERVAL')
+def beat():
+    heartbeat = db.session.get(ReplicaHeartbeat, 1)
+    if heartbeat is None:
+        db.session.add(ReplicaHeartbeat(id=1, beat_at=datetime.utcnow()))
+    else:
+        heartbeat.beat_at = datetime.utcnow()
+    db.session.commit()
+
+
+def lag_stats():
+    # Last measured lag per replica and the reads sent to each, for /metrics and the CLI
+    return {key: {'lag_seconds': routing.state.lag.get(key), 'reads': routing.state.reads.get(key, 0)}
+            for key in routing.replica_engines(db)}
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('replicas', cls=AppGroup, help='Read replicas.')
+def replicas_cli():
+    pass
+
+
+@replicas_cli.command('lag', help='Write a heartbeat and show how far behind each replica is.')
+@click.option('--no-beat', is_flag=True, help="Compare against the last heartbeat instead of writing one.")
+def lag_command(no_beat):
+    if not routing.replica_engines(db):
+        click.echo('No replicas configured, set DATABASE_REPLICA_URLS')
+        return
+    if not no_beat:
+        beat()
+    for key, lag in sorted(routing.measure_lag(db).items()):
+        if lag is None or lag == float('inf'):
+            click.echo(f'{key:<12} {"no heartbeat yet" if lag is None else "no heartbeat replicated"}')
+        else:
+            click.echo(f'{key:<12} {lag:.3f}s')
+
+
+def init_app(app):
+    routing.state.max_lag = app.config.get('REPLICA_MAX_LAG', 5)
+    routing.state.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 10)
+    routing.state.check_interval = app.config.get('REPLICA_LAG_CHECK_INTERVAL', 5)
+    # db.session is shared by every app, see rollups.init_app
+    if not event.contains(db.session, 'after_flush', routing.after_flush):
+        event.listen(db.session, 'after_flush', routing.after_flush)
+        event.listen(db.session, 'after_commit', routing.after_commit)
+    app.cli.add_command(replicas_cli)
@@ -0,0 +1,203 @@
+from collections import Counter
+import random
+import sys
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, select, func, update, insert, inspect as sa_inspect
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .model import db, Patient, Doctor, Appointment, AppointmentDailyGenderCount, DepartmentAppointmentCount, EntityCount, EntityCountShard
+
+
+COUNTED_MODELS = (Patient, Doctor, Appointment)
+# Rows each entity count is spread over, see EntityCountShard
+COUNT_SHARDS = 16
+# Changing any of these moves an appointment to other rollup rows
+MOVING_ATTRIBUTES = ('date', 'patient_id', 'doctor_id', 'patient', 'doctor')
+
+
+# ---------------------------- Incremental maintenance ---------------------------- #
+
+def _increment(connection, model, keys, delta, upsert=True):
+    table = model.__table__
+    if upsert and connection.dialect.name in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql_insert if connection.dialect.name == 'postgresql' else sqlite_insert
+        statement = dialect_insert(table).values(**keys, total=delta)
+        statement = statement.on_conflict_do_update(index_elements=list(keys), set_={'total': table.c.total + delta})
+        connection.execute(statement)
+        return
+
+    # Other databases: update in place and insert when the key does not exist yet
+    where = [table.c[name] == value for name, value in keys.items()]
+    result = connection.execute(update(table).where(*where).values(total=table.c.total + delta))
+    if upsert and result.rowcount == 0:
+        connection.execute(insert(table).values(**keys, total=delta))
+
+
+def adjust_count(connection, name, delta):
+    # Also used for bulk writes that bypass the session events
+    _increment(connection, EntityCountShard, {'name': name, 'shard': random.randrange(COUNT_SHARDS)}, delta)
+
+
+def _lookup(session, connection, model, column, ids):
+    # Resolve a column for the given ids, preferring objects already in the session
+    # (they may have been deleted by this very flush)
+    values = {}
+    for obj in list(session.new) + list(session.deleted) + list(session.identity_map.values()):
+        if isinstance(obj, model) and obj.__dict__.get('id') in ids and column.key in obj.__dict__:
+            values[obj.__dict__['id']] = obj.__dict__[column.key]
+
+    missing = [id for id in ids if id not in values]
+    if missing:
+        values.update(connection.execute(select(model.id, column).where(model.id.in_(missing))).all())
+    return values
+
+
+def before_flush(session, flush_context, instances):
+    # Deleted appointments are gone by after_flush, capture what the rollups need now
+    deleted = [(a.date, a.patient_id, a.doctor_id) for a in session.deleted if isinstance(a, Appointment)]
+    if deleted:
+        session.info.setdefault('rollup_deleted_appointments', []).extend(deleted)
+    # So are the old date, patient and doctor of an updated appointment. They are read back
+    # from the row, a doctor or patient set through the relationship only reaches the
+    # column during the flush
+    moved = [a.id for a in session.dirty if isinstance(a, Appointment) and a not in session.deleted
+             and any(sa_inspect(a).attrs[name].history.has_changes() for name in MOVING_ATTRIBUTES)]
+    if moved:
+        session.info.setdefault('rollup_previous_keys', {}).update(
+            (id, (date, patient_id, doctor_id)) for id, date, patient_id, doctor_id in session.connection().execute(
+                select(Appointment.id, Appointment.date, Appointment.patient_id, Appointment.doctor_id).where(Appointment.id.in_(moved))))
+
+
+def after_flush(session, flush_context):
+    entity_deltas = Counter()
+    appointment_deltas = []
+
+    for obj in session.new:
+        if isinstance(obj, COUNTED_MODELS):
+            entity_deltas[obj.__tablename__] += 1
+        if isinstance(obj, Appointment):
+            appointment_deltas.append((obj.date, obj.patient_id, obj.doctor_id, 1))
+    for obj in session.deleted:
+        if isinstance(obj, COUNTED_MODELS):
+            entity_deltas[obj.__tablename__] -= 1
+    for date, patient_id, doctor_id in session.info.pop('rollup_deleted_appointments', []):
+        appointment_deltas.append((date, patient_id, doctor_id, -1))
+    # Moved to another day or doctor: out of the old key, into the new one
+    previous_keys = session.info.pop('rollup_previous_keys', {})
+    for obj in session.dirty:
+        if not isinstance(obj, Appointment) or obj.id not in previous_keys:
+            continue
+        previous = previous_keys[obj.id]
+        if previous != (obj.date, obj.patient_id, obj.doctor_id):
+            appointment_deltas.append((*previous, -1))
+            appointment_deltas.append((obj.date, obj.patient_id, obj.doctor_id, 1))
+
+    if not entity_deltas and not appointment_deltas:
+        return
+
+    connection = session.connection()
+    genders = _lookup(session, connection, Patient, Patient.gender, {patient_id for _, patient_id, _, _ in appointment_deltas})
+    departments = _lookup(session, connection, Doctor, Doctor.department_id, {doctor_id for _, _, doctor_id, _ in appointment_deltas})
+
+    gender_deltas = Counter()
+    department_deltas = Counter()
+    for date, patient_id, doctor_id, delta in appointment_deltas:
+        if genders.get(patient_id) is not None:
+            gender_deltas[(date, genders[patient_id])] += delta
+        if departments.get(doctor_id) is not None:
+            department_deltas[departments[doctor_id]] += delta
+
+    # Only rebuild() creates EntityCount rows, their presence marks the rollups as built
+    for name, delta in entity_deltas.items():
+        if delta:
+            adjust_count(connection, name, delta)
+    for (date, gender), delta in gender_deltas.items():
+        if delta:
+            _increment(connection, AppointmentDailyGenderCount, {'date': date, 'gender': gender}, delta)
+    for department_id, delta in department_deltas.items():
+        if delta:
+            _increment(connection, DepartmentAppointmentCount, {'department_id': department_id}, delta)
+
+
+def after_rollback(session):
+    session.info.pop('rollup_deleted_appointments', None)
+    session.info.pop('rollup_previous_keys', None)
+
+
+# ---------------------------- Rebuild / verify ---------------------------- #
+
+def compute_rollups():
+    # Recompute every rollup from the base tables. Archived appointments still count,
+    # archiving moves them without touching the rollups
+    appointments = Appointment.with_archive()
+    entity_counts = {model.__tablename__: db.session.query(func.count(model.id)).scalar() for model in COUNTED_MODELS}
+    entity_counts[Appointment.__tablename__] = db.session.query(func.count(appointments.id)).scalar()
+    gender_counts = dict(((date, gender), count) for date, gender, count in db.session.query(appointments.date, Patient.gender, func.count(appointments.id)).join(Patient, appointments.patient_id == Patient.id).group_by(appointments.date, Patient.gender))
+    department_counts = dict(db.session.query(Doctor.department_id, func.count(appointments.id)).join(Doctor, appointments.doctor_id == Doctor.id).group_by(Doctor.department_id).all())
+    return entity_counts, gender_counts, department_counts
+
+
+def stored_rollups():
+    entity_counts = {name: EntityCount.get_count(name) for name, in db.session.query(EntityCount.name)}
+    gender_counts = dict(((date, gender), total) for date, gender, total in db.session.query(AppointmentDailyGenderCount.date, AppointmentDailyGenderCount.gender, AppointmentDailyGenderCount.total) if total)
+    department_counts = dict((department_id, total) for department_id, total in db.session.query(DepartmentAppointmentCount.department_id, DepartmentAppointmentCount.total) if total)
+    return entity_counts, gender_counts, department_counts
+
+
+def rebuild():
+    entity_counts, gender_counts, department_counts = compute_rollups()
+    db.session.query(EntityCount).delete()
+    db.session.query(EntityCountShard).delete()
+    db.session.query(AppointmentDailyGenderCount).delete()
+    db.session.query(DepartmentAppointmentCount).delete()
+    db.session.add_all([EntityCount(name=name, total=total) for name, total in entity_counts.items()])
+    db.session.add_all([AppointmentDailyGenderCount(date=date, gender=gender, total=total) for (date, gender), total in gender_counts.items()])
+    db.session.add_all([DepartmentAppointmentCount(department_id=department_id, total=total) for department_id, total in department_counts.items()])
+    db.session.commit()
+
+
+def verify():
+    # Return a list of (rollup, key, stored, actual) for every mismatch
+    mismatches = []
+    for name, actual, stored in zip(('entity_count', 'appointment_daily_gender_count', 'department_appointment_count'), compute_rollups(), stored_rollups()):
+        for key in set(actual) | set(stored):
+            if actual.get(key, 0) != stored.get(key, 0):
+                mismatches.append((name, key, stored.get(key, 0), actual.get(key, 0)))
+    return mismatches
+
+
+@click.group('rollups', cls=AppGroup, help='Maintain the dashboard statistics rollups.')
+def rollups_cli():
+    pass
+
+
+@rollups_cli.command('rebuild', help='Recompute all rollups from the base tables.')
+def rebuild_command():
+    rebuild()
+    click.echo('Rollups rebuilt')
+
+
+@rollups_cli.command('verify', help='Compare the rollups against the base tables.')
+@click.option('--fix', is_flag=True, help='Rebuild the rollups when they do not match.')
+def verify_command(fix):
+    mismatches = verify()
+    for name, key, stored, actual in mismatches:
+        click.echo(f'{name} {key}: stored={stored} actual={actual}')
+    if not mismatches:
+        click.echo('Rollups are consistent')
+        return
+    if fix:
+        rebuild()
+        click.echo('Rollups rebuilt')
+    else:
+        sys.exit(1)
+
+
+def init_app(app):
+    # create_app() may run more than once per process (tests, scripts), listen only once
+    if not event.contains(db.session, 'before_flush', before_flush):
+        event.listen(db.session, 'before_flush', before_flush)
+        event.listen(db.session, 'after_flush', after_flush)
+        event.listen(db.session, 'after_rollback', after_rollback)
+    app.cli.add_command(rollups_cli)
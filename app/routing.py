@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+import random
+import threading
+import time
+from flask import has_request_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+
+# Read replica routing. Views and functions marked @read_only send their SELECTs to one of
+# the replica binds (SQLALCHEMY_BINDS keys starting with 'replica'), everything else goes
+# to the primary. A session that has written stays on the primary, and so does the user
+# who wrote for REPLICA_STICKY_SECONDS after the commit, so they read their own writes.
+# Replicas further behind than REPLICA_MAX_LAG (see app/replicas.py), or whose lag is not
+# known, say because no heartbeat is being written, are skipped. A replica that fails
+# during a @read_only call is skipped until the next lag check and the call is run again
+# on the primary
+
+REPLICA_BIND_PREFIX = 'replica'
+PRIMARY_UNTIL = 'db_primary_until'
+
+_replica_reads = ContextVar('replica_reads', default=False)
+# Bind key of the replica the current @read_only call last read from
+_replica_used = ContextVar('replica_used', default=None)
+
+
+class ReplicaState:
+    def __init__(self):
+        self.max_lag = 5
+        self.sticky_seconds = 10
+        self.check_interval = 5
+        # bind key -> seconds behind the primary, None when unknown
+        self.lag = {}
+        self.checked_at = None
+        self.reads = {}
+        self._lock = threading.Lock()
+
+
+state = ReplicaState()
+
+
+def replica_engines(db):
+    return {key: engine for key, engine in db.engines.items() if key and key.startswith(REPLICA_BIND_PREFIX)}
+
+
+def _as_datetime(value):
+    # SQLite hands DATETIME columns back as text through a plain text() query
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def measure_lag(db):
+    # Seconds between the primary's heartbeat and the one each replica has replayed (see
+    # app/replicas.py). None while there is no heartbeat yet, inf for a replica that is
+    # down or has never seen one
+    query = text('SELECT beat_at FROM replica_heartbeat WHERE id = 1')
+    with db.engine.connect() as connection:
+        primary = _as_datetime(connection.execute(query).scalar())
+    lag = {}
+    for key, engine in replica_engines(db).items():
+        try:
+            with engine.connect() as connection:
+                replica = _as_datetime(connection.execute(query).scalar())
+        except Exception:
+            replica = None
+        if primary is None:
+            lag[key] = None
+        else:
+            lag[key] = max(0.0, (primary - replica).total_seconds()) if replica else float('inf')
+    return lag
+
+
+def pick_replica(db):
+    engines = replica_engines(db)
+    if not engines:
+        return None
+    if state.checked_at is None or time.monotonic() - state.checked_at > state.check_interval:
+        with state._lock:
+            if state.checked_at is None or time.monotonic() - state.checked_at > state.check_interval:
+                try:
+                    state.lag = measure_lag(db)
+                except Exception:
+                    state.lag = {}
+                state.checked_at = time.monotonic()
+    healthy = [key for key in engines if state.lag.get(key) is not None and state.lag[key] <= state.max_lag]
+    if not healthy:
+        return None
+    key = random.choice(healthy)
+    state.reads[key] = state.reads.get(key, 0) + 1
+    _replica_used.set(key)
+    return engines[key]
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _replica_reads.get() and not self._flushing and not self.info.get('wrote') \
+                and getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None:
+            engine = pick_replica(self._db)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def pinned_to_primary():
+    return has_request_context() and flask_session.get(PRIMARY_UNTIL, 0) > time.time()
+
+
+def replica_reads_active():
+    return _replica_reads.get()
+
+
+@contextmanager
+def replica_reads():
+    token = _replica_reads.set(not pinned_to_primary())
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def read_only(f):
+    # Views and functions that only read, and can live with REPLICA_MAX_LAG seconds of lag
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        with replica_reads():
+            token = _replica_used.set(None)
+            try:
+                return f(*args, **kwargs)
+            except OperationalError:
+                key = _replica_used.get()
+                if key is None:
+                    raise
+            finally:
+                _replica_used.reset(token)
+        # The replica is down or was cut off mid-query, retry once on the primary
+        from .model import db
+        state.lag[key] = float('inf')
+        db.session.rollback()
+        with primary_reads():
+            return f(*args, **kwargs)
+    return decorated_function
+
+
+# ---------------------------- Write tracking ---------------------------- #
+
+def after_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+def after_commit(session):
+    if session.info.get('wrote') and has_request_context():
+        flask_session[PRIMARY_UNTIL] = time.time() + state.sticky_seconds
@@ -0,0 +1,255 @@
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+import heapq
+from itertools import islice
+import threading
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+from .model import db, Doctor, Appointment, DoctorSchedule
+
+
+# Doctors without a schedule of their own work Monday to Friday, 9 to 5, in 30 minute slots
+DEFAULT_HOURS = {weekday: [(9 * 60, 17 * 60, 30)] for weekday in range(5)}
+MINUTES_PER_DAY = 24 * 60
+
+
+def to_minutes(when):
+    return when.toordinal() * MINUTES_PER_DAY + when.hour * 60 + when.minute
+
+
+def from_minutes(minutes):
+    day, minute = divmod(minutes, MINUTES_PER_DAY)
+    return datetime.combine(date.fromordinal(day), time(minute // 60, minute % 60))
+
+
+class AvailabilityIndex:
+    # Per-doctor working hours plus a sorted array of booked slot starts (minutes since
+    # day 1). Checking a slot is a binary search, so finding free slots costs
+    # O(slots scanned * log bookings) no matter how many appointments a doctor has
+
+    def __init__(self):
+        self.schedules = {}
+        self.booked = defaultdict(lambda: array('q'))
+        self.departments = defaultdict(set)
+        self.loaded_at = None
+        self._lock = threading.RLock()
+
+    def set_schedule(self, doctor_id, windows):
+        # windows: {weekday: [(start_minute, end_minute, slot_minutes), ...]}
+        with self._lock:
+            if windows:
+                self.schedules[doctor_id] = windows
+            else:
+                self.schedules.pop(doctor_id, None)
+
+    def add_doctor(self, doctor_id, department_id):
+        with self._lock:
+            self.departments[department_id].add(doctor_id)
+
+    def add_booking(self, doctor_id, when):
+        with self._lock:
+            booked = self.booked[doctor_id]
+            minutes = to_minutes(when)
+            i = bisect_left(booked, minutes)
+            if i == len(booked) or booked[i] != minutes:
+                insort(booked, minutes)
+
+    def remove_booking(self, doctor_id, when):
+        with self._lock:
+            booked = self.booked.get(doctor_id)
+            if booked is None:
+                return
+            minutes = to_minutes(when)
+            i = bisect_left(booked, minutes)
+            if i < len(booked) and booked[i] == minutes:
+                del booked[i]
+
+    def is_booked(self, doctor_id, when):
+        booked = self.booked.get(doctor_id)
+        if not booked:
+            return False
+        minutes = to_minutes(when)
+        i = bisect_left(booked, minutes)
+        return i < len(booked) and booked[i] == minutes
+
+    def is_working(self, doctor_id, when):
+        minute = when.hour * 60 + when.minute
+        for start, end, slot in self.schedules.get(doctor_id, DEFAULT_HOURS).get(when.weekday(), ()):
+            if start <= minute <= end - slot and (minute - start) % slot == 0:
+                return True
+        return False
+
+    def is_free(self, doctor_id, when):
+        return self.is_working(doctor_id, when) and not self.is_booked(doctor_id, when)
+
+    def free_slots(self, doctor_id, start, end):
+        # Lazily yield (slot_start, doctor_id) for every free slot in [start, end)
+        windows = self.schedules.get(doctor_id, DEFAULT_HOURS)
+        booked = self.booked.get(doctor_id) or array('q')
+        start_minutes, end_minutes = to_minutes(start), to_minutes(end)
+        # Bookings are walked in step with the slots, one binary search to start with
+        cursor = bisect_left(booked, start_minutes)
+
+        day = start.date()
+        while day.toordinal() * MINUTES_PER_DAY < end_minutes:
+            day_minutes = day.toordinal() * MINUTES_PER_DAY
+            for window_start, window_end, slot in windows.get(day.weekday(), ()):
+                for minute in range(window_start, window_end - slot + 1, slot):
+                    slot_minutes = day_minutes + minute
+                    if slot_minutes < start_minutes:
+                        continue
+                    if slot_minutes >= end_minutes:
+                        return
+                    while cursor < len(booked) and booked[cursor] < slot_minutes:
+                        cursor += 1
+                    if cursor < len(booked) and booked[cursor] == slot_minutes:
+                        continue
+                    yield from_minutes(slot_minutes), doctor_id
+            day += timedelta(days=1)
+
+    def next_free_slots(self, doctor_ids, start, end, limit=10):
+        # Merge the doctors' lazy slot streams, generation stops after `limit` slots
+        with self._lock:
+            streams = [self.free_slots(doctor_id, start, end) for doctor_id in doctor_ids]
+            return list(islice(heapq.merge(*streams, key=lambda slot: slot[0]), limit))
+
+    def doctors_in_department(self, department_id):
+        return list(self.departments.get(department_id, ()))
+
+
+availability = AvailabilityIndex()
+RELOAD_AFTER = timedelta(minutes=5)
+
+
+def schedule_windows(rows):
+    windows = defaultdict(list)
+    for row in rows:
+        windows[row.weekday].append((row.start_time.hour * 60 + row.start_time.minute,
+                                     row.end_time.hour * 60 + row.end_time.minute,
+                                     row.slot_minutes))
+    return dict(windows)
+
+
+def load_index(index=None, since=None):
+    # (Re)build the index from the database. Only appointments from `since` on matter
+    # for free-slot searches, so history is skipped
+    index = index or AvailabilityIndex()
+    since = since or datetime.utcnow().date()
+
+    for doctor_id, department_id in db.session.query(Doctor.id, Doctor.department_id):
+        index.add_doctor(doctor_id, department_id)
+
+    by_doctor = defaultdict(list)
+    for row in DoctorSchedule.query.order_by(DoctorSchedule.doctor_id):
+        by_doctor[row.doctor_id].append(row)
+    for doctor_id, rows in by_doctor.items():
+        index.set_schedule(doctor_id, schedule_windows(rows))
+
+    bookings = defaultdict(list)
+    for doctor_id, day, slot_time in db.session.query(Appointment.doctor_id, Appointment.date, Appointment.time).filter(Appointment.date >= since):
+        bookings[doctor_id].append(to_minutes(datetime.combine(day, slot_time)))
+    for doctor_id, minutes in bookings.items():
+        index.booked[doctor_id] = array('q', sorted(set(minutes)))
+
+    index.loaded_at = datetime.utcnow()
+    return index
+
+
+def get_availability():
+    # The per-process index is refreshed periodically so bookings made by other workers
+    # show up; the booking itself is always checked against the database
+    global availability
+    if availability.loaded_at is None or datetime.utcnow() - availability.loaded_at > RELOAD_AFTER:
+        availability = load_index()
+    return availability
+
+
+def find_free_slots(doctor_id=None, department_id=None, start=None, end=None, limit=10):
+    index = get_availability()
+    start = start or datetime.utcnow()
+    end = end or start + timedelta(days=14)
+    doctor_ids = [doctor_id] if doctor_id else index.doctors_in_department(department_id)
+    return index.next_free_slots(doctor_ids, start, end, limit)
+
+
+def is_bookable(doctor_id, day, slot_time):
+    # A slot start within the doctor's working hours, on their slot grid. Anything else
+    # would overlap a neighbouring appointment, which the unique index cannot see
+    return get_availability().is_working(doctor_id, datetime.combine(day, slot_time))
+
+
+def is_slot_taken(doctor_id, day, slot_time):
+    return db.session.query(Appointment.id).filter_by(doctor_id=doctor_id, date=day, time=slot_time).first() is not None
+
+
+# ---------------------------- Incremental maintenance ---------------------------- #
+
+def after_flush(session, flush_context):
+    changes = session.info.setdefault('availability_changes', [])
+    for obj in session.new:
+        if isinstance(obj, Appointment):
+            changes.append(('add', obj.doctor_id, datetime.combine(obj.date, obj.time)))
+        elif isinstance(obj, Doctor):
+            changes.append(('doctor', obj.id, obj.department_id))
+    for obj in session.deleted:
+        if isinstance(obj, Appointment):
+            changes.append(('remove', obj.doctor_id, datetime.combine(obj.date, obj.time)))
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, DoctorSchedule):
+            changes.append(('schedule', obj.doctor_id, None))
+
+
+def after_commit(session):
+    changes = session.info.pop('availability_changes', None)
+    if not changes or availability.loaded_at is None:
+        return
+    for kind, doctor_id, value in changes:
+        if kind == 'add':
+            availability.add_booking(doctor_id, value)
+        elif kind == 'remove':
+            availability.remove_booking(doctor_id, value)
+        elif kind == 'doctor':
+            availability.add_doctor(doctor_id, value)
+        else:
+            # Force a reload on next use, schedule edits are rare
+            availability.loaded_at = None
+
+
+def after_rollback(session):
+    session.info.pop('availability_changes', None)
+
+
+# ---------------------------- CLI ---------------------------- #
+
+@click.group('schedule', cls=AppGroup, help='Manage doctor working hours.')
+def schedule_cli():
+    pass
+
+
+@schedule_cli.command('set', help='Replace a doctor\'s working hours on the given weekdays (0 = Monday).')
+@click.argument('email')
+@click.option('--weekdays', default='0,1,2,3,4', show_default=True)
+@click.option('--start', default='09:00', show_default=True)
+@click.option('--end', default='17:00', show_default=True)
+@click.option('--slot', default=30, show_default=True, help='Slot length in minutes.')
+def set_schedule_command(email, weekdays, start, end, slot):
+    doctor = Doctor.query.filter_by(email=email).first()
+    if doctor is None:
+        raise click.ClickException(f'No doctor with email {email}')
+    days = [int(day) for day in weekdays.split(',')]
+    DoctorSchedule.query.filter(DoctorSchedule.doctor_id == doctor.id, DoctorSchedule.weekday.in_(days)).delete(synchronize_session=False)
+    db.session.add_all([DoctorSchedule(doctor_id=doctor.id, weekday=day, start_time=time.fromisoformat(start), end_time=time.fromisoformat(end), slot_minutes=slot) for day in days])
+    db.session.commit()
+    click.echo(f'Updated schedule for Dr. {doctor.first_name} {doctor.last_name}')
+
+
+def init_app(app):
+    # Registered once per process, like the rollup listeners
+    if not event.contains(db.session, 'after_flush', after_flush):
+        event.listen(db.session, 'after_flush', after_flush)
+        event.listen(db.session, 'after_commit', after_commit)
+        event.listen(db.session, 'after_rollback', after_rollback)
+    app.cli.add_command(schedule_cli)
@@ -0,0 +1,328 @@
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime, timedelta
+import re
+import sys
+import threading
+import unicodedata
+from flask import current_app
+from sqlalchemy import event, func, literal_column, and_, or_
+from .model import db, Patient, Doctor
+
+
+# Typeahead search over patients and doctors by name, email and phone. On Postgres the
+# database does the work through trigram indexes (migration 3); elsewhere an in-memory
+# index per process is used, kept up to date by the session events below
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# Fuzzy matching kicks in for words at least this long, below that every word looks alike
+FUZZY_MIN_LENGTH = 3
+# pg_trgm's default similarity threshold
+FUZZY_THRESHOLD = 0.3
+# Entries scanned per query by the in-memory index before giving up on filling `limit`
+MAX_SCANNED = 20000
+RELOAD_AFTER = timedelta(minutes=10)
+
+SearchKind = namedtuple('SearchKind', 'model filters')
+SEARCH_KINDS = {
+    'patients': SearchKind(Patient, {'gender': Patient.gender, 'blood_group': Patient.blood_group, 'health_status': Patient.health_status}),
+    'doctors': SearchKind(Doctor, {'department': Doctor.department_id}),
+}
+
+
+def normalize(text):
+    # Lower case without accents, so "Zoë" is found by "zoe"
+    if not text or text.isascii():
+        return (text or '').lower()
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def query_words(query):
+    # Phone numbers are matched on their digits, "+1 (555) 06" looks for 155506
+    words = [word for word in re.split(r'\s+', normalize(query).strip()) if word]
+    if words and all(re.fullmatch(r'[\d+\-().]+', word) for word in words):
+        digits = re.sub(r'\D', '', ''.join(words))
+        return [digits] if digits else []
+    return words
+
+
+def record_tokens(first_name, last_name, email, phone_number):
+    # Name words, the whole email and its local part split on punctuation, and the phone
+    # digits. Name words repeat across records, they are interned to be stored once
+    email = normalize(email)
+    tokens = {sys.intern(word) for word in name_words(first_name, last_name)}
+    tokens.add(email)
+    tokens.update(word for word in re.split(r'[._+\-@]', email.partition('@')[0]) if word)
+    digits = re.sub(r'\D', '', phone_number or '')
+    if digits:
+        tokens.add(digits)
+    return tuple(tokens)
+
+
+def name_words(first_name, last_name):
+    return re.findall(r'\w+', normalize(f'{first_name} {last_name}'))
+
+
+def trigrams(word):
+    # Padded like pg_trgm does, so the start of a word weighs more than its middle
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a, b):
+    a, b = trigrams(a), trigrams(b)
+    return len(a & b) / len(a | b)
+
+
+def result_json(kind, record_id, first_name, last_name, email, phone_number, filters):
+    item = {'id': str(record_id), 'kind': kind, 'first_name': first_name, 'last_name': last_name,
+            'email': email, 'phone_number': phone_number}
+    item.update(filters)
+    return item
+
+
+# ---------------------------- In-memory index ---------------------------- #
+
+class MemoryIndex:
+    # A sorted list of (token, id) pairs answers prefix queries with a binary search. Every
+    # query word must prefix one of the record's tokens; the word with the fewest
+    # candidates is looked up and the others are checked against the record. Fuzzy
+    # matches go through a trigram index over the distinct name words, which stays small
+    # however many records share them
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.filter_names = tuple(SEARCH_KINDS[kind].filters)
+        self.records = {}
+        self.entries = []
+        self.word_counts = Counter()
+        self.word_trigrams = defaultdict(set)
+        self.loaded_at = None
+        self.reloading = False
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def _add_words(self, words):
+        for word in words:
+            self.word_counts[word] += 1
+            if self.word_counts[word] == 1:
+                for trigram in trigrams(word):
+                    self.word_trigrams[trigram].add(word)
+
+    def _remove_words(self, words):
+        for word in words:
+            self.word_counts[word] -= 1
+            if not self.word_counts[word]:
+                del self.word_counts[word]
+                for trigram in trigrams(word):
+                    self.word_trigrams[trigram].discard(word)
+
+    def _record(self, first_name, last_name, email, phone_number, filters):
+        # Tuples with interned names and filter values, a million of these must fit in memory
+        filter_values = tuple(sys.intern(value) if isinstance(value, str) else value for value in map(filters.get, self.filter_names))
+        return (sys.intern(first_name), sys.intern(last_name), email, phone_number, filter_values,
+                record_tokens(first_name, last_name, email, phone_number))
+
+    def add(self, record_id, first_name, last_name, email, phone_number, filters):
+        with self._lock:
+            self.remove(record_id)
+            record = self.records[record_id] = self._record(first_name, last_name, email, phone_number, filters)
+            for token in record[5]:
+                insort(self.entries, (token, record_id))
+            self._add_words(name_words(first_name, last_name))
+
+    def remove(self, record_id):
+        with self._lock:
+            record = self.records.pop(record_id, None)
+            if record is None:
+                return
+            first_name, last_name, _, _, _, tokens = record
+            for token in tokens:
+                i = bisect_left(self.entries, (token, record_id))
+                if i < len(self.entries) and self.entries[i] == (token, record_id):
+                    del self.entries[i]
+            self._remove_words(name_words(first_name, last_name))
+
+    def load(self, rows):
+        # Bulk load of (id, first_name, last_name, email, phone_number, filters), sorting once
+        with self._lock:
+            self.records, self.word_counts, self.word_trigrams = {}, Counter(), defaultdict(set)
+            entries = []
+            for record_id, first_name, last_name, email, phone_number, filters in rows:
+                record = self.records[record_id] = self._record(first_name, last_name, email, phone_number, filters)
+                entries.extend((token, record_id) for token in record[5])
+                self._add_words(name_words(first_name, last_name))
+            entries.sort()
+            self.entries = entries
+            self.loaded_at = datetime.utcnow()
+
+    def _prefix_range(self, word):
+        return bisect_left(self.entries, (word,)), bisect_left(self.entries, (word + '\uffff',))
+
+    def _matches(self, words, filters, limit, exclude=()):
+        ranges = sorted((self._prefix_range(word) for word in words), key=lambda r: r[1] - r[0])
+        lo, hi = ranges[0]
+        wanted = [(self.filter_names.index(name), value) for name, value in filters.items()]
+        found, seen = [], set(exclude)
+        # Tokens come out in order, so exact matches come before longer words they prefix
+        for _, record_id in self.entries[lo:min(hi, lo + MAX_SCANNED)]:
+            if record_id in seen:
+                continue
+            seen.add(record_id)
+            filter_values, tokens = self.records[record_id][4:]
+            if any(filter_values[i] != value for i, value in wanted):
+                continue
+            if all(any(token.startswith(word) for token in tokens) for word in words):
+                found.append(record_id)
+                if len(found) == limit:
+                    break
+        return found
+
+    def similar_words(self, word, limit=5):
+        candidates = Counter()
+        for trigram in trigrams(word):
+            candidates.update(self.word_trigrams.get(trigram, ()))
+        scored = [(similarity(word, candidate), candidate) for candidate, _ in candidates.most_common(limit * 10)]
+        return [candidate for score, candidate in sorted(scored, reverse=True) if score >= FUZZY_THRESHOLD and candidate != word][:limit]
+
+    def search(self, query, filters=None, limit=DEFAULT_LIMIT):
+        words = query_words(query)
+        if not words:
+            return []
+        filters = filters or {}
+        with self._lock:
+            found = self._matches(words, filters, limit)
+            # Not enough prefix matches: retry with the longest word swapped for similar known words
+            longest = max(words, key=len)
+            if len(found) < limit and len(longest) >= FUZZY_MIN_LENGTH:
+                for alternative in self.similar_words(longest):
+                    fuzzy_words = [alternative if word == longest else word for word in words]
+                    found += self._matches(fuzzy_words, filters, limit - len(found), exclude=found)
+                    if len(found) >= limit:
+                        break
+            return [result_json(self.kind, record_id, *self.records[record_id][:4], dict(zip(self.filter_names, self.records[record_id][4])))
+                    for record_id in found]
+
+
+indexes = {kind: MemoryIndex(kind) for kind in SEARCH_KINDS}
+
+
+def index_rows(kind):
+    spec = SEARCH_KINDS[kind]
+    Model = spec.model
+    columns = [Model.id, Model.first_name, Model.last_name, Model.email, Model.phone_number] + list(spec.filters.values())
+    for row in db.session.query(*columns).yield_per(5000):
+        yield tuple(row[:5]) + (dict(zip(spec.filters, row[5:])),)
+
+
+def get_index(kind):
+    # Built on first use, then rebuilt in the background now and then so writes from other
+    # workers show up. Searches keep using the current index while the new one loads
+    index = indexes[kind]
+    if index.loaded_at is None:
+        index.load(index_rows(kind))
+    elif datetime.utcnow() - index.loaded_at > RELOAD_AFTER and not index.reloading:
+        index.reloading = True
+        threading.Thread(target=reload_index, args=(current_app._get_current_object(), kind), daemon=True).start()
+    return index
+
+
+def reload_index(app, kind):
+    fresh = MemoryIndex(kind)
+    try:
+        with app.app_context():
+            fresh.load(index_rows(kind))
+        indexes[kind] = fresh
+    finally:
+        indexes[kind].reloading = False
+
+
+def invalidate(kind):
+    # After bulk writes that skip the session events, e.g. imports
+    indexes[kind].loaded_at = None
+
+
+# ---------------------------- Postgres ---------------------------- #
+
+def search_expression(Model):
+    # Must match the expression of the trigram indexes in migration 3 exactly, or the
+    # planner won't use them
+    space = literal_column("' '")
+    return func.lower(Model.first_name + space + Model.last_name + space + Model.email + space + Model.phone_number)
+
+
+def database_search(kind, query, filters=None, limit=DEFAULT_LIMIT):
+    # Substring matches on every word plus word_similarity() matches for typos, in one
+    # query. Both operators are served by the GIN trigram index
+    words = query_words(query)
+    if not words:
+        return []
+    spec = SEARCH_KINDS[kind]
+    Model = spec.model
+    expression = search_expression(Model)
+    phrase = ' '.join(words)
+    substring = [expression.like('%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%', escape='\\') for word in words]
+    statement = db.session.query(Model.id, Model.first_name, Model.last_name, Model.email, Model.phone_number, *spec.filters.values()).filter(
+        or_(and_(*substring), expression.op('%>')(phrase)) if len(phrase) >= FUZZY_MIN_LENGTH else and_(*substring))
+    for name, value in (filters or {}).items():
+        statement = statement.filter(spec.filters[name] == value)
+    statement = statement.order_by(func.word_similarity(phrase, expression).desc(), Model.last_name, Model.id).limit(limit)
+    return [result_json(kind, *row[:5], dict(zip(spec.filters, row[5:]))) for row in statement]
+
+
+# ---------------------------- Entry point ---------------------------- #
+
+def use_database(app_config):
+    backend = app_config.get('SEARCH_BACKEND', 'auto')
+    if backend == 'auto':
+        return db.engine.dialect.name == 'postgresql'
+    return backend == 'postgres'
+
+
+def search(kind, query, filters=None, limit=DEFAULT_LIMIT):
+    limit = max(1, min(limit or DEFAULT_LIMIT, MAX_LIMIT))
+    if use_database(current_app.config):
+        return database_search(kind, query, filters, limit)
+    return get_index(kind).search(query, filters, limit)
+
+
+# ---------------------------- Incremental maintenance ---------------------------- #
+
+def after_flush(session, flush_context):
+    changes = session.info.setdefault('search_changes', [])
+    for kind, spec in SEARCH_KINDS.items():
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, spec.model):
+                changes.append((kind, 'add', (obj.id, obj.first_name, obj.last_name, obj.email, obj.phone_number,
+                                              {name: getattr(obj, column.key) for name, column in spec.filters.items()})))
+        for obj in session.deleted:
+            if isinstance(obj, spec.model):
+                changes.append((kind, 'remove', obj.id))
+
+
+def after_commit(session):
+    changes = session.info.pop('search_changes', None)
+    for kind, action, value in changes or ():
+        index = indexes[kind]
+        # Nothing to maintain until the index is first built
+        if index.loaded_at is None:
+            continue
+        if action == 'add':
+            index.add(*value)
+        else:
+            index.remove(value)
+
+
+def after_rollback(session):
+    session.info.pop('search_changes', None)
+
+
+def init_app(app):
+    if not event.contains(db.session, 'after_flush', after_flush):
+        event.listen(db.session, 'after_flush', after_flush)
+        event.listen(db.session, 'after_commit', after_commit)
+        event.listen(db.session, 'after_rollback', after_rollback)
@@ -0,0 +1,61 @@
+// Doctor typeahead for the booking forms, fills the hidden "doctor" field with the picked id.
+// Picking a department lists its doctors from the directory and narrows the search to it
+document.querySelectorAll('.doctor-search').forEach(function (input) {
+    var options = document.getElementById(input.getAttribute('list'));
+    var hidden = input.parentNode.querySelector('input[name="doctor"]');
+    var department = input.form.querySelector('.department-filter');
+    var ids = {};
+    var timer = null;
+
+    function fill(items, label) {
+        ids = {};
+        options.innerHTML = '';
+        items.forEach(function (doctor) {
+            var text = label(doctor);
+            ids[text] = doctor.id;
+            var option = document.createElement('option');
+            option.value = text;
+            options.appendChild(option);
+        });
+    }
+
+    if (department) {
+        department.addEventListener('change', function () {
+            input.value = '';
+            hidden.value = '';
+            if (!department.value) {
+                fill([], null);
+                return;
+            }
+            fetch('/api/doctor-directory?department=' + encodeURIComponent(department.value))
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    fill(data.doctors, function (doctor) { return 'Dr. ' + doctor.name; });
+                });
+        });
+    }
+
+    input.addEventListener('input', function () {
+        hidden.value = ids[input.value] || '';
+        if (hidden.value) {
+            return;
+        }
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            if (input.value.trim().length < 2) {
+                return;
+            }
+            var url = '/api/search/doctors?q=' + encodeURIComponent(input.value);
+            if (department && department.value) {
+                url += '&department=' + encodeURIComponent(department.value);
+            }
+            fetch(url)
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    fill(data.items, function (doctor) {
+                        return 'Dr. ' + doctor.first_name + ' ' + doctor.last_name + ' (' + doctor.email + ')';
+                    });
+                });
+        }, 150);
+    });
+});
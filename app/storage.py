@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from flask import current_app
+from .model import db
+from .instrumentation import external_call
+from .images import read_upload, inspect_image, render_variants, content_digest, variant_name, VARIANT_CONTENT_TYPE
+
+
+DEFAULT_PROFILE_IMAGE = 'https://static-00.iconduck.com/assets.00/profile-default-icon-512x511-v4sw4m29.png'
+
+
+# ---------------------------- Backends ---------------------------- #
+
+class AzureBlobStorage:
+    # One BlobServiceClient per process, its connection pool (and TLS sessions) are
+    # reused by every upload instead of being rebuilt per call
+
+    def __init__(self, connection_string, container):
+        self.connection_string = connection_string
+        self.container = container
+        self._container_client = None
+        self._lock = threading.Lock()
+
+    def _get_container_client(self):
+        with self._lock:
+            if self._container_client is None:
+                from azure.storage.blob import BlobServiceClient
+                service_client = BlobServiceClient.from_connection_string(self.connection_string)
+                self._container_client = service_client.get_container_client(self.container)
+            return self._container_client
+
+    def upload(self, data, name, content_type=None):
+        from azure.storage.blob import ContentSettings
+        blob_client = self._get_container_client().get_blob_client(name)
+        content_settings = ContentSettings(content_type=content_type) if content_type else None
+        blob_client.upload_blob(data, overwrite=True, content_settings=content_settings)
+        return blob_client.url
+
+
+class LocalFileStorage:
+    # Writes blobs under a directory served at base_url, stands in for Azure offline
+
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+        os.makedirs(root, exist_ok=True)
+
+    def upload(self, data, name, content_type=None):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return f'{self.base_url}/{name}'
+
+
+# ---------------------------- Background uploads ---------------------------- #
+
+class UploadQueue:
+    # Uploads run on a small thread pool after the request has returned; on completion the
+    # row's placeholder URL is swapped for the real one
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.completed = 0
+        self.failed = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='upload')
+            return self._executor
+
+    def submit(self, app, upload, on_complete):
+        # `upload` does the work and returns the final URL, `on_complete` runs with it in an app context
+        def run():
+            try:
+                url = upload()
+            except Exception as e:
+                self.failed += 1
+                app.logger.error('Background upload failed: %s', e)
+                return None
+            with app.app_context():
+                on_complete(url)
+            self.completed += 1
+            return url
+        return self._get_executor().submit(run)
+
+    def join(self):
+        # Wait for every queued upload, used by benchmarks and CLI commands
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+storage = None
+upload_queue = UploadQueue()
+
+
+def read_profile_image(image):
+    # Read and validate an uploaded picture inside the request, raises ImageRejected
+    data = read_upload(image.stream)
+    inspect_image(data)
+    return data
+
+
+def upload_profile_image(Model, user_id, data):
+    # Resize, re-encode and store the picture in the background, then point the user's
+    # image_file at the largest variant. The request keeps the placeholder it already saved
+    placeholder = DEFAULT_PROFILE_IMAGE
+    target = storage
+
+    def upload():
+        digest = content_digest(data)
+        variants = render_variants(data)
+        with external_call('storage'):
+            urls = {label: target.upload(variant, variant_name(digest, label), VARIANT_CONTENT_TYPE)
+                    for label, variant in variants.items()}
+        return urls['lg']
+
+    def on_complete(url):
+        user = db.session.get(Model, user_id)
+        if user and user.image_file == placeholder:
+            user.image_file = url
+            db.session.commit()
+
+    return upload_queue.submit(current_app._get_current_object(), upload, on_complete)
+
+
+def init_app(app):
+    global storage
+    backend = app.config.get('STORAGE_BACKEND')
+    if backend == 'azure':
+        storage = AzureBlobStorage(app.config['AZURE_STORAGE_CONNECTION_STRING'], app.config['AZURE_CONTAINER_NAME'])
+    else:
+        storage = LocalFileStorage(app.config.get('LOCAL_STORAGE_ROOT') or os.path.join(app.static_folder, 'uploads'), app.config.get('LOCAL_STORAGE_URL', '/static/uploads'))
+    upload_queue.workers = app.config.get('UPLOAD_WORKERS', 4)
@@ -0,0 +1,64 @@
+import hashlib
+import os
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from flask import current_app
+from .cache import cache
+
+
+# Compiled templates are kept on disk so a new worker loads bytecode instead of parsing the
+# landing pages again (Jinja checks each entry against the template source). Rendered
+# partials can be cached with
+#
+#     {% cache 'admin/head-sidebar', admin.id, tags=['admin'] %} ... {% endcache %}
+#
+# keyed by the name, the arguments and a version of the template files, and dropped when a
+# commit touches one of the tags (see cache.Cache)
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        args, tags = [], nodes.List([])
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.test('name:tags') and parser.stream.look().test('assign'):
+                parser.stream.skip(2)
+                tags = parser.parse_expression()
+            else:
+                args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [name, nodes.List(args), tags]), [], [], body).set_lineno(lineno)
+
+    def _render(self, name, args, tags, caller):
+        if not current_app.config.get('FRAGMENT_CACHE_ENABLED', True):
+            return caller()
+        version = current_app.config['FRAGMENT_CACHE_VERSION']
+        return Markup(cache.get_or_compute(f'fragment:{name}', tags, (version, args), lambda: str(caller()),
+                                           current_app.config.get('FRAGMENT_CACHE_TTL')))
+
+
+def templates_version(app):
+    # Changes whenever a template file does, so a deploy never serves fragments rendered
+    # from the previous templates out of a shared cache
+    digest = hashlib.sha1()
+    root = os.path.join(app.root_path, app.template_folder)
+    for folder, _, files in sorted(os.walk(root)):
+        for file in sorted(files):
+            stat = os.stat(os.path.join(folder, file))
+            digest.update(f'{folder}/{file}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()[:12]
+
+
+def init_app(app):
+    # Must run before anything touches app.jinja_env, Flask builds it from jinja_options once
+    cache_dir = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if cache_dir != '':
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(cache_dir or None)}
+    app.jinja_options = {**app.jinja_options, 'extensions': [*app.jinja_options.get('extensions', ()), FragmentCacheExtension]}
+    app.config.setdefault('FRAGMENT_CACHE_VERSION', templates_version(app))
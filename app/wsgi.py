@@ -0,0 +1,4 @@
+# WSGI entry point for servers that need an application object, e.g. `gunicorn app.wsgi:app`
+from .app import create_app
+
+app = create_app()
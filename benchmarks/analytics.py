@@ -0,0 +1,108 @@
+import argparse
+from datetime import date, time as clock, timedelta
+import os
+import random
+import statistics
+import time
+
+# Runs against the seeded load-test database unless DATABASE_URL says otherwise
+os.environ.setdefault('DATABASE_URL', 'sqlite:///loadtest.db')
+
+from sqlalchemy import func, case
+
+from app.app import create_app
+from app.model import db, Appointment, Patient, Doctor, Department
+from app import analytics
+
+app = create_app()
+
+
+def sql_reports(date_from, date_to):
+    # The same reports as plain GROUP BYs, what each would cost without the snapshot
+    sqlite = db.engine.dialect.name == 'sqlite'
+    if sqlite:
+        week = func.date(Appointment.date, 'weekday 0', '-6 days')
+        weekday = func.strftime('%w', Appointment.date)
+    else:
+        week = func.date_trunc('week', Appointment.date)
+        weekday = func.extract('dow', Appointment.date)
+    in_range = Appointment.date.between(date_from, date_to)
+    age_band = case((Patient.age < 18, 0), (Patient.age < 30, 1), (Patient.age < 45, 2), (Patient.age < 60, 3), (Patient.age < 75, 4), else_=5)
+    return {
+        'weekly trends': lambda: db.session.query(week, Patient.gender, func.count()).join(Patient, Appointment.patient_id == Patient.id)
+            .filter(in_range).group_by(week, Patient.gender).all(),
+        'department x weekday': lambda: db.session.query(Department.name, weekday, func.count()).select_from(Appointment)
+            .join(Doctor, Appointment.doctor_id == Doctor.id).join(Department, Doctor.department_id == Department.id)
+            .filter(in_range).group_by(Department.name, weekday).all(),
+        'doctor utilization': lambda: db.session.query(Appointment.doctor_id, func.count()).filter(in_range)
+            .group_by(Appointment.doctor_id).order_by(func.count().desc()).all(),
+        'demographics': lambda: db.session.query(age_band, Patient.blood_group, Patient.gender, func.count())
+            .group_by(age_band, Patient.blood_group, Patient.gender).all(),
+    }
+
+
+def vector_reports(date_from, date_to):
+    snap = analytics.get_snapshot()
+    mask = lambda: analytics._in_range(snap, date_from, date_to)
+    return {
+        'weekly trends': lambda: analytics.trends(snap, mask(), 'week'),
+        'department x weekday': lambda: analytics.department_weekday_heatmap(snap, mask()),
+        'doctor utilization': lambda: analytics.doctor_utilization(snap, mask(), date_from, date_to),
+        'demographics': lambda: analytics.patient_demographics(snap),
+    }
+
+
+def measure(query, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        query()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def add_appointments(count, rng):
+    # Booked through the ORM like the app does, far enough ahead not to collide with seeded slots
+    doctor_ids = [id for id, in db.session.query(Doctor.id).limit(50)]
+    patient_ids = [id for id, in db.session.query(Patient.id).limit(500)]
+    start = date(2099, 1, 5)
+    added = [Appointment(doctor_id=rng.choice(doctor_ids), patient_id=rng.choice(patient_ids),
+                         date=start + timedelta(days=i // 16), time=clock(9 + i % 16 // 2, i % 2 * 30)) for i in range(count)]
+    db.session.add_all(added)
+    db.session.commit()
+    return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vectorized analytics against the equivalent SQL GROUP BYs.')
+    parser.add_argument('--days', type=int, default=90, help='report window, ending today')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--new-appointments', type=int, default=1000, help='booked between refreshes for the incremental measurement')
+    args = parser.parse_args()
+
+    date_to = date.today()
+    date_from = date_to - timedelta(days=args.days)
+    with app.app_context():
+        print(f'Against {db.engine.url.render_as_string(hide_password=True)}, {args.days} day window')
+        started = time.perf_counter()
+        snap = analytics.get_snapshot(force=True)
+        print(f'snapshot of {snap.appointment_ids.size} appointments / {len(snap.patients)} patients built in '
+              f'{(time.perf_counter() - started) * 1000:.0f}ms')
+
+        sql, vector = sql_reports(date_from, date_to), vector_reports(date_from, date_to)
+        print(f'{"report":<22} {"SQL ms":>10} {"NumPy ms":>10} {"speedup":>9}')
+        for name in sql:
+            sql_ms, vector_ms = measure(sql[name], args.runs), measure(vector[name], args.runs)
+            print(f'{name:<22} {sql_ms:>10.2f} {vector_ms:>10.2f} {sql_ms / max(vector_ms, 1e-6):>8.1f}x')
+        print(f'{"full report()":<22} {"":>10} {measure(lambda: analytics.report(date_from, date_to), args.runs):>10.2f}')
+
+        added = add_appointments(args.new_appointments, random.Random(42))
+        try:
+            started = time.perf_counter()
+            snap = analytics.get_snapshot(force=True)
+            print(f'incremental refresh after {len(added)} new appointments: {(time.perf_counter() - started) * 1000:.1f}ms '
+                  f'(snapshot now {snap.appointment_ids.size})')
+        finally:
+            for appointment in added:
+                db.session.delete(appointment)
+            db.session.commit()
@@ -0,0 +1,70 @@
+import os
+import sys
+from datetime import date, time, timedelta
+
+# Run against a throwaway in-memory database instead of the production Postgres
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from sqlalchemy import event
+
+from app.app import create_app
+from app.model import db, Role, Department, Doctor, Patient, Admin, Appointment
+
+app = create_app()
+
+
+def seed(appointment_count):
+    db.drop_all()
+    db.create_all()
+    db.session.add_all([Role(id=1, name='Patient'), Role(id=2, name='Doctor'), Role(id=3, name='Admin')])
+    departments = [Department(name=f'Department {i}') for i in range(4)]
+    db.session.add_all(departments)
+    db.session.flush()
+
+    admin = Admin(first_name='Ada', last_name='Admin', email='admin@example.com', phone_number='0800', gender='Female', role_id=3, password_hash='x')
+    doctors = [Doctor(first_name=f'Doc{i}', last_name='Tor', email=f'doctor{i}@example.com', phone_number='0801', gender='Male', role_id=2, password_hash='x', department_id=departments[i % 4].id) for i in range(10)]
+    patients = [Patient(first_name=f'Pat{i}', last_name='Ient', email=f'patient{i}@example.com', phone_number='0802', gender='Female' if i % 2 else 'Male', role_id=1, password_hash='x', age=30, health_status='Stable', blood_group='O+', height=1.7, weight=70) for i in range(appointment_count)]
+    db.session.add_all([admin] + doctors + patients)
+    db.session.flush()
+
+    # Doctor and day repeat every 30 appointments, the next round moves to the next half hour
+    start = date(2024, 1, 1)
+    db.session.add_all([Appointment(patient_id=patient.id, doctor_id=doctors[i % len(doctors)].id, date=start + timedelta(days=i % 30),
+                                    time=time(*divmod(9 * 60 + i // 30 * 30, 60))) for i, patient in enumerate(patients)])
+    db.session.commit()
+    return admin.get_id()
+
+
+def count_listing_queries(appointment_count):
+    with app.app_context():
+        admin_id = seed(appointment_count)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = admin_id
+            session['_fresh'] = True
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = client.get('/admin/view-appointments?per_page=100')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        assert response.status_code == 200, response.status_code
+        return len(statements)
+
+
+if __name__ == '__main__':
+    counts = {n: count_listing_queries(n) for n in (5, 50, 500)}
+    for n, queries in counts.items():
+        print(f'{n:>5} appointments: {queries} queries')
+
+    # The listing must issue the same number of statements regardless of how many rows it renders
+    if len(set(counts.values())) != 1:
+        print('FAIL: query count grows with the number of appointments')
+        sys.exit(1)
+    print('OK')
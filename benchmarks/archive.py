@@ -0,0 +1,73 @@
+import argparse
+from datetime import date, timedelta
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# Archiving moves rows out of the seeded load-test database, so this runs on a copy of it
+seeded = os.path.join(os.path.dirname(__file__), '..', 'instance', 'loadtest.db')
+if not os.path.exists(seeded):
+    sys.exit('instance/loadtest.db not found, run python -m benchmarks.seed_data first')
+copy = os.path.join(tempfile.mkdtemp(), 'archive.db')
+shutil.copyfile(seeded, copy)
+os.environ['DATABASE_URL'] = f'sqlite:///{copy}'
+
+from sqlalchemy import func
+
+from app.app import create_app
+from app.model import db, Appointment, Doctor
+from app.archive import archive_appointments
+from app import migrations, rollups
+
+app = create_app()
+
+
+def queries(doctor_ids, recent_from, old_from):
+    return {
+        "doctor's appointment list": lambda: [Appointment.query.filter_by(doctor_id=doctor_id).all() for doctor_id in doctor_ids],
+        'appointments per doctor': lambda: db.session.query(Appointment.doctor_id, func.count()).group_by(Appointment.doctor_id).all(),
+        'listing, recent range': lambda: Appointment.get_appointment_page(date_from=recent_from, per_page=100),
+        'listing, archived range': lambda: Appointment.get_appointment_page(date_from=old_from, date_to=old_from + timedelta(days=7), per_page=100),
+    }
+
+
+def measure(query, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        query()
+        db.session.expunge_all()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hot-table queries before and after archiving old appointments.')
+    parser.add_argument('--keep-days', type=int, default=90, help='archive appointments older than this many days')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    before = date.today() - timedelta(days=args.keep_days)
+    with app.app_context():
+        migrations.upgrade(echo=lambda message: None)
+        doctor_ids = [id for id, in db.session.query(Doctor.id).limit(20)]
+        oldest = db.session.query(func.min(Appointment.date)).scalar()
+        timed = queries(doctor_ids, before, oldest)
+        baseline = {name: measure(query, args.runs) for name, query in timed.items()}
+
+        started = time.perf_counter()
+        moved = archive_appointments(before, args.batch_size)
+        elapsed = time.perf_counter() - started
+        hot = db.session.query(func.count(Appointment.id)).scalar()
+        print(f'archived {moved} appointments before {before} in {elapsed:.2f}s ({moved / max(elapsed, 1e-9):.0f} rows/s), {hot} left hot')
+
+        print(f'{"query":<28} {"before ms":>10} {"after ms":>10} {"speedup":>9}')
+        for name, query in timed.items():
+            after = measure(query, args.runs)
+            print(f'{name:<28} {baseline[name]:>10.2f} {after:>10.2f} {baseline[name] / max(after, 1e-6):>8.1f}x')
+        print(f'rollups after archiving: {"consistent" if not rollups.verify() else "MISMATCH"}')
+    shutil.rmtree(os.path.dirname(copy))
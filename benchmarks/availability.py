@@ -0,0 +1,67 @@
+import argparse
+from array import array
+from datetime import datetime, timedelta
+import os
+import random
+import statistics
+import time
+import uuid
+
+# The index is benchmarked in memory, the app only needs a database to import
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app.scheduling import AvailabilityIndex, DEFAULT_HOURS, to_minutes
+
+
+def build_index(doctors, departments, appointments, days, start):
+    # Fill an index the way load_index() would, without going through a database
+    index = AvailabilityIndex()
+    doctor_ids = [uuid.uuid4() for _ in range(doctors)]
+    for i, doctor_id in enumerate(doctor_ids):
+        index.add_doctor(doctor_id, i % departments)
+
+    # Every weekday slot in the window, bookings are drawn from these
+    slots = []
+    for day in range(days):
+        current = start + timedelta(days=day)
+        for window_start, window_end, slot in DEFAULT_HOURS.get(current.weekday(), ()):
+            slots.extend(to_minutes(current) + minute for minute in range(window_start, window_end, slot))
+
+    per_doctor = appointments // doctors
+    rng = random.Random(42)
+    for doctor_id in doctor_ids:
+        index.booked[doctor_id] = array('q', sorted(rng.sample(slots, min(per_doctor, len(slots)))))
+    index.loaded_at = datetime.utcnow()
+    return index, doctor_ids
+
+
+def measure(label, query, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        query()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f'{label:<40} p50={statistics.median(timings):8.3f}ms  p99={timings[int(len(timings) * 0.99) - 1]:8.3f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Free-slot search latency over a large synthetic roster.')
+    parser.add_argument('--doctors', type=int, default=20000)
+    parser.add_argument('--departments', type=int, default=50)
+    parser.add_argument('--appointments', type=int, default=2000000)
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    start = datetime(2025, 1, 6)
+    started = time.perf_counter()
+    index, doctor_ids = build_index(args.doctors, args.departments, args.appointments, args.days, start)
+    print(f'built index for {args.doctors} doctors / {args.appointments} appointments in {time.perf_counter() - started:.1f}s')
+
+    rng = random.Random(7)
+    end = start + timedelta(days=args.days)
+    measure('next 10 slots, one doctor', lambda: index.next_free_slots([rng.choice(doctor_ids)], start, end, 10), args.runs)
+    measure('next 10 slots, one department', lambda: index.next_free_slots(index.doctors_in_department(rng.randrange(args.departments)), start, end, 10), args.runs)
+    measure('is_free, one doctor and slot', lambda: index.is_free(rng.choice(doctor_ids), start + timedelta(days=rng.randrange(args.days), hours=10)), args.runs)
+    measure('add + remove a booking', lambda: (index.add_booking(doctor_ids[0], start + timedelta(hours=33)), index.remove_booking(doctor_ids[0], start + timedelta(hours=33))), args.runs)
@@ -0,0 +1,116 @@
+import argparse
+from datetime import datetime, timedelta
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Bookings are written, so this runs on a copy of the seeded load-test database unless
+# DATABASE_URL points somewhere else (a scratch Postgres, say)
+if 'DATABASE_URL' not in os.environ:
+    seeded = os.path.join(os.path.dirname(__file__), '..', 'instance', 'loadtest.db')
+    if not os.path.exists(seeded):
+        sys.exit('instance/loadtest.db not found, run python -m benchmarks.seed_data first')
+    copy = os.path.join(tempfile.mkdtemp(), 'booking.db')
+    shutil.copyfile(seeded, copy)
+    os.environ['DATABASE_URL'] = f'sqlite:///{copy}'
+else:
+    copy = None
+
+from sqlalchemy import func
+
+from app.app import create_app
+from app.model import db, Appointment, BookingKey, Doctor, Job, Patient
+from app import migrations
+from app.scheduling import find_free_slots
+
+app = create_app()
+
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def run(clients, slots, double_submit):
+    # Every client books one of the first `slots` free slots of the same doctor, far enough
+    # ahead to be empty, all released at once. With double_submit each form is also sent twice at the same moment, like a
+    # double click, and must still make at most one appointment: both submissions of a
+    # successful form come back booked
+    with app.app_context():
+        doctor_id = db.session.query(Doctor.id).order_by(Doctor.id).first()[0]
+        patients = [patient.get_id() for patient in Patient.query.order_by(Patient.id).limit(clients)]
+        start = datetime(2099, 1, 5)
+        offered = [slot_start for slot_start, _ in find_free_slots(doctor_id=doctor_id, start=start, end=start + timedelta(days=365), limit=slots)]
+        first_job = (db.session.query(func.max(Job.id)).scalar() or 0) + 1
+
+    barrier = threading.Barrier(clients * (2 if double_submit else 1))
+    results = []
+
+    def client(index, patient_id):
+        http = app.test_client()
+        with http.session_transaction() as session:
+            session['_user_id'] = patient_id
+            session['_fresh'] = True
+        slot_start = offered[index % len(offered)]
+        form = {'doctor': str(doctor_id), 'appointment_type': 'online', 'date': slot_start.date().isoformat(),
+                'time': slot_start.strftime('%H:%M'), 'comments': 'Booking benchmark',
+                'idempotency_key': f'bench-{index}'}
+        barrier.wait()
+        started = time.perf_counter()
+        response = http.post('/book-appointment', data=form)
+        elapsed = time.perf_counter() - started
+        location = response.location or ''
+        outcome = 'booked' if location.endswith('/dashboard') else 'conflict' if location.endswith('/book-appointment') else 'error'
+        results.append((outcome, elapsed))
+
+    threads = [threading.Thread(target=client, args=(i, patient_id))
+               for i, patient_id in enumerate(patients) for _ in range(2 if double_submit else 1)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        booked = db.session.query(Appointment.date, Appointment.time, func.count()).filter(Appointment.doctor_id == doctor_id, Appointment.date >= start.date()) \
+            .group_by(Appointment.date, Appointment.time).all()
+        # Leave the database as it was
+        db.session.query(BookingKey).filter(BookingKey.key.like('bench-%')).delete(synchronize_session=False)
+        db.session.query(Job).filter(Job.id >= first_job).delete(synchronize_session=False)
+        # Through the session, so the rollups follow
+        for appointment in Appointment.query.filter(Appointment.doctor_id == doctor_id, Appointment.date >= start.date()):
+            db.session.delete(appointment)
+        db.session.commit()
+    return results, elapsed, booked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simultaneous bookings of the same doctor, successes per second and conflict latency.')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--slots', type=int, default=50, help='free slots the clients compete for')
+    args = parser.parse_args()
+
+    with app.app_context():
+        migrations.upgrade(echo=lambda message: None)
+        print(f'Against {db.engine.url.render_as_string(hide_password=True)}, {args.clients} clients for {args.slots} slots')
+
+    failed = False
+    for label, double_submit in (('single submit', False), ('double submit', True)):
+        results, elapsed, booked = run(args.clients, args.slots, double_submit)
+        successes = [latency for outcome, latency in results if outcome == 'booked']
+        conflicts = [latency for outcome, latency in results if outcome == 'conflict']
+        errors = sum(1 for outcome, _ in results if outcome == 'error')
+        print(f'{label:<14} {len(results)} requests in {elapsed:.2f}s: {len(successes)} booked ({len(successes) / elapsed:.0f}/s), '
+              f'{len(conflicts)} conflicts, conflict latency p50 {statistics.median(conflicts) * 1000 if conflicts else float("nan"):.1f}ms '
+              f'p95 {percentile(conflicts, 0.95) * 1000:.1f}ms, booking p50 {statistics.median(successes) * 1000 if successes else float("nan"):.1f}ms')
+        doubles = [(day, slot, count) for day, slot, count in booked if count > 1]
+        if doubles or errors or len(booked) != min(args.slots, args.clients):
+            print(f'FAIL: {len(booked)} slots booked, {errors} errors, double bookings: {doubles}')
+            failed = True
+    if copy:
+        shutil.rmtree(os.path.dirname(copy))
+    print('FAIL' if failed else 'OK')
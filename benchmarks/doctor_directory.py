@@ -0,0 +1,83 @@
+import os
+import statistics
+import sys
+import time
+
+# Run against a throwaway in-memory database instead of the production Postgres
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from sqlalchemy import event
+
+from app.app import create_app
+from app.model import db, Role, Department, Doctor, Patient
+
+app = create_app()
+
+
+def seed(doctor_count):
+    db.drop_all()
+    db.create_all()
+    db.session.add_all([Role(id=1, name='Patient'), Role(id=2, name='Doctor'), Role(id=3, name='Admin')])
+    departments = [Department(name=f'Department {i}') for i in range(12)]
+    db.session.add_all(departments)
+    db.session.flush()
+    patient = Patient(first_name='Pat', last_name='Ient', email='patient@example.com', phone_number='0802', gender='Female', role_id=1, password_hash='x', age=30, health_status='Stable', blood_group='O+', height=1.7, weight=70)
+    doctors = [Doctor(first_name=f'Doc{i}', last_name='Tor', email=f'doctor{i}@example.com', phone_number='0801', gender='Male', role_id=2, password_hash='x', bio='x' * 2000,
+                      image_file='https://example.com/avatars/0-lg.webp', department_id=departments[i % len(departments)].id) for i in range(doctor_count)]
+    db.session.add_all([patient] + doctors)
+    db.session.commit()
+    return patient.get_id()
+
+
+def old_booking_page():
+    # What the page used to do: every doctor with every column, then a lazy load per department
+    doctors = Doctor.query.all()
+    return [(doctor.id, doctor.first_name, doctor.last_name, doctor.department.name if doctor.department else None) for doctor in doctors]
+
+
+def measure(doctor_count, runs=20):
+    with app.app_context():
+        patient_id = seed(doctor_count)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = patient_id
+            session['_fresh'] = True
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        timings, old_timings, old_queries = [], [], 0
+        client.get('/book-appointment')
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            for _ in range(runs):
+                started = time.perf_counter()
+                response = client.get('/book-appointment')
+                timings.append((time.perf_counter() - started) * 1000)
+                assert response.status_code == 200, response.status_code
+            queries = len(statements) // runs
+            del statements[:]
+            for _ in range(runs):
+                db.session.expunge_all()
+                started = time.perf_counter()
+                old_booking_page()
+                old_timings.append((time.perf_counter() - started) * 1000)
+            old_queries = len(statements) // runs
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return queries, statistics.median(timings), old_queries, statistics.median(old_timings)
+
+
+if __name__ == '__main__':
+    results = {n: measure(n) for n in (50, 500, 5000)}
+    print(f'{"doctors":>8} {"queries":>8} {"page ms":>9}   {"old queries":>11} {"old doctor load ms":>18}')
+    for n, (queries, page_ms, old_queries, old_ms) in results.items():
+        print(f'{n:>8} {queries:>8} {page_ms:>9.2f}   {old_queries:>11} {old_ms:>18.2f}')
+
+    # With the directory cached the page must not query more as the roster grows
+    if len({queries for queries, _, _, _ in results.values()}) != 1:
+        print('FAIL: booking page queries grow with the number of doctors')
+        sys.exit(1)
+    print('OK')
@@ -0,0 +1,139 @@
+import argparse
+import os
+import re
+import sys
+from datetime import date, timedelta
+
+# Seeds a throwaway in-memory database unless DATABASE_URL points somewhere else
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import event
+
+from app.model import db, Admin, Doctor, Patient, Department
+from app.migrations import upgrade
+from benchmarks.appointment_listing import app, seed
+
+
+# Small lookup and summary tables, scanning them is cheaper than any index
+EXPECTED_SCANS = {'role', 'department', 'entity_count', 'department_appointment_count', 'appointment_daily_gender_count'}
+
+# `SCAN x` is a full table scan on SQLite, `Seq Scan on x` on Postgres. Plans that walk an
+# index (SEARCH ..., SCAN x USING INDEX, Index Scan) are fine
+SCAN_PATTERNS = [re.compile(r'^SCAN (\w+)$'), re.compile(r'Seq Scan on (\w+)')]
+
+
+def routes(admin, doctor, patient, department):
+    # Every page and API route that reads the database, as (role, method, url, form)
+    today = date.today()
+    yield patient, 'GET', '/dashboard', None
+    yield patient, 'GET', '/book-appointment', None
+    yield patient, 'POST', '/book-appointment', {'doctor': str(doctor.id), 'appointment_type': 'online', 'date': (today + timedelta(days=3)).isoformat(), 'time': '10:00', 'comments': ''}
+    yield patient, 'GET', f'/api/free-slots?doctor={doctor.id}', None
+    yield patient, 'GET', f'/api/free-slots?department={department.id}', None
+    yield None, 'POST', '/login', {'email': patient.email, 'password': 'wrong'}
+    yield None, 'POST', '/admin/login', {'email': admin.email, 'password': 'wrong'}
+    yield None, 'POST', '/doctor/login', {'email': doctor.email, 'password': 'wrong'}
+
+    yield admin, 'GET', '/admin/', None
+    yield admin, 'GET', '/admin/add-doctor', None
+    yield admin, 'GET', '/admin/view-doctors', None
+    yield admin, 'GET', f'/admin/view-doctors?department={department.id}&gender=Male', None
+    yield admin, 'GET', '/admin/view-patients', None
+    yield admin, 'GET', '/admin/view-patients?gender=Female&blood_group=O%2B', None
+    yield admin, 'GET', '/admin/view-appointments', None
+    yield admin, 'GET', f'/admin/view-appointments?date_from={today.isoformat()}&department={department.id}', None
+    yield admin, 'GET', f'/admin/api/appointments?doctor={doctor.id}', None
+    yield admin, 'GET', '/admin/api/patients', None
+    yield admin, 'GET', '/admin/api/doctors', None
+
+    yield doctor, 'GET', '/doctor/dashboard', None
+    yield doctor, 'GET', '/doctor/view-appoinments', None
+
+
+def explain(connection, statement, parameters):
+    if connection.dialect.name == 'sqlite':
+        return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    # With sequential scans priced out the planner uses any index that applies, so a
+    # Seq Scan left in the plan means there is no index for it at all
+    with connection.begin():
+        connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        return [row[0] for row in connection.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+
+
+def full_scans(statement, plan):
+    # Statements that read a whole table on purpose (pickers, loading the availability
+    # index) cannot use an index, only filtered or joined reads are checked
+    if not re.search(r'\b(WHERE|JOIN)\b', statement):
+        return set()
+    tables = set()
+    for line in plan:
+        for pattern in SCAN_PATTERNS:
+            match = pattern.search(line.strip())
+            if match:
+                tables.add(match.group(1))
+    return tables - EXPECTED_SCANS
+
+
+def capture_statements(client, engine, users):
+    statements = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            statements.setdefault(statement, (current_route, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        for user, method, url, form in routes(*users):
+            current_route = f'{method} {url}'
+            with client.session_transaction() as session:
+                session.clear()
+                if user is not None:
+                    session['_user_id'] = user.get_id()
+                    session['_fresh'] = True
+            response = client.open(url, method=method, data=form)
+            if response.status_code >= 400:
+                print(f'warning: {current_route} returned {response.status_code}')
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the query plan of every statement the routes issue and fail on unindexed scans.')
+    parser.add_argument('--seed', type=int, default=None, help='drop every table and seed this many appointments (default: 500 on the in-memory database, no seeding otherwise)')
+    parser.add_argument('--quiet', action='store_true', help='only print statements with unexpected full scans')
+    args = parser.parse_args()
+
+    in_memory = os.environ['DATABASE_URL'] == 'sqlite://'
+    seed_count = args.seed if args.seed is not None else (500 if in_memory else None)
+
+    with app.app_context():
+        if seed_count:
+            seed(seed_count)
+            upgrade(echo=lambda message: None)
+        users = (Admin.query.first(), Doctor.query.first(), Patient.query.first(), Department.query.first())
+        if None in users:
+            sys.exit('The database needs at least one admin, doctor, patient and department, pass --seed on a scratch database')
+        # Identities are resolved per request, not from another test's cache
+        db.session.expunge_all()
+        engine = db.engine
+
+    # Each request gets its own app context so login and identity loading run as in production
+    statements = capture_statements(app.test_client(), engine, users)
+
+    failures = 0
+    with engine.connect() as connection:
+        for statement, (route, parameters) in statements.items():
+            plan = explain(connection, statement, parameters)
+            scans = full_scans(statement, plan)
+            failures += bool(scans)
+            if args.quiet and not scans:
+                continue
+            print(f'-- {route}{"  FULL SCAN: " + ", ".join(sorted(scans)) if scans else ""}')
+            print(' '.join(statement.split()))
+            for line in plan:
+                print(f'    {line}')
+            print()
+
+    print(f'{len(statements)} statements, {failures} with unindexed full scans')
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,231 @@
+import argparse
+from collections import defaultdict
+from datetime import date, timedelta
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+# Same database benchmarks/seed_data.py fills by default
+os.environ.setdefault('DATABASE_URL', 'sqlite:///loadtest.db')
+
+from sqlalchemy import event
+
+from app.app import create_app
+from app.model import db, Doctor, Department
+
+app = create_app()
+
+
+# Requests are grouped under a route name, the URL can carry per-request values
+def patient_routes(ctx, rng, writes):
+    yield 'GET /', '/', None
+    yield 'GET /dashboard', '/dashboard', None
+    yield 'GET /profile', '/profile', None
+    yield 'GET /update-profile', '/update-profile', None
+    yield 'GET /book-appointment', '/book-appointment', None
+    yield 'GET /api/free-slots?doctor', f'/api/free-slots?doctor={rng.choice(ctx["doctor_ids"])}', None
+    yield 'GET /api/free-slots?department', f'/api/free-slots?department={rng.choice(ctx["department_ids"])}', None
+    yield 'GET /unauthorized', '/unauthorized', None
+    if writes:
+        day = date.today() + timedelta(days=rng.randint(1, 60))
+        yield 'POST /book-appointment', '/book-appointment', {
+            'doctor': str(rng.choice(ctx['doctor_ids'])), 'appointment_type': rng.choice(['online', 'offline']),
+            'date': day.isoformat(), 'time': f'{rng.randint(9, 16):02d}:{rng.choice([0, 30]):02d}', 'comments': 'Load test'}
+
+
+def doctor_routes(ctx, rng, writes):
+    yield 'GET /doctor/dashboard', '/doctor/dashboard', None
+    yield 'GET /doctor/view-appoinments', '/doctor/view-appoinments', None
+    yield 'GET /doctor/unauthorized', '/doctor/unauthorized', None
+
+
+def admin_routes(ctx, rng, writes):
+    department_id = rng.choice(ctx['department_ids'])
+    yield 'GET /admin/', '/admin/', None
+    yield 'GET /admin/view-doctors', '/admin/view-doctors', None
+    yield 'GET /admin/view-doctors?department', f'/admin/view-doctors?department={department_id}', None
+    yield 'GET /admin/view-departments', '/admin/view-departments', None
+    yield 'GET /admin/view-patients', '/admin/view-patients', None
+    yield 'GET /admin/view-patients?gender&blood_group', f'/admin/view-patients?gender={rng.choice(["Male", "Female"])}&blood_group=O%2B', None
+    yield 'GET /admin/view-appointments', '/admin/view-appointments', None
+    yield 'GET /admin/view-appointments?date_from&department', f'/admin/view-appointments?date_from={date.today().isoformat()}&department={department_id}', None
+    yield 'GET /admin/api/appointments?doctor', f'/admin/api/appointments?doctor={rng.choice(ctx["doctor_ids"])}', None
+    yield 'GET /admin/api/patients', '/admin/api/patients', None
+    yield 'GET /admin/api/doctors', '/admin/api/doctors', None
+    yield 'GET /admin/api/cache-stats', '/admin/api/cache-stats', None
+    yield 'GET /admin/add-doctor', '/admin/add-doctor', None
+    yield 'GET /admin/add-patient', '/admin/add-patient', None
+    yield 'GET /admin/add-department', '/admin/add-department', None
+    if writes:
+        n = next(ctx['sequence'])
+        yield 'POST /admin/add-department', '/admin/add-department', {'department': f'Load test {n}'}
+        yield 'POST /admin/add-patient', '/admin/add-patient', {
+            'first_name': 'Load', 'last_name': 'Patient', 'email': f'load-patient-{ctx["run"]}-{n}@example.com', 'phone_number': '0800',
+            'password': 'password', 'age': 40, 'health_status': 'Stable', 'blood_group': 'A+', 'height': 1.7, 'weight': 70,
+            'gender': 'Female', 'image': (None, '')}
+        yield 'POST /admin/add-doctor', '/admin/add-doctor', {
+            'first_name': 'Load', 'last_name': 'Doctor', 'email': f'load-doctor-{ctx["run"]}-{n}@example.com', 'phone_number': '0800',
+            'password': 'password', 'gender': 'Male', 'comments': '', 'department': department_id, 'image': (None, '')}
+
+
+# role: (login URL, email, routes, logout URL)
+ROLES = {
+    'patient': ('/login', lambda rng, ctx: f'patient{rng.randrange(ctx["patients"])}@example.com', patient_routes, '/logout'),
+    'doctor': ('/doctor/login', lambda rng, ctx: f'doctor{rng.randrange(ctx["doctors"])}@example.com', doctor_routes, '/doctor/logout'),
+    'admin': ('/admin/login', lambda rng, ctx: 'admin@example.com', admin_routes, '/admin/logout'),
+}
+# Pages outside a login, requested by every virtual user before it signs in
+PUBLIC_ROUTES = {
+    'patient': [('GET /login', '/login'), ('GET /register', '/register')],
+    'doctor': [('GET /doctor/login', '/doctor/login')],
+    'admin': [('GET /admin/login', '/admin/login'), ('GET /admin/register', '/admin/register')],
+}
+
+
+class Recorder:
+    # Collects (latency, status, query count) per route across every virtual user
+
+    def __init__(self, engine):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._count_query)
+
+    def _count_query(self, conn, cursor, statement, parameters, context, executemany):
+        # The test client runs the request on the calling thread
+        if getattr(self._local, 'queries', None) is not None:
+            self._local.queries += 1
+
+    def request(self, client, name, url, data=None):
+        self._local.queries = 0
+        started = time.perf_counter()
+        response = client.post(url, data=data) if data is not None else client.get(url)
+        elapsed = time.perf_counter() - started
+        queries, self._local.queries = self._local.queries, None
+        with self._lock:
+            self.samples[name].append((elapsed, response.status_code, queries))
+        return response
+
+
+def virtual_user(role, recorder, ctx, password, iterations, writes, seed):
+    rng = random.Random(seed)
+    login_url, email, routes, logout_url = ROLES[role]
+    client = app.test_client()
+    for name, url in PUBLIC_ROUTES[role]:
+        recorder.request(client, name, url)
+    credentials = {'email': email(rng, ctx), 'password': password}
+    # Password hashing sheds load with a 503 when its queue is full, back off like a browser would
+    for _ in range(10):
+        response = recorder.request(client, f'POST {login_url}', login_url, credentials)
+        if response.status_code != 503:
+            break
+        time.sleep(float(response.headers.get('Retry-After', 1)) * rng.uniform(0.5, 1.5))
+    for _ in range(iterations):
+        for name, url, data in routes(ctx, rng, writes):
+            recorder.request(client, name, url, data)
+    recorder.request(client, f'GET {logout_url}', logout_url)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def summarize(samples, elapsed):
+    routes = {}
+    for name, values in sorted(samples.items()):
+        latencies = sorted(latency * 1000 for latency, _, _ in values)
+        routes[name] = {
+            'requests': len(values),
+            'errors': sum(status >= 400 for _, status, _ in values),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'queries': round(statistics.mean(queries for _, _, queries in values), 1),
+            'max_queries': max(queries for _, _, queries in values),
+        }
+    total = sum(route['requests'] for route in routes.values())
+    return {
+        'requests': total,
+        'errors': sum(route['errors'] for route in routes.values()),
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round(total / elapsed, 1),
+        'routes': routes,
+    }
+
+
+def change(new, old):
+    return f'{(new - old) / old * 100:+.0f}%' if old else ('' if new == old else 'new')
+
+
+def print_report(result, baseline=None):
+    baseline_routes = (baseline or {}).get('routes', {})
+    print(f'{"route":<52} {"n":>6} {"err":>5} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8}' + ('   vs baseline p50/p95/queries' if baseline else ''))
+    for name, route in result['routes'].items():
+        line = f'{name:<52} {route["requests"]:>6} {route["errors"]:>5} {route["p50_ms"]:>9.2f} {route["p95_ms"]:>9.2f} {route["p99_ms"]:>9.2f} {route["queries"]:>8.1f}'
+        if baseline:
+            old = baseline_routes.get(name)
+            line += '   ' + ('new route' if old is None else f'{change(route["p50_ms"], old["p50_ms"]):>6} {change(route["p95_ms"], old["p95_ms"]):>6} {change(route["queries"], old["queries"]):>6}')
+        print(line)
+    print(f'\n{result["requests"]} requests, {result["errors"]} errors in {result["elapsed_s"]}s: {result["throughput_rps"]} requests/s'
+          + (f' (baseline {baseline["throughput_rps"]} requests/s, {change(result["throughput_rps"], baseline["throughput_rps"])})' if baseline else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Log in as every role, hit every route and report latency, throughput and query counts.')
+    parser.add_argument('--patients', type=int, default=4, help='concurrent patient users')
+    parser.add_argument('--doctors', type=int, default=2, help='concurrent doctor users')
+    parser.add_argument('--admins', type=int, default=1, help='concurrent admin users')
+    parser.add_argument('--iterations', type=int, default=10, help='passes over its routes per user')
+    parser.add_argument('--password', default='password', help='password the seeded users share')
+    parser.add_argument('--read-only', action='store_true', help='skip the routes that create rows')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--save', metavar='PATH', help='write the results as JSON, to use as a baseline later')
+    parser.add_argument('--baseline', metavar='PATH', help='compare against results saved with --save')
+    parser.add_argument('--verbose', action='store_true', help='show the app\'s error logs')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # Broken pages still show up as errors in the report, without a traceback per request
+        app.logger.setLevel(logging.CRITICAL)
+
+    with app.app_context():
+        engine = db.engine
+        ctx = {
+            'doctor_ids': [id for id, in db.session.query(Doctor.id)],
+            'department_ids': [id for id, in db.session.query(Department.id)],
+            'doctors': Doctor.query.filter(Doctor.email.like('doctor%@example.com')).count(),
+            'patients': db.session.execute(db.text("SELECT count(*) FROM patient WHERE email LIKE 'patient%@example.com'")).scalar(),
+            'run': int(time.time()),
+            'sequence': iter(range(10 ** 9)),
+        }
+    if not (ctx['doctors'] and ctx['patients'] and ctx['department_ids']):
+        sys.exit('No seeded users found, run python -m benchmarks.seed_data first')
+
+    recorder = Recorder(engine)
+    users = [role for role, count in (('patient', args.patients), ('doctor', args.doctors), ('admin', args.admins)) for _ in range(count)]
+    threads = [threading.Thread(target=virtual_user, args=(role, recorder, ctx, args.password, args.iterations, not args.read_only, args.random_seed + i))
+               for i, role in enumerate(users)]
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(recorder.samples, time.perf_counter() - started)
+    result['config'] = {'database': engine.dialect.name, 'users': {role: users.count(role) for role in ROLES},
+                        'iterations': args.iterations, 'writes': not args.read_only}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f'Saved results to {args.save}')
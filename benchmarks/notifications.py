@@ -0,0 +1,66 @@
+import argparse
+from datetime import datetime
+import os
+import time
+
+# Runs against the seeded load-test database unless DATABASE_URL says otherwise. Mail goes
+# to an SMTP sink started here
+os.environ.setdefault('DATABASE_URL', 'sqlite:///loadtest.db')
+
+from app.app import create_app
+from app.mail import SMTPSink, smtp_pool
+from app.jobs import Worker, enqueue
+from app.model import db, Job, Appointment, AppointmentReminder
+from app.notifications import dispatch_reminders
+
+sink = SMTPSink(port=0).start()
+app = create_app({'MAIL_SERVER': '127.0.0.1', 'MAIL_PORT': sink.server_address[1]})
+
+
+def drain(pool_size):
+    # One worker in this process, until no job is due
+    smtp_pool.close()
+    smtp_pool.size = pool_size
+    messages, connections = sink.messages, sink.connections
+    started = time.perf_counter()
+    Worker(app, burst=True).run()
+    elapsed = time.perf_counter() - started
+    return sink.messages - messages, sink.connections - connections, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Booking confirmation and reminder throughput against a local SMTP sink.')
+    parser.add_argument('--jobs', type=int, default=2000, help='booking confirmations to queue per run')
+    parser.add_argument('--lead-days', type=int, default=3, help='reminder window for the dispatch run')
+    args = parser.parse_args()
+
+    benchmark_started = datetime.utcnow()
+    with app.app_context():
+        first_job = (db.session.query(db.func.max(Job.id)).scalar() or 0) + 1
+        appointment_ids = [id for id, in db.session.query(Appointment.id).order_by(Appointment.id.desc()).limit(args.jobs)]
+        print(f'Against {db.engine.url.render_as_string(hide_password=True)}, SMTP sink on port {sink.server_address[1]}')
+        try:
+            for label, pool_size in (('one connection per message', 0), ('pooled connections', 4)):
+                started = time.perf_counter()
+                # Each booking commits its own job, like the request does
+                for appointment_id in appointment_ids:
+                    enqueue('booking_confirmation', {'appointment_id': appointment_id})
+                    db.session.commit()
+                enqueued = time.perf_counter() - started
+                messages, connections, elapsed = drain(pool_size)
+                print(f'{label:<28} enqueue {len(appointment_ids) / enqueued:>7.0f}/s   send {messages / elapsed:>7.0f} msg/s '
+                      f'over {connections} SMTP connections')
+
+            app.config['REMINDER_LEAD_TIME'] = args.lead_days * 24 * 3600
+            messages = sink.messages
+            started = time.perf_counter()
+            sent = dispatch_reminders()
+            elapsed = time.perf_counter() - started
+            print(f'reminder dispatch, {args.lead_days} days ahead     {sent} reminders in {elapsed:.2f}s '
+                  f'({(sink.messages - messages) / max(elapsed, 1e-9):.0f} msg/s)')
+        finally:
+            # Leave the database as it was
+            db.session.rollback()
+            db.session.query(Job).filter(Job.id >= first_job).delete(synchronize_session=False)
+            db.session.query(AppointmentReminder).filter(AppointmentReminder.sent_at >= benchmark_started).delete(synchronize_session=False)
+            db.session.commit()
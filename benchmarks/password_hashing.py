@@ -0,0 +1,64 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from app.hashing import PasswordHasher, HashingBusy
+
+
+# Cost settings worth comparing, from werkzeug's defaults down to cheaper ones
+METHODS = [
+    'scrypt:32768:8:1',
+    'scrypt:16384:8:1',
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha256:260000',
+]
+
+
+def logins_per_second_per_core(method, seconds):
+    # Verify a password on a single core for roughly `seconds`
+    password_hash = generate_password_hash('correct horse battery staple', method)
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        check_password_hash(password_hash, 'correct horse battery staple')
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def pool_logins_per_second(method, workers, clients, logins):
+    # Drive the bounded pool with concurrent request threads, counting shed requests
+    hasher = PasswordHasher(workers=workers)
+    password_hash = generate_password_hash('correct horse battery staple', method)
+    hasher.verify(password_hash, 'warm up the pool')
+    shed = 0
+
+    def login(_):
+        nonlocal shed
+        try:
+            hasher.verify(password_hash, 'correct horse battery staple')
+        except HashingBusy:
+            shed += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as clients_pool:
+        list(clients_pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    hasher.shutdown()
+    return (logins - shed) / elapsed, shed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure password verification throughput per cost setting.')
+    parser.add_argument('--seconds', type=float, default=2.0, help='time spent per single-core measurement')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='hashing pool size')
+    parser.add_argument('--clients', type=int, default=64, help='concurrent login threads')
+    parser.add_argument('--logins', type=int, default=200, help='logins per pool measurement')
+    args = parser.parse_args()
+
+    print(f'{"method":<24} {"logins/s/core":>14} {"pool logins/s":>14} {"shed":>6}')
+    for method in METHODS:
+        per_core = logins_per_second_per_core(method, args.seconds)
+        pooled, shed = pool_logins_per_second(method, args.workers, args.clients, args.logins)
+        print(f'{method:<24} {per_core:>14.1f} {pooled:>14.1f} {shed:>6}')
@@ -0,0 +1,81 @@
+import argparse
+import os
+import random
+import resource
+import statistics
+import time
+
+# Only --database mode touches a database, the in-memory index is fed generated rows
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app.search import MemoryIndex, search
+from benchmarks.seed_data import app, person, weighted, FIRST_NAMES, LAST_NAMES, BLOOD_GROUPS, HEALTH_STATUSES
+
+
+def patient_rows(count, rng):
+    for i in range(count):
+        row = person(rng, 'patient', i, 1, '!')
+        yield (row['id'], row['first_name'], row['last_name'], row['email'], row['phone_number'],
+               {'blood_group': weighted(rng, BLOOD_GROUPS), 'health_status': weighted(rng, HEALTH_STATUSES)})
+
+
+def typo(word, rng):
+    i = rng.randrange(1, len(word))
+    return word[:i - 1] + word[i] + word[i - 1] + word[i + 1:]
+
+
+def queries(count, records, rng):
+    # What people type into a typeahead: name prefixes, first and last name, an email,
+    # a phone prefix, a misspelt name, a prefix narrowed by blood group
+    names = FIRST_NAMES['Male'] + FIRST_NAMES['Female']
+    for _ in range(count):
+        kind = rng.randrange(6)
+        if kind == 0:
+            yield 'prefix', rng.choice(LAST_NAMES)[:rng.randint(2, 5)], {}
+        elif kind == 1:
+            yield 'full name', f'{rng.choice(names)} {rng.choice(LAST_NAMES)[:3]}', {}
+        elif kind == 2:
+            yield 'email', f'patient{rng.randrange(records)}', {}
+        elif kind == 3:
+            yield 'phone', f'+1555{rng.randrange(1000):03d}', {}
+        elif kind == 4:
+            yield 'typo', typo(rng.choice(LAST_NAMES).lower(), rng), {}
+        else:
+            yield 'filtered', rng.choice(LAST_NAMES)[:3], {'blood_group': 'AB-'}
+
+
+def report(latencies):
+    print(f'{"query":<10} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for kind, values in sorted(latencies.items()):
+        values = sorted(values)
+        pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+        print(f'{kind:<10} {len(values):>6} {statistics.median(values):>8.2f} {pick(0.95):>8.2f} {pick(0.99):>8.2f} {values[-1]:>8.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure typeahead search latency.')
+    parser.add_argument('--records', type=int, default=1_000_000, help='patients in the in-memory index')
+    parser.add_argument('--queries', type=int, default=600)
+    parser.add_argument('--database', action='store_true', help='search the patients already in DATABASE_URL through search() instead')
+    parser.add_argument('--random-seed', type=int, default=42)
+    args = parser.parse_args()
+    rng = random.Random(args.random_seed)
+
+    if args.database:
+        context = app.app_context()
+        context.push()
+        run = lambda query, filters: search('patients', query, filters)
+    else:
+        index = MemoryIndex('patients')
+        started = time.perf_counter()
+        index.load(patient_rows(args.records, rng))
+        print(f'Indexed {len(index)} patients in {time.perf_counter() - started:.1f}s, '
+              f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+        run = lambda query, filters: index.search(query, filters)
+
+    latencies = {}
+    for kind, query, filters in queries(args.queries, args.records, rng):
+        started = time.perf_counter()
+        run(query, filters)
+        latencies.setdefault(kind, []).append((time.perf_counter() - started) * 1000)
+    report(latencies)
@@ -0,0 +1,196 @@
+import argparse
+import math
+import os
+import random
+import sys
+import time as timer
+import uuid
+from datetime import date, time, timedelta
+
+# Never seed the production database by accident: without DATABASE_URL the data goes to
+# a SQLite file in the app's instance folder, shared with benchmarks/load.py
+os.environ.setdefault('DATABASE_URL', 'sqlite:///loadtest.db')
+
+from sqlalchemy import insert
+
+from app.app import create_app
+from app.model import db, Role, Department, Doctor, Patient, Admin, Appointment
+from app.hashing import hash_password
+from app.storage import DEFAULT_PROFILE_IMAGE
+from app import migrations, rollups
+
+app = create_app()
+
+
+ROLES = [(1, 'Patient'), (2, 'Doctor'), (3, 'Admin')]
+SPECIALTIES = ['Cardiology', 'Dermatology', 'Emergency Medicine', 'Endocrinology', 'Gastroenterology',
+               'General Surgery', 'Gynecology', 'Hematology', 'Nephrology', 'Neurology', 'Oncology',
+               'Ophthalmology', 'Orthopedics', 'Otolaryngology', 'Pediatrics', 'Psychiatry',
+               'Pulmonology', 'Radiology', 'Rheumatology', 'Urology']
+FIRST_NAMES = {
+    'Male': ['James', 'John', 'Robert', 'Michael', 'David', 'William', 'Daniel', 'Samuel', 'Tunde', 'Chinedu',
+             'Ahmed', 'Carlos', 'Wei', 'Ivan', 'Kofi', 'Arjun', 'Lucas', 'Mateo', 'Noah', 'Emeka'],
+    'Female': ['Mary', 'Patricia', 'Jennifer', 'Linda', 'Elizabeth', 'Sarah', 'Aisha', 'Ngozi', 'Fatima', 'Maria',
+               'Mei', 'Olga', 'Ama', 'Priya', 'Sofia', 'Emma', 'Olivia', 'Amara', 'Chloe', 'Yetunde'],
+}
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Okafor', 'Adeyemi',
+              'Mensah', 'Khan', 'Patel', 'Singh', 'Chen', 'Wang', 'Kim', 'Nguyen', 'Ivanova', 'Silva',
+              'Rossi', 'Muller', 'Dubois', 'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor',
+              'Moore', 'Martin', 'Jackson', 'Thompson', 'White', 'Harris', 'Clark', 'Lewis', 'Walker', 'Hall',
+              'Bello', 'Eze', 'Obi', 'Abubakar', 'Ibrahim', 'Hassan', 'Ali', 'Yamamoto', 'Sato', 'Kowalski']
+# Roughly the population frequencies
+BLOOD_GROUPS = [('O+', 38), ('A+', 34), ('B+', 9), ('AB+', 3), ('O-', 7), ('A-', 6), ('B-', 2), ('AB-', 1)]
+HEALTH_STATUSES = [('Stable', 70), ('Under treatment', 20), ('Critical', 3), ('Recovering', 7)]
+
+# Appointments fall on 30 minute slots between 9:00 and 17:00
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 16
+
+
+def chunked(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bulk_insert(model, rows, total, batch_size, echo):
+    # Core executemany inserts, no ORM objects or session events. Each batch commits so
+    # memory stays flat however many rows are generated
+    started = timer.perf_counter()
+    inserted = 0
+    for batch in chunked(rows, batch_size):
+        db.session.execute(insert(model.__table__), batch)
+        db.session.commit()
+        inserted += len(batch)
+        if inserted % (batch_size * 20) == 0 or inserted == total:
+            echo(f'  {model.__tablename__}: {inserted}/{total}')
+    elapsed = timer.perf_counter() - started
+    echo(f'{model.__tablename__}: {inserted} rows in {elapsed:.1f}s ({inserted / max(elapsed, 1e-9):.0f} rows/s)')
+
+
+def person(rng, prefix, i, role_id, password_hash):
+    gender = 'Male' if rng.random() < 0.5 else 'Female'
+    return {
+        'id': uuid.UUID(int=rng.getrandbits(128), version=4),
+        'first_name': rng.choice(FIRST_NAMES[gender]),
+        'last_name': rng.choice(LAST_NAMES),
+        'email': f'{prefix}{i}@example.com',
+        'phone_number': f'+1555{rng.randrange(10 ** 7):07d}',
+        'gender': gender,
+        'image_file': DEFAULT_PROFILE_IMAGE,
+        'password_hash': password_hash,
+        'role_id': role_id,
+    }
+
+
+def weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+def slot_step(total_slots):
+    # A stride coprime with the number of slots visits every slot once before repeating,
+    # so a doctor is never booked twice for the same slot
+    step = max(1, total_slots // 7) | 1
+    while math.gcd(step, total_slots) != 1:
+        step += 2
+    return step
+
+
+def generate(patients, doctors, departments, appointments, days, password, batch_size=5000, random_seed=42, echo=print):
+    rng = random.Random(random_seed)
+    # Hashing is deliberately slow, every seeded user shares one hash of the same password
+    password_hash = hash_password(password)
+
+    db.session.execute(insert(Role.__table__), [{'id': id, 'name': name} for id, name in ROLES])
+    department_rows = [{'id': i + 1, 'name': SPECIALTIES[i] if i < len(SPECIALTIES) else f'Department {i + 1}'} for i in range(departments)]
+    db.session.execute(insert(Department.__table__), department_rows)
+    db.session.execute(insert(Admin.__table__), [dict(person(rng, 'admin', 0, 3, password_hash), email='admin@example.com')])
+    db.session.commit()
+
+    doctor_ids = []
+
+    def doctor_rows():
+        for i in range(doctors):
+            row = person(rng, 'doctor', i, 2, password_hash)
+            row['department_id'] = rng.randrange(departments) + 1
+            row['bio'] = f'Consultant in {department_rows[row["department_id"] - 1]["name"]}'
+            doctor_ids.append(row['id'])
+            yield row
+
+    patient_ids = []
+
+    def patient_rows():
+        for i in range(patients):
+            row = person(rng, 'patient', i, 1, password_hash)
+            row.update(age=rng.randint(1, 95), blood_group=weighted(rng, BLOOD_GROUPS), health_status=weighted(rng, HEALTH_STATUSES),
+                       height=round(rng.gauss(1.70, 0.1), 2), weight=round(rng.gauss(72, 14), 1))
+            patient_ids.append(row['id'])
+            yield row
+
+    bulk_insert(Doctor, doctor_rows(), doctors, batch_size, echo)
+    bulk_insert(Patient, patient_rows(), patients, batch_size, echo)
+
+    # Spread the doctors' bookings over the window, two thirds in the past and the rest
+    # upcoming. The window grows when the doctors would otherwise run out of slots
+    per_doctor = math.ceil(appointments / max(doctors, 1))
+    days = max(days, math.ceil(per_doctor / SLOTS_PER_DAY))
+    total_slots = days * SLOTS_PER_DAY
+    step = slot_step(total_slots)
+    offsets = [rng.randrange(total_slots) for _ in doctor_ids]
+    start = date.today() - timedelta(days=days * 2 // 3)
+
+    def appointment_rows():
+        for i in range(appointments):
+            d = i % doctors
+            slot = (offsets[d] + (i // doctors) * step) % total_slots
+            day, minute = divmod(slot, SLOTS_PER_DAY)
+            minutes = 9 * 60 + minute * SLOT_MINUTES
+            yield {
+                'doctor_id': doctor_ids[d],
+                'patient_id': patient_ids[rng.randrange(patients)],
+                'date': start + timedelta(days=day),
+                'time': time(minutes // 60, minutes % 60),
+                'comment': None,
+            }
+
+    bulk_insert(Appointment, appointment_rows(), appointments, batch_size, echo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill the database with synthetic roles, departments, doctors, patients and appointments.')
+    parser.add_argument('--patients', type=int, default=10000, help='e.g. 1000000 for a production-sized run')
+    parser.add_argument('--doctors', type=int, default=200)
+    parser.add_argument('--departments', type=int, default=20)
+    parser.add_argument('--appointments', type=int, default=100000, help='e.g. 10000000 for a production-sized run')
+    parser.add_argument('--days', type=int, default=365, help='days covered by the appointments')
+    parser.add_argument('--password', default='password', help='password of every seeded user')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--random-seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true', help='drop and recreate every table first')
+    args = parser.parse_args()
+
+    if min(args.patients, args.doctors, args.departments) < 1:
+        sys.exit('Need at least one patient, doctor and department')
+
+    with app.app_context():
+        print(f'Seeding {db.engine.url.render_as_string(hide_password=True)}')
+        if args.reset:
+            db.drop_all()
+            db.create_all()
+        elif db.session.query(Role.id).first() is not None:
+            sys.exit('The database already has data, pass --reset to replace it')
+
+        started = timer.perf_counter()
+        generate(args.patients, args.doctors, args.departments, args.appointments, args.days, args.password,
+                 batch_size=args.batch_size, random_seed=args.random_seed)
+        # Bulk inserts skip the session events, bring indexes and rollups up to date once
+        migrations.upgrade()
+        rollups.rebuild()
+        print(f'Done in {timer.perf_counter() - started:.1f}s. Log in as admin@example.com, doctor<N>@example.com '
+              f'or patient<N>@example.com with password {args.password!r}')
@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+# Runs in a fresh interpreter per measurement, so every import is cold. Prints one JSON line
+PROBE = '''
+import json, time
+started = time.perf_counter()
+from app.app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+client = app.test_client()
+client.get('/')
+first_request = time.perf_counter()
+from sqlalchemy import text
+from app.model import db
+with app.app_context():
+    db.session.execute(text('SELECT 1'))
+first_query = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'create_app': created - imported,
+    'first_request': first_request - created,
+    'first_query': first_query - first_request,
+    'total': first_query - started,
+}))
+'''
+
+STEPS = ['import', 'create_app', 'first_request', 'first_query', 'total']
+
+
+def measure(runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], capture_output=True, text=True, check=True, cwd=os.getcwd()).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return samples
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure cold start: import, create_app(), first request and first query.')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to start')
+    args = parser.parse_args()
+
+    # Defaults to a throwaway database so the numbers don't depend on a remote server
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    samples = measure(args.runs)
+    print(f'{"step":<14} {"median ms":>10} {"max ms":>10}')
+    for step in STEPS:
+        values = [sample[step] * 1000 for sample in samples]
+        print(f'{step:<14} {statistics.median(values):>10.1f} {max(values):>10.1f}')
@@ -0,0 +1,68 @@
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import uuid
+
+# Templates are rendered without touching the database
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flask import render_template
+from jinja2 import FileSystemBytecodeCache
+
+from app.app import create_app
+from app.model import Admin
+
+app = create_app({'JINJA_BYTECODE_CACHE_DIR': ''})
+
+
+def measure(fn, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def fresh_env(bytecode_cache=None):
+    # No template cache, every get_template() loads like a worker that just booted
+    return app.jinja_env.overlay(cache_size=0, bytecode_cache=bytecode_cache)
+
+
+def render(name, admin, fragments):
+    app.config['FRAGMENT_CACHE_ENABLED'] = fragments
+    with app.test_request_context():
+        return render_template(name, admin=admin)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-template compile, bytecode load and render times.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--prefix', default='', help='only templates whose name starts with this, e.g. admin/')
+    args = parser.parse_args()
+
+    names = [name for name in app.jinja_env.list_templates() if name.startswith(args.prefix)]
+    bytecode_cache = FileSystemBytecodeCache(tempfile.mkdtemp(prefix='jinja-bench-'))
+    warm = fresh_env(bytecode_cache)
+    for name in names:
+        warm.get_template(name)
+
+    admin = Admin(id=uuid.uuid4(), first_name='Ada', last_name='Admin', email='admin@example.com')
+    totals = [0.0, 0.0]
+    print(f'{"template":<42} {"compile ms":>11} {"bytecode ms":>12} {"render ms":>10} {"fragments ms":>13}')
+    for name in names:
+        compile_ms = measure(lambda: fresh_env().get_template(name), args.runs)
+        load_ms = measure(lambda: fresh_env(bytecode_cache).get_template(name), args.runs)
+        totals[0] += compile_ms
+        totals[1] += load_ms
+        try:
+            render(name, admin, True)
+            render_ms = f'{measure(lambda: render(name, admin, False), args.runs):.2f}'
+            fragment_ms = f'{measure(lambda: render(name, admin, True), args.runs):.2f}'
+        except Exception:
+            # Pages that need view data to render at all
+            render_ms = fragment_ms = '-'
+        print(f'{name:<42} {compile_ms:>11.2f} {load_ms:>12.2f} {render_ms:>10} {fragment_ms:>13}')
+    print(f'{len(names)} templates: {totals[0]:.0f}ms to compile from source, {totals[1]:.0f}ms to load from the bytecode cache')
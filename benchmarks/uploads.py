@@ -0,0 +1,105 @@
+import argparse
+import io
+import os
+import statistics
+import tempfile
+import time
+
+# Run against a throwaway in-memory database and the local filesystem backend
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ['STORAGE_BACKEND'] = 'local'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+
+from app.app import create_app
+from PIL import Image
+from app.model import db, Role, Patient
+from app.storage import LocalFileStorage, UploadQueue, DEFAULT_PROFILE_IMAGE
+from app.images import VARIANT_SIZES, content_digest, variant_name
+from app import storage
+
+app = create_app()
+
+
+class SimulatedRemoteStorage(LocalFileStorage):
+    # Local storage that sleeps like a remote blob service: a handshake when a client
+    # is created and a transfer per upload
+    def __init__(self, root, connect_latency, upload_latency, pooled):
+        super().__init__(root, '/static/uploads')
+        self.connect_latency = connect_latency
+        self.upload_latency = upload_latency
+        self.pooled = pooled
+        self.connected = False
+
+    def upload(self, data, name, content_type=None):
+        if not (self.pooled and self.connected):
+            time.sleep(self.connect_latency)
+            self.connected = True
+        time.sleep(self.upload_latency)
+        return super().upload(data, name, content_type)
+
+
+def measure(label, upload, count):
+    timings = []
+    for i in range(count):
+        started = time.perf_counter()
+        upload(i)
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f'{label:<34} p50={statistics.median(timings):7.2f}ms  max={max(timings):7.2f}ms')
+
+
+def sample_photo(width=3000, height=2000):
+    # A camera-sized JPEG with EXIF, the kind of file users actually upload
+    image = Image.radial_gradient('L').resize((width, height)).convert('RGB')
+    output = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x010F] = 'Camera maker'
+    image.save(output, 'JPEG', quality=95, exif=exif)
+    return output.getvalue()
+
+
+def end_to_end(root, count):
+    # Register patients through the admin route and check every placeholder gets patched
+    storage.storage = SimulatedRemoteStorage(root, 0.05, 0.02, pooled=True)
+    photo = sample_photo()
+    with app.app_context():
+        db.create_all()
+        db.session.add(Role(id=1, name='Patient'))
+        db.session.commit()
+
+    timings = []
+    client = app.test_client()
+    for i in range(count):
+        data = {'first_name': 'Pat', 'last_name': str(i), 'email': f'patient{i}@example.com', 'phone_number': '0800',
+                'password': 'pw', 'age': '30', 'health_status': 'Stable', 'blood_group': 'O+', 'height': '1.7',
+                'weight': '70', 'gender': 'Female', 'image': (io.BytesIO(photo), 'avatar.jpg')}
+        started = time.perf_counter()
+        client.post('/register', data=data, content_type='multipart/form-data')
+        timings.append((time.perf_counter() - started) * 1000)
+        client.get('/logout')
+
+    storage.upload_queue.join()
+    with app.app_context():
+        pending = Patient.query.filter_by(image_file=DEFAULT_PROFILE_IMAGE).count()
+    print(f'{"register route (queued upload)":<34} p50={statistics.median(timings):7.2f}ms  max={max(timings):7.2f}ms  unpatched={pending}')
+
+    variants = {label: os.path.getsize(os.path.join(root, variant_name(content_digest(photo), label))) for label in VARIANT_SIZES}
+    print(f'original {len(photo) // 1024} KB -> ' + ', '.join(f'{label} {size / 1024:.1f} KB' for label, size in variants.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare request-facing upload latency per strategy.')
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--size', type=int, default=256 * 1024, help='upload size in bytes')
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size)
+    with tempfile.TemporaryDirectory() as root:
+        per_call = lambda i: SimulatedRemoteStorage(root, 0.05, 0.02, pooled=False).upload(payload, f'a/{i}.bin')
+        pooled_storage = SimulatedRemoteStorage(root, 0.05, 0.02, pooled=True)
+        queue = UploadQueue(workers=4)
+        measure('new client per upload (old path)', per_call, args.count)
+        measure('pooled client, synchronous', lambda i: pooled_storage.upload(payload, f'b/{i}.bin'), args.count)
+        measure('pooled client, queued', lambda i: queue.submit(app, lambda: pooled_storage.upload(payload, f'c/{i}.bin'), lambda url: None), args.count)
+        queue.join()
+        end_to_end(root, args.count)